@@ -1,8 +1,24 @@
 import os
 import binascii
+import decimal
+import functools
+import hashlib
+import itertools
+import json
 import logging
+import multiprocessing
+import threading
+import time
+import uuid
+from collections import deque, namedtuple
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
-from iroha import IrohaCrypto, Iroha, IrohaGrpc
+import grpc
+from google.protobuf import json_format
+from iroha import IrohaCrypto, Iroha
+from iroha import primitive_pb2, ed25519_sha3
+from profiling import trace
+from peer_registry import PeerRegistry
 
 class bcolors:
     HEADER = '\033[95m'
@@ -16,45 +32,61 @@ class bcolors:
     UNDERLINE = '\033[4m'
 
 
-# Iroha peer 1
-IROHA_HOST_ADDR_1 = os.getenv('IROHA_HOST_ADDR_1', '172.29.101.121')
-IROHA_PORT_1 = os.getenv('IROHA_PORT_1', '50051')
-# Iroha peer 2
-IROHA_HOST_ADDR_2 = os.getenv('IROHA_HOST_ADDR_2', '172.29.101.122')
-IROHA_PORT_2 = os.getenv('IROHA_PORT_2', '50052')
-# Iroha peer 3
-IROHA_HOST_ADDR_3 = os.getenv('IROHA_HOST_ADDR_3', '172.29.101.123')
-IROHA_PORT_3 = os.getenv('IROHA_PORT_3', '50053')
-# Iroha peer 4
-IROHA_HOST_ADDR_4 = os.getenv('IROHA_HOST_ADDR_3', '172.29.101.124')
-IROHA_PORT_4 = os.getenv('IROHA_PORT_4', '50054')
-
-
 ADMIN_ACCOUNT_ID = os.getenv('ADMIN_ACCOUNT_ID', 'admin@test')
 ADMIN_PRIVATE_KEY = os.getenv(
     'ADMIN_PRIVATE_KEY', 'f101537e319568c765b2cc89698325604991dca57b9716b58016b253506cab70')
 
+
 iroha = Iroha(ADMIN_ACCOUNT_ID)
-net_1 = IrohaGrpc('{}:{}'.format(IROHA_HOST_ADDR_1, IROHA_PORT_1), timeout=10)
-net_2 = IrohaGrpc('{}:{}'.format(IROHA_HOST_ADDR_2, IROHA_PORT_2), timeout=10)
-net_3 = IrohaGrpc('{}:{}'.format(IROHA_HOST_ADDR_3, IROHA_PORT_3), timeout=10)
-net_4 = IrohaGrpc('{}:{}'.format(IROHA_HOST_ADDR_4, IROHA_PORT_4), timeout=10)
+iroha_admin = iroha
+peers = PeerRegistry.from_env()
+net_1, net_2, net_3, net_4 = peers.connections()[:4]
 
 
-def trace(func):
+def unique_suffix():
+    """A suffix unique to this process, for names of domains, roles and assets that concurrent test runs must not share
+    It is the pytest-xdist worker id, if any, and 8 random hex digits, e.g. gw01f2e3d4c,
+    so it is valid in domain, account, role and asset names
+
+    Returns:
+        String: The suffix
     """
-    A decorator for tracing methods' begin/end execution points
+
+    return f"{os.getenv('PYTEST_XDIST_WORKER', '')}{uuid.uuid4().hex[:8]}"
+
+@trace
+def new_user(account_name, domain_id, private_key=None, public_key=None):
+    """Generate a new keypair and blockchain identity for a user. The account itself is not created
+
+    Args:
+        account_name (String): The name of the account, e.g. user_a
+        domain_id (String): The domain the account will belong to
+        private_key (String, optional): An existing private key to use instead of generating one
+        public_key (String, optional): The public key of private_key. Derived from it if not given
+
+    Returns:
+        dict: The name, domain, id, private_key and public_key of the user,
+            and iroha, an Iroha that creates transactions and queries as the user
     """
 
-    def tracer(*args, **kwargs):
-        name = func.__name__
-        logging.debug(f'{bcolors.HEADER}==> Entering "{name}"{bcolors.ENDC}')
-        result = func(*args, **kwargs)
-        logging.debug(f'{bcolors.HEADER}==> Leaving "{name}"{bcolors.ENDC}')
-        return result
+    if private_key is None:
+        private_key = IrohaCrypto.private_key()
+    account_id = f"{account_name}@{domain_id}"
+    return {
+        "name": account_name,
+        "domain": domain_id,
+        "id": account_id,
+        "private_key": private_key,
+        "public_key": public_key or IrohaCrypto.derive_public_key(private_key),
+        "iroha": Iroha(account_id),
+    }
 
-    return tracer
+def _log_transaction(transaction):
+    """Log the hash and creator of a transaction, only hashing it if debug logging is on"""
 
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug('Transaction hash = {}, creator = {}'.format(
+            binascii.hexlify(IrohaCrypto.hash(transaction)), transaction.payload.reduced_payload.creator_account_id))
 
 @trace
 def send_transaction(transaction, connection, verbose=False):
@@ -71,10 +103,8 @@ def send_transaction(transaction, connection, verbose=False):
         Iroha Transaction Status: The final transaction status received
     """
 
-    hex_hash = binascii.hexlify(IrohaCrypto.hash(transaction))
     logging.debug(transaction)
-    logging.debug('Transaction hash = {}, creator = {}'.format(
-        hex_hash, transaction.payload.reduced_payload.creator_account_id))
+    _log_transaction(transaction)
     connection.send_tx(transaction)
     last_status = None
     for status in connection.tx_status_stream(transaction):
@@ -82,30 +112,841 @@ def send_transaction(transaction, connection, verbose=False):
         last_status = status
     return last_status
 
+class TransactionResult(namedtuple("TransactionResult", ["status", "status_code", "error_code"])):
+    """The final status of one transaction of a batch, the same tuple send_transaction returns,
+    with the hash of the transaction and the timings of its statuses
+
+    Attributes:
+        status (String): The symbolic final status, e.g. COMMITTED
+        status_code (int): The integral final status code
+        error_code (int): The error code of the final status, 0 if no error occurred
+        hex_hash (String): The hex encoded hash of the transaction
+        stage_times (dict of String to float): Seconds from submission of the batch until each status was first seen
+    """
+
+    def __new__(cls, status, status_code, error_code, hex_hash=None, stage_times=None):
+        result = super().__new__(cls, status, status_code, error_code)
+        result.hex_hash = hex_hash
+        result.stage_times = stage_times or {}
+        return result
+
+
+def _track_transaction(transaction, connection, start, verbose=False):
+    """Follow the status stream of a sent transaction, timing each status against start"""
+
+    tx_hash = IrohaCrypto.hash(transaction)
+    hex_hash = binascii.hexlify(tx_hash).decode()
+    logging.debug('Transaction hash = {}, creator = {}'.format(
+        hex_hash, transaction.payload.reduced_payload.creator_account_id))
+    last_status = (None, None, None)
+    stage_times = {}
+    for status in connection.tx_hash_status_stream(tx_hash):
+        if verbose: print(status)
+        stage_times.setdefault(status[0], time.monotonic() - start)
+        last_status = status
+    return TransactionResult(*last_status, hex_hash, stage_times)
+
 @trace
-def send_batch(transactions, connection, verbose=False):
+def send_batch(transactions, connection, verbose=False, max_workers=32):
     """Send a batch of transactions across a connection, all at once
+    The status streams of the transactions are followed concurrently, so a batch
+    finishes in roughly one commit latency rather than one status round trip per transaction
 
     Args:
         transactions (list of Iroha.transaction): The signed transactions to send to a peer
         connection (IrohaGrpc): The Grpc connection to send the transactions across
         verbose (bool): A boolean to print the status stream to stdout
+        max_workers (int, optional): The most status streams to follow at once. Defaults to 32
 
     Returns:
-        Iroha Transaction Statuses: List of the final transaction status received, for each transaction in batch
+        list of TransactionResult: The final status, with the hash and status timings, for each transaction in batch
     """
 
+    if not transactions:
+        return []
+    start = time.monotonic()
     connection.send_txs(transactions)
-    last_status_list = []
-    for tx in transactions:
-        hex_hash = binascii.hexlify(IrohaCrypto.hash(tx))
-        logging.debug('Transaction hash = {}, creator = {}'.format(
-            hex_hash, tx.payload.reduced_payload.creator_account_id))
-        for status in connection.tx_status_stream(tx):
-            if verbose: print(status)
+    with ThreadPoolExecutor(max_workers=min(len(transactions), max_workers)) as executor:
+        return list(executor.map(
+            lambda tx: _track_transaction(tx, connection, start, verbose), transactions))
+
+class TransactionSubmitter:
+    """Pipelined transaction submission, keeping a window of transactions in flight per peer
+    Unlike send_transaction, submitting a transaction does not wait for a final status.
+    Instead each transaction is sent and its status stream followed on a worker thread,
+    so throughput is bound by consensus rather than by the client waiting on each round trip.
+    Submitting only blocks when the window of the chosen peer is full
+
+    Usage:
+        with TransactionSubmitter(window=20) as submitter:
+            futures = [submitter.submit(tx) for tx in transactions]
+        statuses = [f.result() for f in futures]
+    """
+
+    def __init__(self, connections=None, window=10, verbose=False):
+        """
+        Args:
+            connections (list of IrohaGrpc, optional): The peers to spread transactions over, round robin.
+                Defaults to every peer of the registry
+            window (int, optional): The maximum number of transactions in flight per peer. Defaults to 10
+            verbose (bool, optional): A boolean to print the status streams to stdout. Defaults to False
+        """
+
+        self.connections = connections if connections is not None else peers.connections()
+        self.window = window
+        self.verbose = verbose
+        self._windows = {connection: threading.BoundedSemaphore(window) for connection in self.connections}
+        self._windows_lock = threading.Lock()
+        self._round_robin = itertools.cycle(self.connections)
+        self._executor = ThreadPoolExecutor(max_workers=window * len(self.connections),
+            thread_name_prefix="TransactionSubmitter")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _window(self, connection):
+        with self._windows_lock:
+            if connection not in self._windows:
+                self._windows[connection] = threading.BoundedSemaphore(self.window)
+            return self._windows[connection]
+
+    def submit(self, transaction, connection=None, callback=None):
+        """Submit a signed transaction without waiting for its final status
+        Blocks only while the window of the chosen peer is full
+
+        Args:
+            transaction (Iroha.transaction): The signed transaction to send to a peer
+            connection (IrohaGrpc, optional): The peer to send to. Defaults to the next peer, round robin
+            callback (callable, optional): Called with the future once the final status is known
+
+        Returns:
+            concurrent.futures.Future: Resolves to the final transaction status received,
+                or raises the grpc.RpcError met while sending or streaming
+        """
+
+        if connection is None:
+            connection = next(self._round_robin)
+        window = self._window(connection)
+        window.acquire()
+        try:
+            future = self._executor.submit(self._send_and_track, transaction, connection)
+        except BaseException:
+            window.release()
+            raise
+        future.add_done_callback(lambda _: window.release())
+        if callback is not None:
+            future.add_done_callback(callback)
+        return future
+
+    def submit_all(self, transactions, connection=None):
+        """Submit many signed transactions, returning a future for each in the same order
+
+        Args:
+            transactions (list of Iroha.transaction): The signed transactions to send
+            connection (IrohaGrpc, optional): The peer to send all transactions to. Defaults to round robin
+
+        Returns:
+            list of concurrent.futures.Future: One future per transaction, resolving to the final status
+        """
+
+        return [self.submit(tx, connection) for tx in transactions]
+
+    def _send_and_track(self, transaction, connection):
+        _log_transaction(transaction)
+        connection.send_tx(transaction)
+        last_status = None
+        for status in connection.tx_status_stream(transaction):
+            if self.verbose: print(status)
             last_status = status
-        last_status_list.append(last_status)
-    return last_status_list
+        return last_status
+
+    def close(self, wait=True):
+        """Stop accepting transactions, optionally waiting for all in flight transactions to finish
+
+        Args:
+            wait (bool, optional): Wait for final statuses of all in flight transactions. Defaults to True
+        """
+
+        self._executor.shutdown(wait=wait)
+
+# Bulk signing -----------------------------------------------------------------
+# Signing is pure Python ed25519, taking milliseconds per signature, and IrohaCrypto derives the
+# public key from the private key again for every signature. Bulk signing derives each public key once,
+# and can spread large lists of transactions over a pool of processes in chunks. Only serialized payloads are
+# sent to the workers, and only hashes and signatures are sent back.
+# Workers are spawned, and a spawned process imports the __main__ module of its parent again, so a pool must
+# only be started below an if __name__ == "__main__" guard. Signing is in process unless the caller asks for a pool
+
+SIGNING_CHUNK_SIZE = 64
+
+def signing_pool(max_workers=None):
+    """A pool of spawned processes to sign and generate keys with, to pass as the executor of sign_transactions,
+    generate_keypairs and provision_accounts. Spawned rather than forked, as forking a process with open gRPC
+    channels is unsafe. Each worker imports the main script again, so create the pool below its
+    if __name__ == "__main__" guard, and reuse it rather than starting one per call
+
+    Usage:
+        if __name__ == "__main__":
+            with signing_pool() as executor:
+                sign_transactions(transactions, ADMIN_PRIVATE_KEY, executor=executor)
+
+    Args:
+        max_workers (int, optional): The number of processes. Defaults to the number of CPUs
+
+    Returns:
+        concurrent.futures.ProcessPoolExecutor: The pool, to shut down or use as a context manager
+    """
+
+    return ProcessPoolExecutor(max_workers, mp_context=multiprocessing.get_context("spawn"))
+
+@functools.lru_cache(maxsize=4096)
+def _public_key(private_key):
+    return IrohaCrypto.derive_public_key(private_key)
+
+def _sign_payloads(chunk):
+    """Hash and sign serialized transaction payloads
+
+    Args:
+        chunk (list of (bytes, tuple of String)): Each serialized payload and the hex private keys to sign it with
+
+    Returns:
+        list of (bytes, list of (bytes, bytes)): The hash of each payload, and its hex public keys and signatures
+    """
+
+    results = []
+    for payload, private_keys in chunk:
+        payload_hash = hashlib.sha3_256(payload).digest()
+        signatures = []
+        for private_key in private_keys:
+            public_key = _public_key(private_key)
+            signature = ed25519_sha3.signature_unsafe(
+                payload_hash, binascii.unhexlify(private_key), binascii.unhexlify(public_key))
+            signatures.append((public_key, binascii.hexlify(signature)))
+        results.append((payload_hash, signatures))
+    return results
+
+@trace
+def sign_transactions(transactions, private_keys, max_workers=1, chunk_size=SIGNING_CHUNK_SIZE, executor=None):
+    """Sign many transactions in place, as IrohaCrypto.sign_transaction does, in this process or across a pool
+    A max_workers above 1 starts a pool for this call alone, so pass an executor to sign many lists. Each worker of
+    either imports the main script again, so only sign across processes below an if __name__ == "__main__" guard
+
+    Args:
+        transactions (list of Iroha.transaction): The transactions to sign
+        private_keys (String or list): The hex private key to sign every transaction with, or one entry per
+            transaction, each a private key or a list of private keys to sign that transaction with
+        max_workers (int, optional): The most processes to sign with, if no executor is given. Defaults to 1,
+            signing in this process
+        chunk_size (int, optional): Transactions sent to a process at a time. Defaults to SIGNING_CHUNK_SIZE
+        executor (concurrent.futures.Executor, optional): A pool to sign across, e.g. from signing_pool, left open
+
+    Returns:
+        list of bytes: The hash of each transaction, as IrohaCrypto.hash
+    """
+
+    if isinstance(private_keys, (str, bytes)):
+        private_keys = [private_keys] * len(transactions)
+    if len(private_keys) != len(transactions):
+        raise ValueError(f"Expected a private key for each of {len(transactions)} transactions, got {len(private_keys)}")
+    work = [(transaction.payload.SerializeToString(), (keys,) if isinstance(keys, (str, bytes)) else tuple(keys))
+            for transaction, keys in zip(transactions, private_keys)]
+    chunks = [work[i:i + chunk_size] for i in range(0, len(work), chunk_size)]
+    if executor is not None and len(chunks) > 1:
+        results = [result for chunk_results in executor.map(_sign_payloads, chunks) for result in chunk_results]
+    elif min(max_workers or 1, len(chunks)) > 1:
+        with signing_pool(min(max_workers, len(chunks))) as executor:
+            results = [result for chunk_results in executor.map(_sign_payloads, chunks) for result in chunk_results]
+    else:
+        results = [result for chunk in chunks for result in _sign_payloads(chunk)]
+
+    hashes = []
+    for transaction, (payload_hash, signatures) in zip(transactions, results):
+        transaction.signatures.extend(primitive_pb2.Signature(public_key=public_key, signature=signature)
+                                      for public_key, signature in signatures)
+        hashes.append(payload_hash)
+    return hashes
+
+# Account provisioning ---------------------------------------------------------
+# Large fixtures need many accounts. Their keypairs can be generated across processes and are kept in a
+# keystore file, so later runs reuse them, and the accounts are created many to a transaction,
+# with the transactions sent as batches to every peer at once rather than one commit per account
+
+# CreateAccount commands packed into one transaction, and transactions sent per batch
+ACCOUNTS_PER_TRANSACTION = 500
+TRANSACTIONS_PER_BATCH = 10
+
+def _generate_keypairs(count):
+    keypairs = []
+    for _ in range(count):
+        private_key = IrohaCrypto.private_key()
+        keypairs.append((private_key.decode(), IrohaCrypto.derive_public_key(private_key).decode()))
+    return keypairs
+
+@trace
+def generate_keypairs(count, max_workers=1, chunk_size=256, executor=None):
+    """Generate keypairs in this process or across a pool
+    As with sign_transactions, only generate across processes below an if __name__ == "__main__" guard
+
+    Args:
+        count (int): The number of keypairs to generate
+        max_workers (int, optional): The most processes to generate keys with, if no executor is given. Defaults to 1,
+            generating in this process
+        chunk_size (int, optional): Keypairs generated by a process at a time. Defaults to 256
+        executor (concurrent.futures.Executor, optional): A pool to generate across, e.g. from signing_pool, left open
+
+    Returns:
+        list of (String, String): The hex private and public key of each keypair
+    """
+
+    chunks = [min(chunk_size, count - i) for i in range(0, count, chunk_size)]
+    if executor is not None and len(chunks) > 1:
+        return [keypair for keypairs in executor.map(_generate_keypairs, chunks) for keypair in keypairs]
+    if min(max_workers or 1, len(chunks)) > 1:
+        with signing_pool(min(max_workers, len(chunks))) as executor:
+            return [keypair for keypairs in executor.map(_generate_keypairs, chunks) for keypair in keypairs]
+    return [keypair for chunk in chunks for keypair in _generate_keypairs(chunk)]
+
+
+class Keystore:
+    """Keypairs of accounts kept in a JSON file, so accounts created on one run can be used on the next
+
+    Usage:
+        keystore = Keystore("logs/keystore.json")
+        users = keystore.users("load", 10000)  # Generates and saves any keys not already held
+    """
+
+    def __init__(self, path=None):
+        """
+        Args:
+            path (String, optional): The file to load keypairs from and save them to, if it exists.
+                Defaults to holding keypairs in memory only
+        """
+
+        self.path = path
+        self.keys = {}
+        if path is not None and os.path.exists(path):
+            with open(path) as f:
+                self.keys = json.load(f)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, account_id):
+        return account_id in self.keys
+
+    def save(self):
+        """Write the keystore to its file, replacing the file at once so it is never half written"""
+
+        if self.path is None:
+            return
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        with open(f"{self.path}.tmp", "w") as f:
+            json.dump(self.keys, f)
+        os.replace(f"{self.path}.tmp", self.path)
+
+    def users(self, domain_id, count, prefix="user", executor=None):
+        """The users {prefix}0 to {prefix}{count-1} of a domain, generating keypairs for those not held yet
+
+        Args:
+            domain_id (String): The domain of the users
+            count (int): The number of users
+            prefix (String, optional): Users are named {prefix}0 to {prefix}{count-1}. Defaults to user
+            executor (concurrent.futures.Executor, optional): A pool to generate keypairs across, as for generate_keypairs
+
+        Returns:
+            list of dict: Each user, as from new_user
+        """
+
+        names = [f"{prefix}{i}" for i in range(count)]
+        missing = [name for name in names if f"{name}@{domain_id}" not in self.keys]
+        if missing:
+            logging.info(f"GENERATING {len(missing)} KEYPAIRS")
+            for name, (private_key, public_key) in zip(missing, generate_keypairs(len(missing), executor=executor)):
+                self.keys[f"{name}@{domain_id}"] = {"private_key": private_key, "public_key": public_key}
+            self.save()
+        return [new_user(name, domain_id, **self.keys[f"{name}@{domain_id}"]) for name in names]
+
+
+def pack_transactions(commands, creator=iroha_admin, commands_per_transaction=ACCOUNTS_PER_TRANSACTION):
+    """Pack commands into as few unsigned transactions as possible
+
+    Args:
+        commands (list of Iroha.command): The commands to send
+        creator (Iroha, optional): Creates the transactions. Defaults to the admin
+        commands_per_transaction (int, optional): The most commands in one transaction
+
+    Returns:
+        list of Iroha.transaction: The unsigned transactions, commands in their original order
+    """
+
+    return [creator.transaction(commands[i:i + commands_per_transaction])
+            for i in range(0, len(commands), commands_per_transaction)]
+
+@trace
+def send_packed(transactions, connection=peers, transactions_per_batch=TRANSACTIONS_PER_BATCH):
+    """Send signed transactions in batches, a batch to each peer at once, and check every one is committed
+
+    Args:
+        transactions (list of Iroha.transaction): The signed transactions to send
+        connection (PeerRegistry, optional): The peers to spread batches over. Defaults to all peers
+        transactions_per_batch (int, optional): Transactions sent in one batch. Defaults to max_proposal_size
+
+    Returns:
+        list of TransactionResult: The outcome of each transaction
+
+    Throws:
+        RuntimeError: If any transaction was not committed
+    """
+
+    batches = [transactions[i:i + transactions_per_batch] for i in range(0, len(transactions), transactions_per_batch)]
+    connections = connection.connections()
+    if not batches:
+        return []
+    with ThreadPoolExecutor(max_workers=min(len(batches), len(connections))) as executor:
+        results = [result for batch_results in executor.map(
+            lambda item: send_batch(item[1], connections[item[0] % len(connections)]), enumerate(batches))
+            for result in batch_results]
+    failed = [result for result in results if result.status != "COMMITTED"]
+    if failed:
+        raise RuntimeError(f"{len(failed)} of {len(results)} transactions were not committed, "
+                           f"first {failed[0].hex_hash} with {tuple(failed[0])}")
+    return results
+
+@trace
+def provision_accounts(domain_id, count, keystore=None, connection=peers, prefix="user",
+                       accounts_per_transaction=ACCOUNTS_PER_TRANSACTION, executor=None):
+    """Create count accounts in an existing domain, reusing keypairs from a keystore where it holds them
+
+    Args:
+        domain_id (String): The domain to create the accounts in
+        count (int): The number of accounts to create
+        keystore (Keystore, optional): Where keypairs are read from and new ones saved. Defaults to a new one in memory
+        connection (PeerRegistry, optional): The peers to send the transactions to. Defaults to all peers
+        prefix (String, optional): Accounts are named {prefix}0 to {prefix}{count-1}. Defaults to user
+        accounts_per_transaction (int, optional): CreateAccount commands packed into one transaction
+        executor (concurrent.futures.Executor, optional): A pool to generate keypairs and sign across, e.g. from
+            signing_pool. Defaults to this process
+
+    Returns:
+        list of dict: The new users, as from new_user
+    """
+
+    users = (keystore if keystore is not None else Keystore()).users(domain_id, count, prefix, executor)
+    transactions = pack_transactions([
+        iroha_admin.command('CreateAccount', account_name=user["name"], domain_id=domain_id,
+                            public_key=user["public_key"]) for user in users
+    ], commands_per_transaction=accounts_per_transaction)
+    sign_transactions(transactions, ADMIN_PRIVATE_KEY, executor=executor)
+    logging.info(f"CREATING {count} ACCOUNTS IN {len(transactions)} TRANSACTIONS")
+    send_packed(transactions, connection)
+    return users
+
+# Command coalescing -----------------------------------------------------------
+# A consensus round commits at most max_proposal_size transactions, whatever their size, so sending one command per
+# transaction wastes most of each round. Commands submitted one at a time are instead packed into transactions
+# per creator, and the transactions into batches that fill one proposal, sent when full or after a short delay
+
+# Estimated bytes a transaction adds to a batch beyond its commands: creator, times, quorum, batch hashes and signature
+TRANSACTION_OVERHEAD_BYTES = 256
+MAX_BATCH_BYTES = 1 << 20
+
+
+class CommandCoalescer:
+    """Coalesce commands submitted one at a time into transactions, and transactions into batches
+    Commands of one creator are packed in submission order, up to commands_per_transaction to a transaction,
+    and transactions into a batch of up to max_proposal_size transactions and max_batch_bytes. A batch is
+    sent as soon as it is full, or once its oldest command has waited max_delay seconds
+
+    In an ORDERED batch each transaction is committed or rejected on its own, in an ATOMIC batch all or none are.
+    Either way the commands of one transaction commit together, so a failing command rejects those packed with it
+
+    Usage:
+        with CommandCoalescer(peers) as coalescer:
+            futures = [coalescer.submit(iroha_admin.command('CreateAccount', ...)) for ...]
+        statuses = [f.result() for f in futures]
+    """
+
+    def __init__(self, connection=peers, max_proposal_size=TRANSACTIONS_PER_BATCH, max_batch_bytes=MAX_BATCH_BYTES,
+                 commands_per_transaction=100, max_delay=0.5, atomic=False, max_in_flight=4):
+        """
+        Args:
+            connection (PeerRegistry or IrohaGrpc, optional): Where to send batches. Defaults to all peers
+            max_proposal_size (int, optional): The most transactions in a batch, as max_proposal_size of the peers.
+                Defaults to TRANSACTIONS_PER_BATCH
+            max_batch_bytes (int, optional): The most estimated bytes in a batch. Defaults to MAX_BATCH_BYTES
+            commands_per_transaction (int, optional): The most commands in a transaction. Defaults to 100
+            max_delay (float, optional): The longest a command waits for its batch to fill, in seconds. Defaults to 0.5
+            atomic (bool, optional): Send ATOMIC rather than ORDERED batches. Defaults to False
+            max_in_flight (int, optional): The most batches awaiting final statuses at once. Defaults to 4
+        """
+
+        self.connection = connection
+        self.max_proposal_size = max_proposal_size
+        self.max_batch_bytes = max_batch_bytes
+        self.commands_per_transaction = commands_per_transaction
+        self.max_delay = max_delay
+        self.atomic = atomic
+        # Transactions of the batch being filled, each [creator, private key, commands, futures]
+        self._transactions = []
+        # The open transaction of each creator, by creator account
+        self._open = {}
+        self._bytes = 0
+        self._oldest = None
+        self._created_time = 0
+        self._closed = False
+        self._condition = threading.Condition()
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix="CommandCoalescer")
+        self._thread = threading.Thread(target=self._run, name="CommandCoalescer", daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def submit(self, command, creator=iroha_admin, private_key=ADMIN_PRIVATE_KEY):
+        """Queue a command to be sent in the next batch
+
+        Args:
+            command (Iroha.command): The command
+            creator (Iroha, optional): Creates the transaction carrying the command. Defaults to the admin
+            private_key (String, optional): Signs that transaction. Defaults to the admin private key
+
+        Returns:
+            concurrent.futures.Future: Resolves to the final status of the transaction carrying the command,
+                or raises the error met sending it
+        """
+
+        future = Future()
+        size = command.ByteSize()
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("CommandCoalescer is closed")
+            transaction = self._open.get(creator.creator_account)
+            added = size + (TRANSACTION_OVERHEAD_BYTES if transaction is None else 0)
+            # Send the batch first if this command would take it over either limit
+            if self._transactions and (self._bytes + added > self.max_batch_bytes or
+                                       (transaction is None and len(self._transactions) >= self.max_proposal_size)):
+                self._flush()
+                transaction = None
+                added = size + TRANSACTION_OVERHEAD_BYTES
+            if transaction is None:
+                transaction = [creator, private_key, [], []]
+                self._transactions.append(transaction)
+                self._open[creator.creator_account] = transaction
+            transaction[2].append(command)
+            transaction[3].append(future)
+            self._bytes += added
+            if len(transaction[2]) >= self.commands_per_transaction:
+                # Full, so later commands of this creator start a new transaction
+                del self._open[creator.creator_account]
+            if len(self._transactions) >= self.max_proposal_size and not self._open:
+                # Every transaction is full and there is no room for another, so nothing more can join the batch
+                self._flush()
+            elif self._oldest is None:
+                self._oldest = time.monotonic()
+                self._condition.notify_all()
+        return future
+
+    def flush(self):
+        """Send the batch being filled now, without waiting for it to fill"""
+
+        with self._condition:
+            self._flush()
+
+    def _flush(self):
+        if not self._transactions:
+            return
+        transactions, self._transactions = self._transactions, []
+        self._open, self._bytes, self._oldest = {}, 0, None
+        self._executor.submit(self._send, transactions)
+
+    def _send(self, pending):
+        futures = [future for _, _, _, transaction_futures in pending for future in transaction_futures]
+        try:
+            # Transactions of identical commands must not share a creation time, or they would share a hash too
+            now = Iroha.now()
+            with self._condition:
+                created_time = self._created_time = max(now, self._created_time + 1)
+                self._created_time += len(pending) - 1
+            transactions = [creator.transaction(commands, created_time=created_time + i)
+                            for i, (creator, _, commands, _) in enumerate(pending)]
+            if len(transactions) > 1:
+                iroha.batch(transactions, atomic=self.atomic)
+            sign_transactions(transactions, [private_key for _, private_key, _, _ in pending], max_workers=1)
+            logging.debug(f"SENDING BATCH OF {len(transactions)} TRANSACTIONS, {len(futures)} COMMANDS")
+            results = send_batch(transactions, self.connection)
+        except Exception as e:
+            for future in futures:
+                future.set_exception(e)
+            return
+        for result, (_, _, _, transaction_futures) in zip(results, pending):
+            for future in transaction_futures:
+                future.set_result(result)
+
+    def _run(self):
+        with self._condition:
+            while not self._closed:
+                if self._oldest is None:
+                    self._condition.wait()
+                    continue
+                remaining = self._oldest + self.max_delay - time.monotonic()
+                if remaining > 0:
+                    self._condition.wait(remaining)
+                else:
+                    self._flush()
+
+    def close(self, wait=True):
+        """Send any commands still queued and stop, optionally waiting for their final statuses
+
+        Args:
+            wait (bool, optional): Wait for the final statuses of every batch sent. Defaults to True
+        """
+
+        with self._condition:
+            self._flush()
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join()
+        self._executor.shutdown(wait=wait)
+
+# Paginated queries ------------------------------------------------------------
+# Iroha answers account asset and transaction queries a page at a time. The iterators below follow the pages,
+# requesting the next page while the caller works through the current one, so reading a long history costs
+# little more than the slowest of the two, and at most two pages are held in memory however long it is
+
+def _iter_pages(fetch_page, prefetch=True):
+    """Yield the items of every page, where fetch_page(cursor) returns (items, cursor of the next page or None),
+    starting from the cursor None. With prefetch, the next page is fetched on a thread while items are yielded
+    """
+
+    if not prefetch:
+        cursor = None
+        while True:
+            items, cursor = fetch_page(cursor)
+            yield from items
+            if not cursor:
+                return
+    executor = ThreadPoolExecutor(max_workers=1)
+    future = executor.submit(fetch_page, None)
+    try:
+        while future is not None:
+            items, cursor = future.result()
+            future = executor.submit(fetch_page, cursor) if cursor else None
+            yield from items
+    finally:
+        # The caller may stop early, leaving a page in flight
+        if future is not None:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+def _send_page_query(query, connection, private_key):
+    IrohaCrypto.sign_query(query, private_key)
+    response = connection.send_query(query)
+    if response.HasField("error_response"):
+        kind = query.payload.WhichOneof("query")
+        account_id = getattr(query.payload, kind).account_id
+        raise RuntimeError(f"{kind} of {account_id} failed: {response.error_response.message}")
+    return response
+
+def iter_account_assets(account_id, connection, page_size=100, prefetch=True, creator=iroha_admin,
+                        private_key=ADMIN_PRIVATE_KEY):
+    """Iterate over the assets held by an account, a page of GetAccountAssets at a time
+
+    Args:
+        account_id (String): The account to query
+        connection (IrohaGrpc): The connection to query
+        page_size (int, optional): Assets fetched per query. Defaults to 100
+        prefetch (bool, optional): Fetch the next page while the current one is processed. Defaults to True
+        creator (Iroha, optional): Creates the queries. Defaults to the admin
+        private_key (String, optional): Signs the queries. Defaults to the admin private key
+
+    Yields:
+        AccountAsset: The asset_id, account_id and balance of each asset held, in order of asset id
+
+    Throws:
+        RuntimeError if a page cannot be queried
+    """
+
+    def fetch_page(first_asset_id):
+        # Iroha.query would build a TxPaginationMeta from page_size, so asset pagination is set by hand
+        query = creator.query("GetAccountAssets", account_id=account_id)
+        query.payload.get_account_assets.pagination_meta.page_size = page_size
+        if first_asset_id:
+            query.payload.get_account_assets.pagination_meta.first_asset_id = first_asset_id
+        page = _send_page_query(query, connection, private_key).account_assets_response
+        return page.account_assets, page.next_asset_id
+
+    return _iter_pages(fetch_page, prefetch)
+
+def _iter_transaction_pages(name, connection, page_size, prefetch, creator, private_key, **kwargs):
+    def fetch_page(first_tx_hash):
+        query = creator.query(name, page_size=page_size, first_tx_hash=first_tx_hash, **kwargs)
+        page = _send_page_query(query, connection, private_key).transactions_page_response
+        return page.transactions, page.next_tx_hash
+
+    return _iter_pages(fetch_page, prefetch)
+
+def iter_account_transactions(account_id, connection, page_size=100, prefetch=True, creator=iroha_admin,
+                              private_key=ADMIN_PRIVATE_KEY):
+    """Iterate over the transactions created by an account, a page of GetAccountTransactions at a time
+
+    Args:
+        account_id (String): The account to query
+        connection (IrohaGrpc): The connection to query
+        page_size (int, optional): Transactions fetched per query. Defaults to 100
+        prefetch (bool, optional): Fetch the next page while the current one is processed. Defaults to True
+        creator (Iroha, optional): Creates the queries. Defaults to the admin
+        private_key (String, optional): Signs the queries. Defaults to the admin private key
+
+    Yields:
+        Transaction: Each committed transaction of the account, oldest first
+
+    Throws:
+        RuntimeError if a page cannot be queried
+    """
+
+    return _iter_transaction_pages("GetAccountTransactions", connection, page_size, prefetch, creator, private_key,
+                                   account_id=account_id)
+
+def iter_account_asset_transactions(account_id, asset_id, connection, page_size=100, prefetch=True,
+                                    creator=iroha_admin, private_key=ADMIN_PRIVATE_KEY):
+    """Iterate over the transactions moving an asset in or out of an account, a page of
+    GetAccountAssetTransactions at a time
+
+    Args:
+        account_id (String): The account to query
+        asset_id (String): The asset, e.g. coin#test
+        connection (IrohaGrpc): The connection to query
+        page_size (int, optional): Transactions fetched per query. Defaults to 100
+        prefetch (bool, optional): Fetch the next page while the current one is processed. Defaults to True
+        creator (Iroha, optional): Creates the queries. Defaults to the admin
+        private_key (String, optional): Signs the queries. Defaults to the admin private key
+
+    Yields:
+        Transaction: Each committed transaction involving the account and asset, oldest first
+
+    Throws:
+        RuntimeError if a page cannot be queried
+    """
+
+    return _iter_transaction_pages("GetAccountAssetTransactions", connection, page_size, prefetch, creator,
+                                   private_key, account_id=account_id, asset_id=asset_id)
+
+# Balances ---------------------------------------------------------------------
+# Resetting balances between tests reads every balance at once and commits only the difference, in one
+# transaction, or nothing at all if the balances already match
+
+def get_account_assets(account_id, connection, page_size=None, creator=iroha_admin, private_key=ADMIN_PRIVATE_KEY):
+    """Get the assets held by an account
+
+    Args:
+        account_id (String): The account to query
+        connection (IrohaGrpc): The connection to query
+        page_size (int, optional): Assets fetched per query, following pages until all are read.
+            Defaults to all assets in one query
+        creator (Iroha, optional): Creates the queries. Defaults to the admin
+        private_key (String, optional): Signs the queries. Defaults to the admin private key
+
+    Returns:
+        list of AccountAsset: The asset_id, account_id and balance of each asset held
+    """
+
+    if page_size is not None:
+        return list(iter_account_assets(account_id, connection, page_size, False, creator, private_key))
+    query = creator.query("GetAccountAssets", account_id=account_id)
+    return list(_send_page_query(query, connection, private_key).account_assets_response.account_assets)
+
+@trace
+def get_balances(account_ids, asset_id, connection, max_workers=16):
+    """Get the balance of one asset for many accounts, querying them all at once
+
+    Args:
+        account_ids (list of String): The accounts to query
+        asset_id (String): The asset, e.g. coin#pytest
+        connection (IrohaGrpc): The connection to query
+        max_workers (int, optional): The most queries in flight. Defaults to 16
+
+    Returns:
+        dict of String to Decimal: The balance of each account, 0 if it holds none of the asset
+    """
+
+    def balance(account_id):
+        for asset in get_account_assets(account_id, connection):
+            if asset.asset_id == asset_id:
+                return decimal.Decimal(asset.balance)
+        return decimal.Decimal(0)
+
+    account_ids = list(account_ids)
+    if not account_ids:
+        return {}
+    with ThreadPoolExecutor(max_workers=min(len(account_ids), max_workers)) as executor:
+        return dict(zip(account_ids, executor.map(balance, account_ids)))
+
+def _amount(value):
+    """Format a positive Decimal as an Iroha amount, without trailing zeros"""
+
+    return f"{value.normalize():f}"
+
+def balance_reset_commands(balances, targets, asset_id, holder=ADMIN_ACCOUNT_ID, creator=iroha_admin):
+    """The commands moving balances to targets through a holder account
+    Surpluses are first transferred to the holder, which then adds any shortfall of the asset before
+    transferring to the accounts below their target. Accounts already at their target are left alone.
+    The holder needs permission to transfer the assets of accounts with a surplus
+
+    Args:
+        balances (dict of String to Decimal): The current balance of each account
+        targets (dict of String to Decimal): The balance each account should have
+        asset_id (String): The asset the balances are of
+        holder (String, optional): The account to move balances through. Defaults to the admin
+        creator (Iroha, optional): Creates the commands. Defaults to the admin
+
+    Returns:
+        list of Iroha.command: The commands, empty if every balance is already at its target
+    """
+
+    diffs = {account_id: decimal.Decimal(target) - balances.get(account_id, decimal.Decimal(0))
+             for account_id, target in targets.items()}
+    surplus = [(account_id, -diff) for account_id, diff in diffs.items() if diff < 0]
+    shortfall = [(account_id, diff) for account_id, diff in diffs.items() if diff > 0]
+    commands = [creator.command('TransferAsset', src_account_id=account_id, dest_account_id=holder,
+                                asset_id=asset_id, description="Reset balance", amount=_amount(amount))
+                for account_id, amount in surplus]
+    needed = sum((amount for _, amount in shortfall), decimal.Decimal(0)) - \
+        sum((amount for _, amount in surplus), decimal.Decimal(0))
+    if needed > 0:
+        commands.append(creator.command('AddAssetQuantity', asset_id=asset_id, amount=_amount(needed)))
+    commands.extend(creator.command('TransferAsset', src_account_id=holder, dest_account_id=account_id,
+                                    asset_id=asset_id, description="Reset balance", amount=_amount(amount))
+                    for account_id, amount in shortfall)
+    return commands
+
+@trace
+def reset_balances(targets, asset_id, connection, creator=iroha_admin, private_key=ADMIN_PRIVATE_KEY):
+    """Set the balance of an asset for many accounts, in one transaction through the creator's account
+    Nothing is sent if every balance is already at its target
+
+    Args:
+        targets (dict of String to Decimal or String): The balance each account should have
+        asset_id (String): The asset, e.g. coin#pytest
+        connection (IrohaGrpc): The connection to query and send the transaction across
+        creator (Iroha, optional): The account the balances move through, creating the transaction. Defaults to the admin
+        private_key (String, optional): The private key of the creator. Defaults to the admin private key
+
+    Returns:
+        Iroha Transaction Status: The final status of the reset transaction, or None if none was needed
+    """
+
+    balances = get_balances(targets, asset_id, connection)
+    commands = balance_reset_commands(balances, targets, asset_id, creator.creator_account, creator)
+    if not commands:
+        logging.debug("BALANCES ALREADY AT TARGETS")
+        return None
+    return send_transaction(IrohaCrypto.sign_transaction(creator.transaction(commands), private_key), connection)
 
 @trace
 def get_block(block_number, connection):
@@ -128,49 +969,444 @@ def get_block(block_number, connection):
 
     return block
 
+def _is_block(response):
+    """True if a GetBlock query response holds a block rather than an error"""
+    return response.HasField("block_response")
+
+@trace
+def get_chain_height(connection):
+    """Find the height of the chain on a node, using exponential probing followed by a binary search
+    Only O(log(height)) GetBlock queries are needed, rather than one per block
+
+    Args:
+        connection (IrohaGrpc): The connection to a node to probe
+
+    Returns:
+        int: The height of the highest block on the node, 0 if the node has no blocks
+    """
+
+    # Exponential probing: find a height that exists (low) and one that does not (high)
+    low, high = 0, 1
+    while _is_block(get_block(high, connection)):
+        low, high = high, high * 2
+    # Binary search between them for the last height that exists
+    while high - low > 1:
+        middle = (low + high) // 2
+        if _is_block(get_block(middle, connection)):
+            low = middle
+        else:
+            high = middle
+    logging.debug(f"CHAIN HEIGHT IS {low}")
+    return low
+
+def _get_block_range(first_height, last_height, connection):
+    blocks = []
+    for height in range(first_height, last_height + 1):
+        block = get_block(height, connection)
+        if not _is_block(block):
+            raise RuntimeError(f"Block {height} missing from {connection._address}: {block.error_response.message}")
+        blocks.append(block)
+    return blocks
+
+def iter_blocks(first_height, last_height, connections, max_workers=8, chunk_size=32):
+    """Lazily get a range of blocks in order, fetching ahead in parallel across one or more nodes
+    The range is split into chunks of consecutive heights, and the chunks are handed to the nodes round robin.
+    At most max_workers chunks are held at once, so memory use does not grow with the length of the range
+
+    Args:
+        first_height (int): The height of the first block to get, at least 1
+        last_height (int): The height of the last block to get, inclusive
+        connections (list of IrohaGrpc): The connections to nodes to get blocks from
+        max_workers (int, optional): The number of chunks fetched at once. Defaults to 8
+        chunk_size (int, optional): The number of blocks fetched by a worker at a time. Defaults to 32
+
+    Yields:
+        JSON: The blocks from first_height to last_height, in order of height
+
+    Throws:
+        RuntimeError if a block in the range cannot be got from the node it was requested from
+    """
+
+    peers = itertools.cycle(connections)
+    pending = deque()
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        for start in range(first_height, last_height + 1, chunk_size):
+            end = min(start + chunk_size - 1, last_height)
+            pending.append(executor.submit(_get_block_range, start, end, next(peers)))
+            if len(pending) >= max_workers:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
+
 @trace
-def get_all_blocks(connection):
+def get_blocks(first_height, last_height, connections, max_workers=8, chunk_size=32):
+    """Get a range of blocks in parallel, with a pool of workers spread across one or more nodes
+    See iter_blocks to process blocks as they arrive rather than holding the whole range
+
+    Args:
+        first_height (int): The height of the first block to get, at least 1
+        last_height (int): The height of the last block to get, inclusive
+        connections (list of IrohaGrpc): The connections to nodes to get blocks from
+        max_workers (int, optional): The number of chunks fetched at once. Defaults to 8
+        chunk_size (int, optional): The number of blocks fetched by a worker at a time. Defaults to 32
+
+    Returns:
+        list of JSON strings: The blocks from first_height to last_height, in order of height
+
+    Throws:
+        RuntimeError if a block in the range cannot be got from the node it was requested from
+    """
+
+    return list(iter_blocks(first_height, last_height, connections, max_workers, chunk_size))
+
+@trace
+def get_all_blocks(connection, connections=None, max_workers=8):
     """Get all blocks from a connection
+    The chain height is found first, then the blocks are downloaded in parallel ranges
 
     Args:
         connection (IrohaGrpc): The connection to a node to get blocks from
+        connections (list of IrohaGrpc, optional): Nodes to spread the download over,
+            e.g. all four peers. Defaults to only the node of connection
+        max_workers (int, optional): The number of ranges fetched at once. Defaults to 8
 
     Returns:
         list of JSON strings: A list of every block in JSON format from a node 
     """
 
-    current_height = 1
-    current_block = get_block(current_height, connection)
-    block_json = []
-
-    while (current_block := get_block(current_height, connection)).error_response.error_code == 0:
-        logging.debug(f"SUCCESSFULLY GOT BLOCK {current_height}")
-        block_json.append(current_block)
-        current_height += 1
-        logging.debug(f"GETTING BLOCK {current_height}")
+    height = get_chain_height(connection)
+    block_json = get_blocks(1, height, connections or [connection], max_workers=max_workers)
     logging.debug(f"END OF CHAIN REACHED")
     return block_json
 
+class ChainMismatchError(RuntimeError):
+    """Raised when blocks from a node do not link onto the chain previously synced from it"""
+
+
+def block_hash(block):
+    """Get the hash of a block, as referenced by prev_block_hash of the block after it
+
+    Args:
+        block (JSON): A block, as returned by get_block
+
+    Returns:
+        String: The hex encoded hash of the block payload
+    """
+
+    return binascii.hexlify(IrohaCrypto.hash(block.block_response.block.block_v1)).decode()
+
+def _check_block_link(block, prev_hash):
+    """Check a block links to the block with hash prev_hash, if given. Returns the hash of the block"""
+
+    payload = block.block_response.block.block_v1.payload
+    if prev_hash is not None and payload.prev_block_hash != prev_hash:
+        raise ChainMismatchError(
+            f"Block {payload.height} has prev_block_hash {payload.prev_block_hash}, expected {prev_hash}")
+    return block_hash(block)
+
+def _format_block(block, block_format):
+    if block_format == "json":
+        return json_format.MessageToJson(block.block_response.block, indent=None) + "\n"
+    return str(block) + "\n\n"
+
+def _read_sync_state(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def _write_sync_state(path, height, hash, block_format):
+    with open(path, "w") as f:
+        json.dump({"height": height, "hash": hash, "format": block_format}, f)
+
 @trace
-def log_all_blocks(connection, log_name, logs_directory="logs"):
-    """Get all blocks from a node and write them to a log file in JSON format
+def log_all_blocks(connection, log_name, logs_directory="logs", incremental=False, block_format="json"):
+    """Get all blocks from a node and write them to a log file, each block written as soon as it arrives
+    In incremental mode the height, hash and format of the last block written is kept next to the log,
+    in {log_name}.sync, so that only blocks committed since the last call are fetched and appended
 
     Args:
         connection (IrohaGrpc): The connection to a node to get blocks from
         log_name (String): Name of file to write logs to
         logs_directory (String, optional): Name of directory (child of current directory) to place logs into
             Created if not currently created. Defaults to logs
+        incremental (bool, optional): Append only new blocks to an existing log rather than rewriting it.
+            Falls back to writing the whole chain if there is no log or sync state yet. Defaults to False
+        block_format (String, optional): "json" for one compact JSON block per line,
+            or "text" for the larger protobuf text format. Defaults to json
+
+    Throws:
+        ChainMismatchError if the node no longer holds the synced chain, e.g. it is shorter,
+            the last synced block has a different hash, or a new block does not link to it
+        ValueError if appending to a log written in another block_format
     """
 
     path = Path(logs_directory + "/" + log_name)
     if not os.path.exists(os.path.dirname(path)):
         os.makedirs(os.path.dirname(path))
+    sync_path = path.with_name(path.name + ".sync")
 
-    block_json = get_all_blocks(connection)
+    state = _read_sync_state(sync_path) if incremental and path.exists() else None
+    if state is not None and state.get("format", "text") != block_format:
+        raise ValueError(f"{path} is a {state.get('format', 'text')} log, cannot append {block_format} blocks to it")
+    if not incremental and sync_path.exists():
+        # The log is rewritten without sync state, so state of an earlier incremental run no longer describes it
+        sync_path.unlink()
+    height = get_chain_height(connection)
+    if state is None:
+        synced_height, synced_hash = 0, None
+        mode = "w"
+    else:
+        synced_height, synced_hash = state["height"], state["hash"]
+        if height < synced_height:
+            raise ChainMismatchError(f"Node height {height} is below the synced height {synced_height}")
+        if synced_height and block_hash(get_block(synced_height, connection)) != synced_hash:
+            raise ChainMismatchError(f"Block {synced_height} no longer has the synced hash {synced_hash}")
+        logging.debug(f"SYNCING BLOCKS {synced_height + 1} TO {height}")
+        mode = "a"
 
-    with open(path, "w") as f:
-        for block in block_json:
-            f.write(str(block)+"\n\n")
+    # Record how far we got even if the stream fails part way, so the log and sync state stay in step
+    try:
+        with open(path, mode) as f:
+            for block in iter_blocks(synced_height + 1, height, [connection]):
+                synced_hash = _check_block_link(block, synced_hash)
+                f.write(_format_block(block, block_format))
+                synced_height += 1
+    finally:
+        if incremental:
+            _write_sync_state(sync_path, synced_height, synced_hash, block_format)
+
+
+class ConsistencyReport(namedtuple("ConsistencyReport",
+        ["heights", "common_height", "first_divergent_height", "hashes"])):
+    """The result of comparing the chains of several nodes
+
+    Attributes:
+        heights (dict of String to int): The chain height of each node
+        common_height (int): The height all nodes have reached
+        first_divergent_height (int): The lowest height at which the nodes hold different blocks, None if they agree
+        hashes (dict of String to list of String): At first_divergent_height, the nodes holding each block hash.
+            Empty if the nodes agree
+    """
+
+    __slots__ = ()
+
+    @property
+    def consistent(self):
+        return self.first_divergent_height is None
+
+
+def _block_hashes(height, connections, names, executor):
+    blocks = executor.map(lambda connection: get_block(height, connection), connections)
+    return {name: block_hash(block) for name, block in zip(names, blocks)}
+
+@trace
+def check_chain_consistency(connections, names=None):
+    """Check that several nodes hold the same chain, finding the first height at which they diverge
+    Since each block payload includes the hash of the block before it, nodes that agree on the hash
+    of a block agree on every block below it. So only the blocks at the common height are compared,
+    and on disagreement the first diverging height is found by bisection, fetching O(log(height))
+    blocks per node rather than the whole chain. Nodes are queried in parallel.
+    Block signatures are not part of the hash, so nodes may agree even though their logs differ in signatures
+
+    Args:
+        connections (list of IrohaGrpc): The connections to the nodes to compare
+        names (list of String, optional): A name for each node in the report. Defaults to node1, node2, ...
+
+    Returns:
+        ConsistencyReport: The heights of the nodes, and where and between which nodes they disagree
+    """
+
+    names = names or [f"node{i+1}" for i in range(len(connections))]
+    with ThreadPoolExecutor(max_workers=len(connections)) as executor:
+        heights = dict(zip(names, executor.map(get_chain_height, connections)))
+        common_height = min(heights.values())
+        logging.debug(f"NODE HEIGHTS {heights}, COMMON HEIGHT {common_height}")
+
+        hashes = _block_hashes(common_height, connections, names, executor) if common_height else {}
+        if len(set(hashes.values())) <= 1:
+            return ConsistencyReport(heights, common_height, None, {})
+
+        # Nodes agree at low (height 0 being the empty chain) and disagree at high
+        low, high = 0, common_height
+        while high - low > 1:
+            middle = (low + high) // 2
+            middle_hashes = _block_hashes(middle, connections, names, executor)
+            if len(set(middle_hashes.values())) == 1:
+                low = middle
+            else:
+                high, hashes = middle, middle_hashes
+
+    groups = {}
+    for name, hash in hashes.items():
+        groups.setdefault(hash, []).append(name)
+    logging.debug(f"NODES DIVERGE AT HEIGHT {high}: {groups}")
+    return ConsistencyReport(heights, common_height, high, groups)
+
+# Block subscription -----------------------------------------------------------
+# Rather than polling GetBlock for the next height, a subscriber holds a FetchCommits stream open and is pushed
+# each block as it commits. The stream only carries blocks committed while it is open, so on every (re)subscription
+# the blocks committed since the last one delivered are fetched with GetBlock first, as is any gap in the stream
+
+class _HandlerFailed(Exception):
+    """Raised inside a BlockSubscriber to unwind its thread when a handler fails"""
+
+
+class BlockSubscriber:
+    """Deliver committed blocks to handlers as they commit, in order of height, each block exactly once
+    If the stream fails, the subscriber resubscribes (to another peer, given a PeerRegistry) after a backoff,
+    and catches up on the blocks it missed before delivering new ones.
+    If a handler raises, the subscriber stops at the block before, keeps the exception in error,
+    and wait_for raises it
+
+    Usage:
+        with BlockSubscriber(peers, [lambda block: print(block.block_response.block.block_v1.payload.height)]):
+            ...
+    """
+
+    # Seconds to wait before resubscribing after the stream fails, and at most
+    RESUBSCRIBE_DELAY = 1.0
+    MAX_RESUBSCRIBE_DELAY = 30.0
+
+    def __init__(self, connection, handlers=(), from_height=None, creator=iroha_admin, private_key=ADMIN_PRIVATE_KEY):
+        """
+        Args:
+            connection (PeerConnection or PeerRegistry): The peer, or peers, to stream blocks from
+            handlers (list of callable, optional): Called with each block response, as from get_block. Defaults to none
+            from_height (int, optional): The first block to deliver, e.g. 1 for the whole chain.
+                Defaults to the first block committed after subscribing
+            creator (Iroha, optional): Creates the blocks query. Defaults to the admin
+            private_key (String, optional): Signs the blocks query. Defaults to the admin private key
+        """
+
+        self.connection = connection
+        self.handlers = list(handlers)
+        self.creator = creator
+        self.private_key = private_key
+        # The height of the last block delivered, None until the first subscription when following only new blocks
+        self.height = None if from_height is None else from_height - 1
+        # True while subscribed and caught up, so every block committed is being delivered
+        self.live = False
+        # The exception a handler raised, which stopped the subscriber
+        self.error = None
+        self._condition = threading.Condition()
+        self._stop = threading.Event()
+        # Guards opening the stream against stop, so a stream opened as the subscriber stops is still cancelled
+        self._stream_lock = threading.Lock()
+        self._stream = None
+        self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def add_handler(self, handler):
+        self.handlers.append(handler)
+
+    def start(self):
+        self.error = None
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="BlockSubscriber", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        with self._stream_lock:
+            self._stop.set()
+            if self._stream is not None:
+                self._stream.cancel()
+        if self._thread is not None:
+            self._thread.join()
+        self.live = False
+
+    def wait_for(self, height, timeout=None):
+        """Wait until the block at height has been delivered
+
+        Returns:
+            bool: False if the timeout passed first
+
+        Throws:
+            Exception: The exception a handler raised, if the subscriber stopped before height
+        """
+
+        with self._condition:
+            delivered = self._condition.wait_for(
+                lambda: self.error is not None or (self.height is not None and self.height >= height), timeout)
+            if self.error is not None and (self.height is None or self.height < height):
+                raise self.error
+            return delivered
+
+    def _deliver(self, block):
+        height = block.block_response.block.block_v1.payload.height
+        for handler in list(self.handlers):
+            try:
+                handler(block)
+            except Exception as e:
+                logging.exception(f"BLOCK HANDLER {handler} FAILED ON BLOCK {height}, STOPPING")
+                with self._condition:
+                    self.error = e
+                    self._condition.notify_all()
+                raise _HandlerFailed() from e
+        with self._condition:
+            self.height = height
+            self._condition.notify_all()
+
+    def _catch_up(self, height, connection):
+        """Deliver the blocks after the last one delivered up to height, with GetBlock queries"""
+
+        if self.height < height:
+            logging.debug(f"BACKFILLING BLOCKS {self.height + 1} TO {height} FROM {connection.name}")
+            for block in iter_blocks(self.height + 1, height, [connection]):
+                self._deliver(block)
+
+    def _run(self):
+        delay = self.RESUBSCRIBE_DELAY
+        while not self._stop.is_set():
+            connection = self.connection.select() if hasattr(self.connection, "select") else self.connection
+            query = self.creator.blocks_query()
+            IrohaCrypto.sign_query(query, self.private_key)
+            try:
+                # Subscribe before reading the height, so no block falls between the two
+                with self._stream_lock:
+                    if self._stop.is_set():
+                        return
+                    self._stream = connection.fetch_commits(query)
+                height = get_chain_height(connection)
+                if self.height is None:
+                    with self._condition:
+                        self.height = height
+                        self._condition.notify_all()
+                self._catch_up(height, connection)
+                self.live = True
+                delay = self.RESUBSCRIBE_DELAY
+                logging.debug(f"FOLLOWING BLOCKS FROM {self.height} ON {connection.name}")
+                for response in self._stream:
+                    block_height = response.block_response.block.block_v1.payload.height
+                    if block_height <= self.height:
+                        continue
+                    self._catch_up(block_height - 1, connection)
+                    self._deliver(response)
+            except _HandlerFailed:
+                with self._stream_lock:
+                    self._stop.set()
+                    self._stream.cancel()
+                self.live = False
+                return
+            except (grpc.RpcError, RuntimeError) as e:
+                if self._stop.is_set():
+                    return
+                logging.warning(f"BLOCK STREAM FROM {connection.name} FAILED ({e}), RESUBSCRIBING IN {delay}s")
+            self.live = False
+            self._stop.wait(delay)
+            delay = min(delay * 2, self.MAX_RESUBSCRIBE_DELAY)
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.DEBUG)
\ No newline at end of file
@@ -0,0 +1,152 @@
+"""
+An asyncio API to the peers, so one event loop can keep thousands of transactions and queries in flight
+
+Usage:
+    from async_iroha import async_connections, async_send_transaction
+    async def main():
+        connections = async_connections()
+        status = await async_send_transaction(tx, connections[0])
+"""
+from profiling import trace
+from IrohaUtils import ADMIN_PRIVATE_KEY, iroha, peers, _log_transaction
+import asyncio
+import binascii
+import grpc
+from iroha import IrohaCrypto, IrohaGrpc
+from iroha import endpoint_pb2, endpoint_pb2_grpc
+
+# Asyncio API -----------------------------------------------------------------
+
+class AsyncIrohaGrpc:
+    """gRPC transport to Iroha on an asyncio (grpc.aio) channel, mirroring IrohaGrpc
+    A single channel multiplexes every outstanding call to a peer, so one event loop
+    can keep thousands of transactions and queries in flight across all peers.
+    Must be created inside the event loop it is used from
+    """
+
+    def __init__(self, address=None, timeout=None):
+        """
+        Args:
+            address (String, optional): Iroha Torii address with port. Defaults to 127.0.0.1:50051
+            timeout (float, optional): Timeout for network I/O operations in seconds. Defaults to None
+        """
+
+        self._address = address if address else '127.0.0.1:50051'
+        self._timeout = timeout
+        self._channel = grpc.aio.insecure_channel(self._address)
+        self._command_service_stub = endpoint_pb2_grpc.CommandService_v1Stub(self._channel)
+        self._query_service_stub = endpoint_pb2_grpc.QueryService_v1Stub(self._channel)
+
+    async def send_tx(self, transaction, timeout=None):
+        await self._command_service_stub.Torii(transaction, timeout=timeout or self._timeout)
+
+    async def send_txs(self, transactions, timeout=None):
+        tx_list = endpoint_pb2.TxList()
+        tx_list.transactions.extend(transactions)
+        await self._command_service_stub.ListTorii(tx_list, timeout=timeout or self._timeout)
+
+    async def send_query(self, query, timeout=None):
+        return await self._query_service_stub.Find(query, timeout=timeout or self._timeout)
+
+    async def send_blocks_stream_query(self, query, timeout=None):
+        async for block in self._query_service_stub.FetchCommits(query, timeout=timeout or self._timeout):
+            yield block
+
+    async def tx_status(self, transaction, timeout=None):
+        request = endpoint_pb2.TxStatusRequest()
+        request.tx_hash = binascii.hexlify(IrohaCrypto.hash(transaction))
+        response = await self._command_service_stub.Status(request, timeout=timeout or self._timeout)
+        return IrohaGrpc._parse_tx_status(response)
+
+    async def tx_status_stream(self, transaction, timeout=None):
+        """Asynchronously iterate the status stream of a transaction, as IrohaGrpc.tx_status_stream
+
+        Args:
+            transaction (Iroha.transaction): The transaction whose statuses to stream
+            timeout (float, optional): Timeout for the whole stream in seconds
+
+        Yields:
+            tuple: Symbolic status, integral status code, and error code (0 if no error occurred)
+        """
+
+        request = endpoint_pb2.TxStatusRequest()
+        request.tx_hash = binascii.hexlify(IrohaCrypto.hash(transaction))
+        async for status in self._command_service_stub.StatusStream(request, timeout=timeout or self._timeout):
+            yield IrohaGrpc._parse_tx_status(status)
+
+    async def close(self):
+        await self._channel.close()
+
+
+def async_connections(timeout=10):
+    """Create an AsyncIrohaGrpc for each peer of the registry. Must be called from within the running event loop
+
+    Args:
+        timeout (float, optional): Timeout for network I/O operations in seconds. Defaults to 10
+
+    Returns:
+        list of AsyncIrohaGrpc: Connections to each peer, in order
+    """
+
+    return [AsyncIrohaGrpc(connection.address, timeout=timeout) for connection in peers.connections()]
+
+@trace
+async def async_send_transaction(transaction, connection, verbose=False):
+    """Asynchronously send a transaction to a peer and return the final status
+    Only the calling coroutine waits for the final status, the event loop is free to run others
+
+    Args:
+        transaction (Iroha.transaction): The signed transaction to send to a peer
+        connection (AsyncIrohaGrpc): The asyncio Grpc connection to send the transaction across
+        verbose (bool): A boolean to print the status stream to stdout
+
+    Returns:
+        Iroha Transaction Status: The final transaction status received
+    """
+
+    _log_transaction(transaction)
+    await connection.send_tx(transaction)
+    return await _async_final_status(transaction, connection, verbose)
+
+async def _async_final_status(transaction, connection, verbose=False):
+    last_status = None
+    async for status in connection.tx_status_stream(transaction):
+        if verbose: print(status)
+        last_status = status
+    return last_status
+
+@trace
+async def async_send_batch(transactions, connection, verbose=False):
+    """Asynchronously send a batch of transactions across a connection, all at once
+    The status streams of all transactions are followed concurrently
+
+    Args:
+        transactions (list of Iroha.transaction): The signed transactions to send to a peer
+        connection (AsyncIrohaGrpc): The asyncio Grpc connection to send the transactions across
+        verbose (bool): A boolean to print the status stream to stdout
+
+    Returns:
+        Iroha Transaction Statuses: List of the final transaction status received, for each transaction in batch
+    """
+
+    if not transactions:
+        return []
+    await connection.send_txs(transactions)
+    return list(await asyncio.gather(
+        *(_async_final_status(tx, connection, verbose) for tx in transactions)))
+
+@trace
+async def async_get_block(block_number, connection):
+    """Asynchronously get the block at height block_number from the node specified by connection
+
+    Args:
+        block_number (int): The block number to get. Must be >0 and less than the maximum height
+        connection (AsyncIrohaGrpc): The asyncio connection to a node to get blocks from
+
+    Returns:
+        JSON: the JSON description of the block requested
+    """
+
+    query = iroha.query("GetBlock", height=block_number)
+    IrohaCrypto.sign_query(query, ADMIN_PRIVATE_KEY)
+    return await connection.send_query(query)
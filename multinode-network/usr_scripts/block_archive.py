@@ -0,0 +1,377 @@
+"""
+A binary archive of the blocks of a node, with an index for random access by height
+
+Usage:
+    from block_archive import BlockArchiveReader, archive_all_blocks
+    archive_all_blocks(net_1, "node1.blocks")
+    with BlockArchiveReader("logs/node1.blocks") as archive:
+        block = archive.get_block(10)
+"""
+from profiling import trace
+from IrohaUtils import get_chain_height, iter_blocks, _check_block_link
+import os
+import binascii
+import logging
+import mmap
+import struct
+import zlib
+from pathlib import Path
+from iroha import IrohaCrypto
+from iroha import block_pb2
+
+# Block archive ---------------------------------------------------------------
+# An archive is a pair of files. The data file is a series of segments, each a header
+# (compression flag, payload length) followed by the payload, which (once decompressed)
+# is a series of length prefixed serialized Block protobufs.
+# The index file is a header (magic, version, first height) followed by one fixed size
+# record per height: (segment offset, segment length, offset in payload, block length).
+# Reading block N is then a seek in the index and a slice of one segment.
+# The index can always be rebuilt from the data file, so a writer or archive_all_blocks rebuilds
+# an index that is missing or out of step with the data, e.g. after a crash between the two writes
+
+_ARCHIVE_MAGIC = b"IRBA"
+_ARCHIVE_VERSION = 1
+_INDEX_HEADER = struct.Struct("<4sHQ")
+_INDEX_RECORD = struct.Struct("<QIII")
+_SEGMENT_HEADER = struct.Struct("<BI")
+_BLOCK_LENGTH = struct.Struct("<I")
+
+
+def _unwrap_block(block):
+    """Accept either a GetBlock response or a Block protobuf, returning the Block"""
+    return block.block_response.block if hasattr(block, "block_response") else block
+
+
+def _rebuild_index(path):
+    """Write the index of an archive again from its data file, dropping a segment cut short at its end
+
+    Args:
+        path (Path): Path of the archive data file
+
+    Throws:
+        ValueError if the blocks of the data file are not in order of height
+    """
+
+    index_path = Path(f"{path}.index")
+    records = []
+    first_height = next_height = None
+    with open(path, "r+b") as data:
+        size = os.fstat(data.fileno()).st_size
+        offset = 0
+        while offset + _SEGMENT_HEADER.size <= size:
+            compressed, length = _SEGMENT_HEADER.unpack(data.read(_SEGMENT_HEADER.size))
+            payload = data.read(length)
+            if len(payload) < length:
+                break
+            if compressed:
+                payload = zlib.decompress(payload)
+            position = 0
+            while position < len(payload):
+                block_length, = _BLOCK_LENGTH.unpack_from(payload, position)
+                position += _BLOCK_LENGTH.size
+                height = block_pb2.Block.FromString(payload[position:position + block_length]).block_v1.payload.height
+                if next_height is None:
+                    first_height = next_height = height
+                if height != next_height:
+                    raise ValueError(f"Expected block {next_height} in {path}, found block {height}")
+                records.append(_INDEX_RECORD.pack(offset, length, position, block_length))
+                position += block_length
+                next_height += 1
+            offset += _SEGMENT_HEADER.size + length
+        if offset < size:
+            logging.warning(f"DROPPING {size - offset} BYTES OF A PARTLY WRITTEN SEGMENT AT THE END OF {path}")
+            data.truncate(offset)
+    logging.info(f"REBUILDING INDEX OF {path} WITH {len(records)} BLOCKS")
+    with open(f"{index_path}.tmp", "wb") as index:
+        if records:
+            index.write(_INDEX_HEADER.pack(_ARCHIVE_MAGIC, _ARCHIVE_VERSION, first_height))
+            index.write(b"".join(records))
+    os.replace(f"{index_path}.tmp", index_path)
+
+def _is_last_block(path, data_size, offset, length, position, block_length):
+    """Whether an index record points at the last block of the data file"""
+
+    if offset + _SEGMENT_HEADER.size + length != data_size:
+        return False
+    with open(path, "rb") as data:
+        data.seek(offset)
+        compressed, _ = _SEGMENT_HEADER.unpack(data.read(_SEGMENT_HEADER.size))
+        payload_length = len(zlib.decompress(data.read(length))) if compressed else length
+    return position + block_length == payload_length
+
+def _check_index(path):
+    """Rebuild the index of an archive if it is missing or out of step with the data file
+
+    Args:
+        path (Path): Path of the archive data file
+
+    Throws:
+        ValueError if the index is not a block archive index
+    """
+
+    index_path = Path(f"{path}.index")
+    data_size = path.stat().st_size if path.exists() else 0
+    index_size = index_path.stat().st_size if index_path.exists() else 0
+    if index_size < _INDEX_HEADER.size:
+        if data_size:
+            _rebuild_index(path)
+        return
+    with open(index_path, "rb") as f:
+        magic, version, _ = _INDEX_HEADER.unpack(f.read(_INDEX_HEADER.size))
+        if magic != _ARCHIVE_MAGIC or version != _ARCHIVE_VERSION:
+            raise ValueError(f"{index_path} is not a version {_ARCHIVE_VERSION} block archive index")
+        count, partial = divmod(index_size - _INDEX_HEADER.size, _INDEX_RECORD.size)
+        last = None
+        if count:
+            f.seek(_INDEX_HEADER.size + (count - 1) * _INDEX_RECORD.size)
+            last = _INDEX_RECORD.unpack(f.read(_INDEX_RECORD.size))
+    # The last record should be the last block of the last segment, with no record written in part
+    in_step = not partial and (data_size == 0 if last is None else _is_last_block(path, data_size, *last))
+    if not in_step:
+        _rebuild_index(path)
+
+
+class BlockArchiveWriter:
+    """Append blocks to a binary block archive and its index
+    Blocks must be appended in order of height. An existing archive is appended to,
+    after rebuilding its index if it is missing or out of step with the data
+    """
+
+    def __init__(self, path, compress=False, segment_size=64):
+        """
+        Args:
+            path (String): Path of the archive data file. The index is written to {path}.index
+            compress (bool, optional): Compress each segment with zlib. Defaults to False
+            segment_size (int, optional): The number of blocks per segment. Defaults to 64
+
+        Throws:
+            ValueError if an existing index is not a block archive index
+        """
+
+        self.path = Path(path)
+        self.index_path = Path(f"{path}.index")
+        self.compress = compress
+        self.segment_size = segment_size
+        self._segment = []
+        _check_index(self.path)
+        if self.index_path.exists() and self.index_path.stat().st_size >= _INDEX_HEADER.size:
+            with open(self.index_path, "rb") as f:
+                _, _, self.first_height = _INDEX_HEADER.unpack(f.read(_INDEX_HEADER.size))
+            count = (self.index_path.stat().st_size - _INDEX_HEADER.size) // _INDEX_RECORD.size
+            self.next_height = self.first_height + count
+        else:
+            self.first_height = None
+            self.next_height = None
+        self._data = open(self.path, "ab")
+        self._index = open(self.index_path, "ab")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def append(self, block):
+        """Append the next block to the archive
+
+        Args:
+            block (JSON or Block): The block, as returned by get_block, or the Block protobuf itself
+
+        Throws:
+            ValueError if the block is not the next height of the archive
+        """
+
+        block = _unwrap_block(block)
+        height = block.block_v1.payload.height
+        if self.next_height is None:
+            self.first_height = self.next_height = height
+            self._index.write(_INDEX_HEADER.pack(_ARCHIVE_MAGIC, _ARCHIVE_VERSION, height))
+        if height != self.next_height:
+            raise ValueError(f"Expected block {self.next_height} for {self.path}, got block {height}")
+        self._segment.append(block.SerializeToString())
+        self.next_height += 1
+        if len(self._segment) >= self.segment_size:
+            self.flush()
+
+    def flush(self):
+        """Write out the current segment, even if it is not full"""
+
+        if not self._segment:
+            return
+        payload = bytearray()
+        positions = []
+        for data in self._segment:
+            positions.append((len(payload) + _BLOCK_LENGTH.size, len(data)))
+            payload += _BLOCK_LENGTH.pack(len(data)) + data
+        if self.compress:
+            payload = zlib.compress(bytes(payload))
+        offset = self._data.tell()
+        self._data.write(_SEGMENT_HEADER.pack(int(self.compress), len(payload)))
+        self._data.write(payload)
+        for position, length in positions:
+            self._index.write(_INDEX_RECORD.pack(offset, len(payload), position, length))
+        # Data before index, so an index record never points past the end of the data
+        self._data.flush()
+        self._index.flush()
+        self._segment = []
+
+    def close(self):
+        self.flush()
+        self._data.close()
+        self._index.close()
+
+
+class BlockArchiveReader:
+    """Random access to the blocks of a binary block archive, through memory maps of the data and index files
+
+    Usage:
+        with BlockArchiveReader("logs/node1.blocks") as archive:
+            block = archive.get_block(10)
+            for block in archive.iter_blocks(20, 30): ...
+    """
+
+    def __init__(self, path):
+        """
+        Args:
+            path (String): Path of the archive data file. The index is read from {path}.index
+
+        Throws:
+            ValueError if the index is not a block archive index
+        """
+
+        self.path = Path(path)
+        self._data_file = open(self.path, "rb")
+        self._index_file = open(f"{path}.index", "rb")
+        self._data = self._map(self._data_file)
+        self._index = self._map(self._index_file)
+        self._segment_cache = (None, None)
+        if len(self._index) < _INDEX_HEADER.size:
+            self.first_height, self.last_height = 1, 0
+            return
+        magic, version, self.first_height = _INDEX_HEADER.unpack_from(self._index)
+        if magic != _ARCHIVE_MAGIC or version != _ARCHIVE_VERSION:
+            raise ValueError(f"{path}.index is not a version {_ARCHIVE_VERSION} block archive index")
+        count = (len(self._index) - _INDEX_HEADER.size) // _INDEX_RECORD.size
+        self.last_height = self.first_height + count - 1
+
+    @staticmethod
+    def _map(f):
+        # mmap cannot map an empty file
+        if os.fstat(f.fileno()).st_size == 0:
+            return b""
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self.last_height - self.first_height + 1
+
+    def _segment_payload(self, offset, length):
+        if self._segment_cache[0] == offset:
+            return self._segment_cache[1]
+        start = offset + _SEGMENT_HEADER.size
+        payload = zlib.decompress(self._data[start:start + length])
+        self._segment_cache = (offset, payload)
+        return payload
+
+    def get_block_bytes(self, height):
+        """Get the serialized Block protobuf at a height, without parsing it
+
+        Args:
+            height (int): The height of the block to get
+
+        Returns:
+            bytes: The serialized block
+
+        Throws:
+            IndexError if the height is not in the archive
+        """
+
+        if not self.first_height <= height <= self.last_height:
+            raise IndexError(f"Block {height} is not in {self.path} ({self.first_height} to {self.last_height})")
+        offset, length, position, block_length = _INDEX_RECORD.unpack_from(
+            self._index, _INDEX_HEADER.size + (height - self.first_height) * _INDEX_RECORD.size)
+        compressed, _ = _SEGMENT_HEADER.unpack_from(self._data, offset)
+        if not compressed:
+            start = offset + _SEGMENT_HEADER.size + position
+            return self._data[start:start + block_length]
+        return self._segment_payload(offset, length)[position:position + block_length]
+
+    def get_block(self, height):
+        """Get the Block protobuf at a height
+
+        Args:
+            height (int): The height of the block to get
+
+        Returns:
+            Block: The block at that height
+
+        Throws:
+            IndexError if the height is not in the archive
+        """
+
+        return block_pb2.Block.FromString(self.get_block_bytes(height))
+
+    def iter_blocks(self, first_height=None, last_height=None):
+        """Iterate the Block protobufs over a range of heights, by default the whole archive
+
+        Args:
+            first_height (int, optional): The first height to read. Defaults to the first height in the archive
+            last_height (int, optional): The last height to read, inclusive. Defaults to the last height in the archive
+
+        Yields:
+            Block: The blocks in order of height
+        """
+
+        first_height = self.first_height if first_height is None else first_height
+        last_height = self.last_height if last_height is None else last_height
+        for height in range(first_height, last_height + 1):
+            yield self.get_block(height)
+
+    def close(self):
+        for mapped in (self._data, self._index):
+            if isinstance(mapped, mmap.mmap):
+                mapped.close()
+        self._data_file.close()
+        self._index_file.close()
+
+@trace
+def archive_all_blocks(connection, archive_name, archive_directory="logs", compress=False):
+    """Get all blocks from a node and append those not yet archived to a binary block archive
+    Only blocks above the last archived height are fetched, and each must link to the block before it
+
+    Args:
+        connection (IrohaGrpc): The connection to a node to get blocks from
+        archive_name (String): Name of the archive data file. The index is written to {archive_name}.index
+        archive_directory (String, optional): Name of directory (child of current directory) to place archives into
+            Created if not currently created. Defaults to logs
+        compress (bool, optional): Compress each segment with zlib. Defaults to False
+
+    Throws:
+        ChainMismatchError if a new block does not link to the last archived block
+        ValueError if an existing index is not a block archive index
+    """
+
+    path = Path(archive_directory + "/" + archive_name)
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+
+    prev_hash = None
+    next_height = 1
+    if path.exists():
+        _check_index(path)
+        with BlockArchiveReader(path) as archive:
+            if len(archive):
+                prev_hash = binascii.hexlify(IrohaCrypto.hash(
+                    archive.get_block(archive.last_height).block_v1)).decode()
+                next_height = archive.last_height + 1
+
+    height = get_chain_height(connection)
+    with BlockArchiveWriter(path, compress=compress) as archive:
+        for block in iter_blocks(next_height, height, [connection]):
+            prev_hash = _check_block_link(block, prev_hash)
+            archive.append(block)
@@ -0,0 +1,8 @@
+"""
+Shared pytest configuration for the *_testing.py modules
+"""
+
+
+def pytest_configure(config):
+    # Registered here too so the marker is known when pytest-xdist is not installed
+    config.addinivalue_line("markers", "xdist_group(name): run all tests of the group on the same pytest-xdist worker")
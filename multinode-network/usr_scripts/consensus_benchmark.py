@@ -0,0 +1,213 @@
+#! /bin/python
+
+"""
+Benchmark the multinode Iroha network over a sweep of consensus settings
+For each combination of settings, every network/nodeN/config.docker is rewritten with those settings,
+the network is restarted with manage-network.sh, and a fixed load_generator workload is run against it.
+Throughput, p50/p99 commit latency and block fill ratio (transactions per block over max_proposal_size)
+are reported for each setting. The original configs are restored afterwards
+
+NOTE this restarts the network for every setting, destroying its blocks
+
+Usage:
+    python consensus_benchmark.py --max-proposal-size 10 100 --proposal-delay 1000 5000 --json sweep.json
+"""
+from IrohaUtils import *
+import load_generator
+import argparse
+import grpc
+import itertools
+import json
+import logging
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+NETWORK_DIRECTORY = Path(__file__).resolve().parent.parent / "network"
+# The consensus settings that can be swept, as named in config.docker
+SETTINGS = ("max_proposal_size", "proposal_delay", "vote_delay", "proposal_creation_timeout")
+
+
+def config_variants(grid):
+    """
+    Every combination of the values of a grid of settings
+
+    Args:
+        grid (dict of String to list): Values to try for each setting, e.g. {"proposal_delay": [1000, 5000]}
+
+    Returns:
+        list of dict: One dict of settings per combination
+    """
+
+    names = list(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*(grid[name] for name in names))]
+
+def node_configs(network_directory=NETWORK_DIRECTORY):
+    """The config.docker of every node in the network directory, in node order"""
+    return sorted(Path(network_directory).glob("node*/config.docker"))
+
+@contextmanager
+def preserved_configs(network_directory=NETWORK_DIRECTORY):
+    """Restore every node config to its original contents on exit"""
+
+    originals = {path: path.read_bytes() for path in node_configs(network_directory)}
+    try:
+        yield
+    finally:
+        for path, contents in originals.items():
+            path.write_bytes(contents)
+
+def write_configs(settings, network_directory=NETWORK_DIRECTORY):
+    """
+    Apply settings to the config.docker of every node, keeping their other settings
+
+    Args:
+        settings (dict): The settings to apply, e.g. {"max_proposal_size": 100}
+        network_directory (Path, optional): The directory holding the nodeN directories
+    """
+
+    for path in node_configs(network_directory):
+        with open(path) as f:
+            config = json.load(f)
+        config.update(settings)
+        with open(path, "w") as f:
+            json.dump(config, f, indent=2)
+
+def restart_network(network_directory=NETWORK_DIRECTORY, connection=peers, timeout=120):
+    """Restart the network with manage-network.sh, and wait until every peer serves the genesis block"""
+
+    subprocess.run(["bash", "manage-network.sh", "restart"], cwd=Path(network_directory).parent, check=True)
+    deadline = time.monotonic() + timeout
+    for peer in connection:
+        while True:
+            try:
+                if get_chain_height(peer) >= 1:
+                    break
+            except grpc.RpcError:
+                pass
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"{peer.name} did not come up within {timeout}s")
+            time.sleep(1)
+
+def block_fill(first_height, last_height, connection, max_proposal_size):
+    """
+    Count the blocks and transactions in a range of heights
+
+    Returns:
+        (int, int, float): The number of blocks, the number of transactions (committed and rejected),
+            and the mean fraction of max_proposal_size each block was filled to
+    """
+
+    blocks = transactions = 0
+    for block in iter_blocks(first_height, last_height, [connection]):
+        payload = block.block_response.block.block_v1.payload
+        blocks += 1
+        transactions += len(payload.transactions) + len(payload.rejected_transactions_hashes)
+    fill = transactions / (blocks * max_proposal_size) if blocks else 0.0
+    return blocks, transactions, fill
+
+def fixed_workload(accounts=20, duration=60, concurrency=20, connection=peers):
+    """A closed-loop workload on fresh accounts, returning a function that runs it and returns its summary"""
+
+    def workload():
+        users, asset_id = load_generator.set_up_accounts(f"bench{int(time.time())}", accounts, connection=connection)
+        return lambda: load_generator.run_load(users, asset_id, duration, concurrency=concurrency, connection=connection)
+
+    return workload
+
+def benchmark_setting(settings, workload, restart, connection, network_directory=NETWORK_DIRECTORY):
+    """
+    Run the workload on a network restarted with settings, returning a result row
+    Workload setup (e.g. creating accounts) is excluded from the block counts
+
+    Args:
+        settings (dict): The consensus settings to apply
+        workload (callable): Sets up the workload, returning a callable that runs it and returns a load_generator summary
+        restart (callable): Restarts the network once configs are written
+        connection (IrohaGrpc): A peer to count blocks on
+        network_directory (Path, optional): The directory holding the nodeN directories
+
+    Returns:
+        dict: The settings, with throughput, latency and block fill of the run
+    """
+
+    logging.info(f"BENCHMARKING {settings}")
+    write_configs(settings, network_directory)
+    restart()
+    run = workload()
+    first_height = get_chain_height(connection) + 1
+    summary = run()
+    last_height = get_chain_height(connection)
+    with open(node_configs(network_directory)[0]) as f:
+        max_proposal_size = json.load(f)["max_proposal_size"]
+    blocks, transactions, fill = block_fill(first_height, last_height, connection, max_proposal_size)
+    return {
+        **settings,
+        "committed_tps": summary["committed_tps"],
+        "latency_p50": summary["latency_p50"],
+        "latency_p99": summary["latency_p99"],
+        "rejection_rate": summary["rejection_rate"],
+        "blocks": blocks,
+        "transactions": transactions,
+        "block_fill": fill,
+    }
+
+def sweep(grid, workload, restart, connection, network_directory=NETWORK_DIRECTORY):
+    """
+    Benchmark every combination of a grid of settings, restoring the original configs afterwards
+
+    Returns:
+        list of dict: A result row per combination, as from benchmark_setting
+    """
+
+    with preserved_configs(network_directory):
+        return [benchmark_setting(settings, workload, restart, connection, network_directory)
+                for settings in config_variants(grid)]
+
+def format_table(rows):
+    """Format result rows as a plain text table"""
+
+    if not rows:
+        return ""
+    columns = list(rows[0])
+
+    def cell(value):
+        if value is None:
+            return "-"
+        return f"{value:.3f}" if isinstance(value, float) else str(value)
+
+    widths = [max(len(column), *(len(cell(row[column])) for row in rows)) for column in columns]
+    lines = ["  ".join(column.rjust(width) for column, width in zip(columns, widths))]
+    for row in rows:
+        lines.append("  ".join(cell(row[column]).rjust(width) for column, width in zip(columns, widths)))
+    return "\n".join(lines)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the network over a sweep of consensus settings")
+    for setting in SETTINGS:
+        parser.add_argument(f"--{setting.replace('_', '-')}", type=int, nargs="+", dest=setting,
+                            help=f"values of {setting} to try")
+    parser.add_argument("--accounts", type=int, default=20, help="accounts to transfer between")
+    parser.add_argument("--concurrency", type=int, default=20, help="transactions to keep in flight")
+    parser.add_argument("--duration", type=float, default=60, help="seconds to run the workload for each setting")
+    parser.add_argument("--json", help="also write the results to this file as JSON")
+    args = parser.parse_args(argv)
+
+    grid = {setting: getattr(args, setting) for setting in SETTINGS if getattr(args, setting)}
+    if not grid:
+        parser.error("give at least one setting to sweep")
+    rows = sweep(grid,
+                 fixed_workload(args.accounts, args.duration, args.concurrency),
+                 restart_network,
+                 net_1)
+    print(format_table(rows))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(rows, f, indent=2)
+    return rows
+
+if __name__=="__main__":
+    logging.basicConfig(level=logging.INFO)
+    main(sys.argv[1:])
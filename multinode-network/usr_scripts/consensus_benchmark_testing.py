@@ -0,0 +1,135 @@
+#! /bin/python
+
+"""
+Test the consensus benchmark harness against a local stub, so no network or docker is needed
+The stub stands in for a peer, serving GetBlock queries from an in-memory chain, and restarting the
+network and running the workload are replaced by functions that grow that chain
+
+Run with pytest -rA -v consensus_benchmark_testing.py
+"""
+from consensus_benchmark import *
+from iroha import block_pb2, qry_responses_pb2, transaction_pb2
+import json
+import shutil
+import pytest
+
+
+class StubChain:
+    """A stand-in for a peer connection, answering GetBlock queries from an in-memory chain"""
+
+    def __init__(self):
+        self.blocks = []
+        self.restart()
+
+    def restart(self):
+        self.blocks = []
+        self.add_block(0)
+
+    def add_block(self, transactions):
+        block = block_pb2.Block()
+        block.block_v1.payload.height = len(self.blocks) + 1
+        block.block_v1.payload.transactions.extend(transaction_pb2.Transaction() for _ in range(transactions))
+        self.blocks.append(block)
+
+    def send_query(self, query, timeout=None):
+        response = qry_responses_pb2.QueryResponse()
+        height = query.payload.get_block.height
+        if 1 <= height <= len(self.blocks):
+            response.block_response.block.CopyFrom(self.blocks[height - 1])
+        else:
+            response.error_response.message = "no block"
+        return response
+
+
+@pytest.fixture(name="network_directory")
+def network_directory_fixture(tmp_path):
+    """A copy of the node configs of the network, safe to rewrite"""
+
+    for path in node_configs():
+        (tmp_path / path.parent.name).mkdir()
+        shutil.copy(path, tmp_path / path.parent.name / path.name)
+    return tmp_path
+
+
+def test_config_variants():
+    """
+    Test every combination of the grid is produced
+    """
+
+    variants = config_variants({"max_proposal_size": [10, 100], "proposal_delay": [1000, 5000]})
+    assert variants == [
+        {"max_proposal_size": 10, "proposal_delay": 1000},
+        {"max_proposal_size": 10, "proposal_delay": 5000},
+        {"max_proposal_size": 100, "proposal_delay": 1000},
+        {"max_proposal_size": 100, "proposal_delay": 5000},
+    ]
+
+
+def test_write_configs_restored(network_directory):
+    """
+    Test settings are written to every node config, keeping other settings, and the originals are restored
+    """
+
+    originals = [path.read_bytes() for path in node_configs(network_directory)]
+    assert len(originals) == 4
+    with preserved_configs(network_directory):
+        write_configs({"proposal_delay": 1000}, network_directory)
+        for i, path in enumerate(node_configs(network_directory)):
+            config = json.loads(path.read_text())
+            assert config["proposal_delay"] == 1000
+            assert config["torii_port"] == 50051 + i
+    assert [path.read_bytes() for path in node_configs(network_directory)] == originals
+
+
+def test_sweep_against_stub(network_directory):
+    """
+    Test a sweep restarts the network once per setting, and reports the workload and block fill of each
+    """
+
+    chain = StubChain()
+    restarted_with = []
+
+    def restart():
+        with open(node_configs(network_directory)[0]) as f:
+            restarted_with.append(json.load(f)["max_proposal_size"])
+        chain.restart()
+
+    def workload():
+        # Setup commits a block, which should not count towards the fill
+        chain.add_block(1)
+
+        def run():
+            # Four blocks, each half full
+            max_proposal_size = restarted_with[-1]
+            for _ in range(4):
+                chain.add_block(max_proposal_size // 2)
+            return {"committed_tps": 2.0 * max_proposal_size, "latency_p50": 1.5,
+                    "latency_p99": 4.5, "rejection_rate": 0.0}
+
+        return run
+
+    rows = sweep({"max_proposal_size": [10, 100]}, workload, restart, chain, network_directory)
+    assert restarted_with == [10, 100]
+    assert [row["max_proposal_size"] for row in rows] == [10, 100]
+    assert [row["blocks"] for row in rows] == [4, 4]
+    assert [row["transactions"] for row in rows] == [20, 200]
+    assert [row["block_fill"] for row in rows] == [0.5, 0.5]
+    assert [row["committed_tps"] for row in rows] == [20.0, 200.0]
+    assert json.loads(node_configs(network_directory)[0].read_text())["max_proposal_size"] == 10
+
+
+def test_format_table():
+    """
+    Test results are laid out as aligned columns
+    """
+
+    table = format_table([
+        {"proposal_delay": 1000, "committed_tps": 12.5, "latency_p50": None},
+        {"proposal_delay": 5000, "committed_tps": 2.25, "latency_p50": 5.0},
+    ])
+    lines = table.splitlines()
+    assert len(lines) == 3
+    assert lines[0].split() == ["proposal_delay", "committed_tps", "latency_p50"]
+    assert lines[1].split() == ["1000", "12.500", "-"]
+    assert lines[2].split() == ["5000", "2.250", "5.000"]
+    assert len({len(line) for line in lines}) == 1
@@ -0,0 +1,780 @@
+#! /bin/python
+
+"""
+An in-process stand-in for the Iroha network, so client code can be tested and benchmarked without docker
+A FakeLedger holds the world state in memory, starting from the genesis block of this network, and commits the
+pending transactions as a block every commit_latency seconds, up to max_proposal_size transactions per block.
+Each FakePeer serves the CommandService (Torii, ListTorii, Status, StatusStream) and QueryService (Find, FetchCommits)
+of Iroha over gRPC on a local port, and can add latency to and fail its calls, to exercise timeouts and failover.
+Several peers share one ledger, so they always agree, as a healthy network does
+
+The ledger validates transactions much as Iroha does: a transaction needs a signature of its creator, commands
+need the role permissions Iroha asks for (e.g. can_transfer, can_create_account, or a granted can_transfer_my_assets),
+balances cannot go negative, and a transaction whose hash was already seen is ignored. ATOMIC batches are committed
+or rejected as a whole. Signatures are not verified, queries are not permission checked, and error codes
+only approximate Iroha's
+
+Usage:
+    python fake_iroha.py --peers 4 --base-port 50051 --commit-latency 1
+Then point the scripts at it, e.g. IROHA_HOST_ADDR_1=127.0.0.1 ... IROHA_PORT_4=50054 python load_generator.py --rate 5
+
+Or in code:
+    with FakeNetwork(peers=4, commit_latency=0.1) as network:
+        registry = network.registry()
+        send_transaction(tx, registry)
+"""
+from IrohaUtils import *
+from iroha import primitive_pb2, qry_responses_pb2, transaction_pb2, block_pb2, endpoint_pb2, endpoint_pb2_grpc
+from google.protobuf import empty_pb2
+import argparse
+import decimal
+import logging
+import random
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+GENESIS_PATH = Path(__file__).resolve().parent.parent / "network" / "shared_init" / "genesis.block"
+TERMINAL_STATUSES = ("COMMITTED", "REJECTED", "STATELESS_VALIDATION_FAILED", "MST_EXPIRED")
+# Seconds a status stream waits for an unknown transaction before answering NOT_RECEIVED
+NOT_RECEIVED_WAIT = 1.0
+
+_MISSING = object()
+
+
+class CommandError(Exception):
+    """A command failing stateful validation, with the error code Iroha would give"""
+
+    # Error codes shared by every command, as in Iroha
+    NO_PERMISSION = 2
+
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+
+
+def _status(name, tx_hash, command_name="", command_index=0, error_code=0):
+    return endpoint_pb2.ToriiResponse(tx_status=endpoint_pb2.TxStatus.Value(name), tx_hash=tx_hash,
+                                      err_or_cmd_name=command_name, failed_cmd_index=command_index,
+                                      error_code=error_code)
+
+def _hex_hash(proto):
+    return binascii.hexlify(IrohaCrypto.hash(proto)).decode()
+
+def _format_amount(amount, precision):
+    """An amount written as Iroha writes balances, with as many decimal places as the asset has"""
+    return f"{amount:.{precision}f}"
+
+
+class FakeLedger:
+    """The world state, blocks and transaction statuses of a fake network, and its commit loop
+    All state is guarded by one condition, notified whenever a status changes or a block commits
+    """
+
+    def __init__(self, genesis_path=GENESIS_PATH, commit_latency=0.5, max_proposal_size=10):
+        """
+        Args:
+            genesis_path (String, optional): The JSON genesis block to start from. Defaults to that of this network
+            commit_latency (float, optional): Seconds between commit rounds, or None to only commit when
+                commit_round is called. Defaults to 0.5
+            max_proposal_size (int, optional): The most transactions in a block. Defaults to 10
+        """
+
+        self.commit_latency = commit_latency
+        self.max_proposal_size = max_proposal_size
+        self.changed = threading.Condition()
+        self.blocks = []
+        self.peers = {}
+        self.domains = {}
+        self.assets = {}
+        self.accounts = {}
+        self.roles = {}
+        self.grants = {}
+        self.balances = {}
+        self.transactions = {}
+        self.account_transactions = {}
+        self.account_asset_transactions = {}
+        self.statuses = {}
+        self._pending = deque()
+        self._stopped = threading.Event()
+
+        with open(genesis_path) as f:
+            genesis = json_format.Parse(f.read(), block_pb2.Block(), ignore_unknown_fields=True)
+        for transaction in genesis.block_v1.payload.transactions:
+            self._apply(transaction, [], check=False)
+        self._commit_block(list(genesis.block_v1.payload.transactions), [])
+
+        self._thread = None
+        if commit_latency is not None:
+            self._thread = threading.Thread(target=self._run, name="FakeLedger", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        with self.changed:
+            self.changed.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+
+    @property
+    def height(self):
+        return len(self.blocks)
+
+    # Receiving transactions ---------------------------------------------------
+
+    def receive(self, transactions):
+        """Stateless validate transactions and queue them for the next proposal
+        Transactions of one batch (sharing their batch reduced_hashes) are queued as one unit
+        """
+
+        units = []
+        for transaction in transactions:
+            batch = tuple(transaction.payload.batch.reduced_hashes)
+            if batch and units and units[-1][0] == batch:
+                units[-1][1].append(transaction)
+            else:
+                units.append((batch, [transaction]))
+        with self.changed:
+            for _, unit in units:
+                accepted = []
+                for transaction in unit:
+                    tx_hash = _hex_hash(transaction)
+                    if tx_hash in self.statuses:
+                        # Iroha handles a transaction once, and answers a replay with its earlier statuses
+                        continue
+                    if not transaction.signatures or not transaction.payload.reduced_payload.commands:
+                        self.statuses[tx_hash] = [_status("STATELESS_VALIDATION_FAILED", tx_hash)]
+                        continue
+                    self.statuses[tx_hash] = [_status("STATELESS_VALIDATION_SUCCESS", tx_hash),
+                                              _status("ENOUGH_SIGNATURES_COLLECTED", tx_hash)]
+                    accepted.append(transaction)
+                if accepted:
+                    self._pending.append(accepted)
+            self.changed.notify_all()
+
+    # Committing ---------------------------------------------------------------
+
+    def _run(self):
+        while not self._stopped.wait(self.commit_latency):
+            self.commit_round()
+
+    def commit_round(self):
+        """Take the next proposal from the pending transactions, validate it and commit it as a block
+
+        Returns:
+            Block: The block committed, or None if no transactions were pending
+        """
+
+        with self.changed:
+            units = []
+            size = 0
+            while self._pending and (not units or size + len(self._pending[0]) <= self.max_proposal_size):
+                unit = self._pending.popleft()
+                units.append(unit)
+                size += len(unit)
+            if not units:
+                return None
+            committed, rejected = [], []
+            for unit in units:
+                atomic = len(unit) > 1 and \
+                    unit[0].payload.batch.type == transaction_pb2.Transaction.Payload.BatchMeta.ATOMIC
+                unit_undo, errors = [], []
+                for transaction in unit:
+                    undo = []
+                    error = self._validate(transaction, undo)
+                    errors.append(error)
+                    if error is None:
+                        unit_undo.extend(undo)
+                    elif atomic:
+                        break
+                if atomic and any(error is not None for error in errors):
+                    self._rollback(unit_undo)
+                    errors += [None] * (len(unit) - len(errors))
+                    # The first failure is reported for every transaction of the batch
+                    failure = next(error for error in errors if error is not None)
+                    errors = [failure] * len(unit)
+                for transaction, error in zip(unit, errors):
+                    tx_hash = _hex_hash(transaction)
+                    if error is None:
+                        committed.append(transaction)
+                        self.statuses[tx_hash].append(_status("STATEFUL_VALIDATION_SUCCESS", tx_hash))
+                    else:
+                        rejected.append((tx_hash, error))
+                        self.statuses[tx_hash].append(_status("STATEFUL_VALIDATION_FAILED", tx_hash, *error))
+            block = self._commit_block(committed, [tx_hash for tx_hash, _ in rejected])
+            for transaction in committed:
+                tx_hash = _hex_hash(transaction)
+                self.statuses[tx_hash].append(_status("COMMITTED", tx_hash))
+            for tx_hash, error in rejected:
+                self.statuses[tx_hash].append(_status("REJECTED", tx_hash, *error))
+            self.changed.notify_all()
+            return block
+
+    def _commit_block(self, committed, rejected):
+        block = block_pb2.Block()
+        payload = block.block_v1.payload
+        payload.height = len(self.blocks) + 1
+        payload.prev_block_hash = binascii.hexlify(IrohaCrypto.hash(self.blocks[-1].block_v1)).decode() \
+            if self.blocks else "0" * 64
+        payload.transactions.extend(committed)
+        payload.tx_number = len(committed)
+        payload.rejected_transactions_hashes.extend(rejected)
+        payload.created_time = int(time.time() * 1000)
+        self.blocks.append(block)
+        for transaction in committed:
+            self._index(transaction, payload.height)
+        return block
+
+    def _index(self, transaction, height):
+        """Record a committed transaction for the transaction queries"""
+
+        tx_hash = _hex_hash(transaction)
+        reduced = transaction.payload.reduced_payload
+        self.transactions[tx_hash] = (transaction, height)
+        self.account_transactions.setdefault(reduced.creator_account_id, []).append(tx_hash)
+        touched = set()
+        for command in reduced.commands:
+            kind = command.WhichOneof("command")
+            if kind == "transfer_asset":
+                touched.add((command.transfer_asset.src_account_id, command.transfer_asset.asset_id))
+                touched.add((command.transfer_asset.dest_account_id, command.transfer_asset.asset_id))
+            elif kind in ("add_asset_quantity", "subtract_asset_quantity"):
+                touched.add((reduced.creator_account_id, getattr(command, kind).asset_id))
+        for key in sorted(touched):
+            self.account_asset_transactions.setdefault(key, []).append(tx_hash)
+
+    # Validation ---------------------------------------------------------------
+
+    def _validate(self, transaction, undo):
+        """Apply a transaction, returning None, or (command name, index, error code) and undoing it if it fails"""
+
+        try:
+            self._apply(transaction, undo)
+            return None
+        except CommandError as e:
+            self._rollback(undo)
+            logging.debug(f"FAKE LEDGER REJECTED {_hex_hash(transaction)}: {e}")
+            return e.command_name, e.command_index, e.code
+
+    def _rollback(self, undo):
+        for mapping, key, value in reversed(undo):
+            if value is _MISSING:
+                mapping.pop(key, None)
+            else:
+                mapping[key] = value
+        undo.clear()
+
+    def _set(self, mapping, key, value, undo):
+        undo.append((mapping, key, mapping.get(key, _MISSING)))
+        mapping[key] = value
+
+    def _apply(self, transaction, undo, check=True):
+        reduced = transaction.payload.reduced_payload
+        creator = reduced.creator_account_id
+        if check:
+            account = self.accounts.get(creator)
+            keys = {signature.public_key for signature in transaction.signatures}
+            if account is None or len(keys & account["signatories"]) < account["quorum"]:
+                error = CommandError(1, f"Not enough signatures of {creator}")
+                error.command_name, error.command_index = "", 0
+                raise error
+        for index, command in enumerate(reduced.commands):
+            kind = command.WhichOneof("command")
+            handler = getattr(self, f"_command_{kind}", None)
+            try:
+                if handler is None:
+                    raise CommandError(1, f"{kind} is not supported by the fake ledger")
+                handler(creator, getattr(command, kind), undo, check)
+            except CommandError as e:
+                e.command_name, e.command_index = kind, index
+                raise
+
+    def _can(self, account_id, permission):
+        account = self.accounts.get(account_id)
+        return account is not None and any(permission in self.roles.get(role, ()) for role in account["roles"])
+
+    def _require(self, check, account_id, permission):
+        if check and not self._can(account_id, permission):
+            raise CommandError(CommandError.NO_PERMISSION,
+                               f"{account_id} lacks {primitive_pb2.RolePermission.Name(permission)}")
+
+    def _amount(self, asset_id, amount):
+        if asset_id not in self.assets:
+            raise CommandError(3, f"No such asset {asset_id}")
+        try:
+            value = decimal.Decimal(amount)
+        except decimal.InvalidOperation:
+            raise CommandError(1, f"Invalid amount {amount}")
+        if value <= 0 or -value.as_tuple().exponent > self.assets[asset_id]["precision"]:
+            raise CommandError(1, f"Invalid amount {amount} for {asset_id}")
+        return value
+
+    def _update_account(self, account_id, undo, **changes):
+        account = self.accounts.get(account_id)
+        if account is None:
+            raise CommandError(3, f"No such account {account_id}")
+        self._set(self.accounts, account_id, {**account, **changes}, undo)
+
+    def _command_add_peer(self, creator, command, undo, check):
+        self._require(check, creator, primitive_pb2.can_add_peer)
+        self._set(self.peers, command.peer.peer_key, command.peer, undo)
+
+    def _command_create_role(self, creator, command, undo, check):
+        self._require(check, creator, primitive_pb2.can_create_role)
+        if command.role_name in self.roles:
+            raise CommandError(3, f"Role {command.role_name} already exists")
+        self._set(self.roles, command.role_name, set(command.permissions), undo)
+
+    def _command_append_role(self, creator, command, undo, check):
+        self._require(check, creator, primitive_pb2.can_append_role)
+        if command.role_name not in self.roles:
+            raise CommandError(4, f"No such role {command.role_name}")
+        account = self.accounts.get(command.account_id)
+        if account is None:
+            raise CommandError(3, f"No such account {command.account_id}")
+        self._update_account(command.account_id, undo, roles=account["roles"] + [command.role_name])
+
+    def _command_create_domain(self, creator, command, undo, check):
+        self._require(check, creator, primitive_pb2.can_create_domain)
+        if command.domain_id in self.domains:
+            raise CommandError(3, f"Domain {command.domain_id} already exists")
+        if command.default_role not in self.roles:
+            raise CommandError(4, f"No such role {command.default_role}")
+        self._set(self.domains, command.domain_id, command.default_role, undo)
+
+    def _command_create_asset(self, creator, command, undo, check):
+        self._require(check, creator, primitive_pb2.can_create_asset)
+        asset_id = f"{command.asset_name}#{command.domain_id}"
+        if command.domain_id not in self.domains:
+            raise CommandError(4, f"No such domain {command.domain_id}")
+        if asset_id in self.assets:
+            raise CommandError(3, f"Asset {asset_id} already exists")
+        self._set(self.assets, asset_id, {"domain_id": command.domain_id, "precision": command.precision}, undo)
+
+    def _command_create_account(self, creator, command, undo, check):
+        self._require(check, creator, primitive_pb2.can_create_account)
+        account_id = f"{command.account_name}@{command.domain_id}"
+        if command.domain_id not in self.domains:
+            raise CommandError(3, f"No such domain {command.domain_id}")
+        if account_id in self.accounts:
+            raise CommandError(4, f"Account {account_id} already exists")
+        self._set(self.accounts, account_id, {"domain_id": command.domain_id, "quorum": 1,
+                                              "signatories": {command.public_key},
+                                              "roles": [self.domains[command.domain_id]], "detail": {}}, undo)
+
+    def _command_add_signatory(self, creator, command, undo, check):
+        if command.account_id != creator:
+            self._require(check, creator, primitive_pb2.can_add_signatory)
+        account = self.accounts.get(command.account_id)
+        if account is None:
+            raise CommandError(3, f"No such account {command.account_id}")
+        self._update_account(command.account_id, undo, signatories=account["signatories"] | {command.public_key})
+
+    def _command_set_account_detail(self, creator, command, undo, check):
+        if command.account_id != creator:
+            self._require(check, creator, primitive_pb2.can_set_detail)
+        account = self.accounts.get(command.account_id)
+        if account is None:
+            raise CommandError(3, f"No such account {command.account_id}")
+        detail = {**account["detail"], creator: {**account["detail"].get(creator, {}), command.key: command.value}}
+        self._update_account(command.account_id, undo, detail=detail)
+
+    def _command_grant_permission(self, creator, command, undo, check):
+        name = primitive_pb2.GrantablePermission.Name(command.permission)
+        self._require(check, creator, getattr(primitive_pb2, f"can_grant_{name}"))
+        if command.account_id not in self.accounts:
+            raise CommandError(3, f"No such account {command.account_id}")
+        self._set(self.grants, (creator, command.account_id, command.permission), True, undo)
+
+    def _command_revoke_permission(self, creator, command, undo, check):
+        key = (creator, command.account_id, command.permission)
+        if key not in self.grants:
+            raise CommandError(3, f"{command.account_id} was not granted that permission by {creator}")
+        undo.append((self.grants, key, True))
+        del self.grants[key]
+
+    def _change_balance(self, account_id, asset_id, change, undo):
+        balance = self.balances.get((account_id, asset_id), decimal.Decimal(0)) + change
+        if balance < 0:
+            raise CommandError(4, f"Not enough {asset_id} held by {account_id}")
+        self._set(self.balances, (account_id, asset_id), balance, undo)
+
+    def _command_add_asset_quantity(self, creator, command, undo, check):
+        self._require(check, creator, primitive_pb2.can_add_asset_qty)
+        self._change_balance(creator, command.asset_id, self._amount(command.asset_id, command.amount), undo)
+
+    def _command_subtract_asset_quantity(self, creator, command, undo, check):
+        self._require(check, creator, primitive_pb2.can_subtract_asset_qty)
+        self._change_balance(creator, command.asset_id, -self._amount(command.asset_id, command.amount), undo)
+
+    def _command_transfer_asset(self, creator, command, undo, check):
+        if command.src_account_id == creator:
+            self._require(check, creator, primitive_pb2.can_transfer)
+        elif check and (command.src_account_id, creator, primitive_pb2.can_transfer_my_assets) not in self.grants:
+            raise CommandError(CommandError.NO_PERMISSION,
+                               f"{creator} may not transfer assets of {command.src_account_id}")
+        if command.src_account_id not in self.accounts:
+            raise CommandError(3, f"No such account {command.src_account_id}")
+        if command.dest_account_id not in self.accounts:
+            raise CommandError(4, f"No such account {command.dest_account_id}")
+        self._require(check, command.dest_account_id, primitive_pb2.can_receive)
+        amount = self._amount(command.asset_id, command.amount)
+        try:
+            self._change_balance(command.src_account_id, command.asset_id, -amount, undo)
+        except CommandError as e:
+            raise CommandError(6, str(e))
+        self._change_balance(command.dest_account_id, command.asset_id, amount, undo)
+
+    # Queries ------------------------------------------------------------------
+
+    def query(self, query):
+        """Answer a query from the current state
+
+        Returns:
+            QueryResponse: The response, an error_response for queries the fake ledger does not support
+        """
+
+        response = qry_responses_pb2.QueryResponse()
+        response.query_hash = _hex_hash(query)
+        kind = query.payload.WhichOneof("query")
+        handler = getattr(self, f"_query_{kind}", None)
+        with self.changed:
+            if handler is None:
+                self._error(response, "NOT_SUPPORTED", 0, f"{kind} is not supported by the fake ledger")
+            else:
+                handler(getattr(query.payload, kind), response)
+        return response
+
+    def _error(self, response, reason, code, message):
+        response.error_response.reason = qry_responses_pb2.ErrorResponse.Reason.Value(reason)
+        response.error_response.error_code = code
+        response.error_response.message = message
+
+    def _invalid_page_size(self, pagination_meta, response):
+        # Iroha refuses a page of no results in stateless validation, before reading any state
+        self._error(response, "STATELESS_INVALID", 0, f"Page size {pagination_meta.page_size} is below 1")
+
+    def _query_get_block(self, query, response):
+        if not 1 <= query.height <= len(self.blocks):
+            return self._error(response, "STATEFUL_INVALID", 3, f"No block at height {query.height}")
+        response.block_response.block.CopyFrom(self.blocks[query.height - 1])
+
+    def _query_get_account(self, query, response):
+        account = self.accounts.get(query.account_id)
+        if account is None:
+            return self._error(response, "NO_ACCOUNT", 0, f"No such account {query.account_id}")
+        response.account_response.account.account_id = query.account_id
+        response.account_response.account.domain_id = account["domain_id"]
+        response.account_response.account.quorum = account["quorum"]
+        response.account_response.account.json_data = json.dumps(account["detail"])
+        response.account_response.account_roles.extend(account["roles"])
+
+    def _query_get_signatories(self, query, response):
+        account = self.accounts.get(query.account_id)
+        if account is None:
+            return self._error(response, "NO_SIGNATORIES", 0, f"No such account {query.account_id}")
+        response.signatories_response.keys.extend(sorted(account["signatories"]))
+
+    def _query_get_asset_info(self, query, response):
+        asset = self.assets.get(query.asset_id)
+        if asset is None:
+            return self._error(response, "NO_ASSET", 0, f"No such asset {query.asset_id}")
+        response.asset_response.asset.asset_id = query.asset_id
+        response.asset_response.asset.domain_id = asset["domain_id"]
+        response.asset_response.asset.precision = asset["precision"]
+
+    def _query_get_roles(self, query, response):
+        response.roles_response.roles.extend(sorted(self.roles))
+
+    def _query_get_role_permissions(self, query, response):
+        if query.role_id not in self.roles:
+            return self._error(response, "NO_ROLES", 0, f"No such role {query.role_id}")
+        response.role_permissions_response.permissions.extend(sorted(self.roles[query.role_id]))
+
+    def _query_get_peers(self, query, response):
+        response.peers_response.peers.extend(self.peers.values())
+
+    def _query_get_account_assets(self, query, response):
+        if query.HasField("pagination_meta") and query.pagination_meta.page_size < 1:
+            return self._invalid_page_size(query.pagination_meta, response)
+        if query.account_id not in self.accounts:
+            return self._error(response, "NO_ACCOUNT_ASSETS", 0, f"No such account {query.account_id}")
+        held = sorted(asset_id for account_id, asset_id in self.balances if account_id == query.account_id)
+        start, end = 0, len(held)
+        if query.HasField("pagination_meta"):
+            first = query.pagination_meta.first_asset_id
+            if first:
+                if first not in held:
+                    return self._error(response, "STATEFUL_INVALID", 4, f"{query.account_id} does not hold {first}")
+                start = held.index(first)
+            end = min(len(held), start + query.pagination_meta.page_size)
+        for asset_id in held[start:end]:
+            asset = response.account_assets_response.account_assets.add()
+            asset.asset_id = asset_id
+            asset.account_id = query.account_id
+            asset.balance = _format_amount(self.balances[(query.account_id, asset_id)],
+                                           self.assets[asset_id]["precision"])
+        response.account_assets_response.total_number = len(held)
+        if end < len(held):
+            response.account_assets_response.next_asset_id = held[end]
+
+    def _query_get_transactions(self, query, response):
+        for tx_hash in query.tx_hashes:
+            if tx_hash not in self.transactions:
+                return self._error(response, "STATEFUL_INVALID", 4, f"No committed transaction {tx_hash}")
+        response.transactions_response.transactions.extend(
+            self.transactions[tx_hash][0] for tx_hash in query.tx_hashes)
+
+    def _transactions_page(self, hashes, pagination_meta, response):
+        if pagination_meta.page_size < 1:
+            return self._invalid_page_size(pagination_meta, response)
+        start = 0
+        if pagination_meta.first_tx_hash:
+            if pagination_meta.first_tx_hash not in hashes:
+                return self._error(response, "STATEFUL_INVALID", 4, f"No transaction {pagination_meta.first_tx_hash}")
+            start = hashes.index(pagination_meta.first_tx_hash)
+        end = min(len(hashes), start + pagination_meta.page_size)
+        page = response.transactions_page_response
+        page.transactions.extend(self.transactions[tx_hash][0] for tx_hash in hashes[start:end])
+        page.all_transactions_size = len(hashes)
+        if end < len(hashes):
+            page.next_tx_hash = hashes[end]
+
+    def _query_get_account_transactions(self, query, response):
+        if query.account_id not in self.accounts:
+            return self._error(response, "STATEFUL_INVALID", 4, f"No such account {query.account_id}")
+        self._transactions_page(self.account_transactions.get(query.account_id, []), query.pagination_meta, response)
+
+    def _query_get_account_asset_transactions(self, query, response):
+        if query.account_id not in self.accounts:
+            return self._error(response, "STATEFUL_INVALID", 4, f"No such account {query.account_id}")
+        if query.asset_id not in self.assets:
+            return self._error(response, "STATEFUL_INVALID", 5, f"No such asset {query.asset_id}")
+        self._transactions_page(self.account_asset_transactions.get((query.account_id, query.asset_id), []),
+                                query.pagination_meta, response)
+
+
+class _CommandService(endpoint_pb2_grpc.CommandService_v1Servicer):
+
+    def __init__(self, peer):
+        self.peer = peer
+
+    def Torii(self, request, context):
+        self.peer.inject(context)
+        self.peer.ledger.receive([request])
+        return empty_pb2.Empty()
+
+    def ListTorii(self, request, context):
+        self.peer.inject(context)
+        self.peer.ledger.receive(request.transactions)
+        return empty_pb2.Empty()
+
+    def Status(self, request, context):
+        self.peer.inject(context)
+        with self.peer.ledger.changed:
+            statuses = self.peer.ledger.statuses.get(request.tx_hash)
+            return statuses[-1] if statuses else _status("NOT_RECEIVED", request.tx_hash)
+
+    def StatusStream(self, request, context):
+        self.peer.inject(context)
+        ledger = self.peer.ledger
+        sent = 0
+        deadline = time.monotonic() + NOT_RECEIVED_WAIT
+        while context.is_active():
+            with ledger.changed:
+                statuses = ledger.statuses.get(request.tx_hash)
+                if self.peer.stalled:
+                    new = []
+                elif statuses is None and time.monotonic() > deadline:
+                    new = [_status("NOT_RECEIVED", request.tx_hash)]
+                else:
+                    new = (statuses or [])[sent:]
+                if not new:
+                    ledger.changed.wait(0.5)
+            if self.peer.down:
+                context.abort(grpc.StatusCode.UNAVAILABLE, f"{self.peer.name} is down")
+            for status in new:
+                yield status
+            sent += len(new)
+            if new and endpoint_pb2.TxStatus.Name(new[-1].tx_status) in TERMINAL_STATUSES + ("NOT_RECEIVED",):
+                return
+
+
+class _QueryService(endpoint_pb2_grpc.QueryService_v1Servicer):
+
+    def __init__(self, peer):
+        self.peer = peer
+
+    def Find(self, request, context):
+        self.peer.inject(context)
+        return self.peer.ledger.query(request)
+
+    def FetchCommits(self, request, context):
+        self.peer.inject(context)
+        ledger = self.peer.ledger
+        with ledger.changed:
+            height = ledger.height
+        while context.is_active():
+            with ledger.changed:
+                if ledger.height == height:
+                    ledger.changed.wait(0.5)
+                blocks = ledger.blocks[height:]
+            if self.peer.down:
+                context.abort(grpc.StatusCode.UNAVAILABLE, f"{self.peer.name} is down")
+            for block in blocks:
+                yield qry_responses_pb2.BlockQueryResponse(block_response=qry_responses_pb2.BlockResponse(block=block))
+            height += len(blocks)
+
+
+class FakePeer:
+    """One peer of a fake network, serving the Iroha gRPC services of a FakeLedger on a local port
+
+    Failure injection:
+        rpc_latency: seconds added to the start of every call
+        failure_rate: the chance each call fails with failure_code
+        fail_next(count): fail the next count calls
+        down: while True every call fails as UNAVAILABLE, and open streams are cut
+        stalled: while True open status streams send nothing more, as from a peer that stopped making progress
+    """
+
+    def __init__(self, ledger, name="node1", address="127.0.0.1:0", rpc_latency=0.0, failure_rate=0.0,
+                 failure_code=grpc.StatusCode.UNAVAILABLE, seed=None, max_workers=64):
+        """
+        Args:
+            ledger (FakeLedger): The ledger to serve
+            name (String, optional): The name of the peer. Defaults to node1
+            address (String, optional): The host and port to listen on, port 0 for any free port. Defaults to 127.0.0.1:0
+            rpc_latency (float, optional): Seconds added to every call. Defaults to 0
+            failure_rate (float, optional): The chance each call fails. Defaults to 0
+            failure_code (grpc.StatusCode, optional): The code failed calls end with. Defaults to UNAVAILABLE
+            seed (int, optional): Seeds the choice of calls to fail, for repeatable runs
+            max_workers (int, optional): Threads serving calls, which bounds the status streams open at once
+        """
+
+        self.ledger = ledger
+        self.name = name
+        self.rpc_latency = rpc_latency
+        self.failure_rate = failure_rate
+        self.failure_code = failure_code
+        self.down = False
+        self.stalled = False
+        self.calls = 0
+        self._fail_next = []
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.server = grpc.server(ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f"FakePeer-{name}"))
+        endpoint_pb2_grpc.add_CommandService_v1Servicer_to_server(_CommandService(self), self.server)
+        endpoint_pb2_grpc.add_QueryService_v1Servicer_to_server(_QueryService(self), self.server)
+        port = self.server.add_insecure_port(address)
+        self.address = f"{address.rsplit(':', 1)[0]}:{port}"
+
+    def __repr__(self):
+        return f"FakePeer({self.name}, {self.address})"
+
+    def start(self):
+        self.server.start()
+        return self
+
+    def stop(self, grace=None):
+        self.server.stop(grace)
+
+    def fail_next(self, count=1, code=None):
+        """Fail the next count calls to this peer with code, by default the failure_code of the peer"""
+
+        with self._lock:
+            self._fail_next.extend([code or self.failure_code] * count)
+
+    def inject(self, context):
+        """Apply the latency and failures of the peer to a call, aborting it if it should fail"""
+
+        with self._lock:
+            self.calls += 1
+            code = self._fail_next.pop(0) if self._fail_next else None
+            if code is None and self.failure_rate and self._random.random() < self.failure_rate:
+                code = self.failure_code
+        if self.rpc_latency:
+            time.sleep(self.rpc_latency)
+        if self.down:
+            context.abort(grpc.StatusCode.UNAVAILABLE, f"{self.name} is down")
+        if code is not None:
+            context.abort(code, f"Injected failure of {self.name}")
+
+
+class FakeNetwork:
+    """A FakeLedger served by several FakePeers, started and stopped together"""
+
+    def __init__(self, peers=4, host="127.0.0.1", base_port=0, genesis_path=GENESIS_PATH, commit_latency=0.5,
+                 max_proposal_size=10, **peer_options):
+        """
+        Args:
+            peers (int, optional): The number of peers. Defaults to 4
+            host (String, optional): The host to listen on. Defaults to 127.0.0.1
+            base_port (int, optional): Peer N listens on base_port + N - 1. Defaults to any free ports
+            genesis_path, commit_latency, max_proposal_size: As for FakeLedger
+            peer_options: Failure injection options given to every FakePeer
+        """
+
+        self.ledger = FakeLedger(genesis_path, commit_latency, max_proposal_size)
+        self.peers = [FakePeer(self.ledger, f"node{i+1}", f"{host}:{base_port + i if base_port else 0}", **peer_options)
+                      for i in range(peers)]
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        for peer in self.peers:
+            peer.start()
+        return self
+
+    def stop(self):
+        for peer in self.peers:
+            peer.stop(None)
+        self.ledger.stop()
+
+    def registry(self, **kwargs):
+        """A PeerRegistry of the peers, taking the same options as PeerRegistry"""
+        return PeerRegistry([(peer.name, peer.address) for peer in self.peers], **kwargs)
+
+    def environment(self):
+        """The IROHA_HOST_ADDR_n and IROHA_PORT_n variables pointing the scripts at the peers"""
+
+        variables = {}
+        for i, peer in enumerate(self.peers):
+            host, port = peer.address.rsplit(":", 1)
+            variables[f"IROHA_HOST_ADDR_{i+1}"] = host
+            variables[f"IROHA_PORT_{i+1}"] = port
+        return variables
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve an in-process stand-in for the Iroha network")
+    parser.add_argument("--peers", type=int, default=4, help="peers to serve")
+    parser.add_argument("--host", default="127.0.0.1", help="host to listen on")
+    parser.add_argument("--base-port", type=int, default=50051, help="port of the first peer, the rest follow it")
+    parser.add_argument("--commit-latency", type=float, default=1.0, help="seconds between blocks")
+    parser.add_argument("--max-proposal-size", type=int, default=10, help="most transactions in a block")
+    parser.add_argument("--rpc-latency", type=float, default=0.0, help="seconds added to every call")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="chance each call fails as UNAVAILABLE")
+    args = parser.parse_args(argv)
+
+    network = FakeNetwork(args.peers, args.host, args.base_port, commit_latency=args.commit_latency,
+                          max_proposal_size=args.max_proposal_size, rpc_latency=args.rpc_latency,
+                          failure_rate=args.failure_rate).start()
+    print(" ".join(f"{name}={value}" for name, value in network.environment().items()))
+    logging.info(f"SERVING {args.peers} FAKE PEERS, CTRL-C TO STOP")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        network.stop()
+
+if __name__=="__main__":
+    logging.basicConfig(level=logging.INFO)
+    main(sys.argv[1:])
@@ -0,0 +1,909 @@
+#! /bin/python
+
+"""
+Test IrohaUtils against the in-process fake network of fake_iroha.py, so no network or docker is needed
+This also checks the fake ledger validates transactions as the real network does in network_testing.py
+and malicious_client_testing.py, so it can stand in for it in tests and benchmarks
+
+Run with pytest -rA -v fake_iroha_testing.py
+"""
+from fake_iroha import *
+from async_iroha import async_connections, async_send_transaction, async_send_batch, async_get_block
+from block_archive import BlockArchiveWriter, BlockArchiveReader, archive_all_blocks
+from query_cache import QueryCache
+import asyncio
+import async_iroha
+import block_archive
+import IrohaUtils
+import pytest
+
+DOMAIN_ID = f"fake-{unique_suffix()}"
+ASSET_ID = f"coin#{DOMAIN_ID}"
+
+
+@pytest.fixture(name="network", scope="module")
+def network_fixture():
+    """Four fake peers with a domain, an asset and two users, alice funded with 10 and bob with none"""
+
+    with FakeNetwork(peers=4, commit_latency=0.02) as network:
+        registry = network.registry(send_timeout=1)
+        alice, bob = new_user("alice", DOMAIN_ID), new_user("bob", DOMAIN_ID)
+        tx = IrohaCrypto.sign_transaction(iroha_admin.transaction([
+            iroha_admin.command('CreateDomain', domain_id=DOMAIN_ID, default_role='user'),
+            iroha_admin.command('CreateAsset', asset_name='coin', domain_id=DOMAIN_ID, precision=2),
+            iroha_admin.command('CreateAccount', account_name='alice', domain_id=DOMAIN_ID, public_key=alice["public_key"]),
+            iroha_admin.command('CreateAccount', account_name='bob', domain_id=DOMAIN_ID, public_key=bob["public_key"]),
+        ]), ADMIN_PRIVATE_KEY)
+        assert send_transaction(tx, registry)[0] == "COMMITTED"
+        # Let admin reset the balances between tests
+        for user in (alice, bob):
+            tx = IrohaCrypto.sign_transaction(user["iroha"].transaction([
+                user["iroha"].command("GrantPermission", account_id=ADMIN_ACCOUNT_ID,
+                                      permission=primitive_pb2.can_transfer_my_assets)
+            ]), user["private_key"])
+            assert send_transaction(tx, registry)[0] == "COMMITTED"
+        network.alice, network.bob, network.connection = alice, bob, registry
+        yield network
+        registry.close()
+
+
+@pytest.fixture(autouse=True)
+def reset_fixture(network):
+    """Give alice 10 coin, bob none, and every peer back up"""
+
+    for peer in network.peers:
+        peer.down = False
+    status = reset_balances({network.alice["id"]: "10", network.bob["id"]: "0"}, ASSET_ID, network.connection)
+    assert status is None or status[0] == "COMMITTED"
+
+
+def transfer(sender, receiver, amount):
+    tx = sender["iroha"].transaction([
+        sender["iroha"].command('TransferAsset', src_account_id=sender["id"], dest_account_id=receiver["id"],
+                                asset_id=ASSET_ID, description='test', amount=amount)
+    ])
+    return IrohaCrypto.sign_transaction(tx, sender["private_key"])
+
+
+def balances(network):
+    return get_balances([network.alice["id"], network.bob["id"]], ASSET_ID, network.connection)
+
+
+def test_genesis(network):
+    """
+    Test the chain starts from the genesis block of the network, and blocks link
+    """
+
+    genesis = get_block(1, network.connection)
+    assert genesis.block_response.block.block_v1.payload.height == 1
+    height = get_chain_height(network.connection)
+    assert height >= 2
+    assert get_block(2, network.connection).block_response.block.block_v1.payload.prev_block_hash == block_hash(genesis)
+
+
+def test_transfer_committed(network):
+    """
+    Test a transfer is committed and moves the balance
+    """
+
+    assert send_transaction(transfer(network.alice, network.bob, "2.50"), network.connection)[0] == "COMMITTED"
+    assert balances(network) == {network.alice["id"]: decimal.Decimal("7.5"), network.bob["id"]: decimal.Decimal("2.5")}
+
+
+def test_invalid_transfers_rejected(network):
+    """
+    Test overdrawing, transferring another's assets, and a replayed transaction are not committed
+    """
+
+    assert send_transaction(transfer(network.alice, network.bob, "10.01"), network.connection)[0] == "REJECTED"
+    stolen = network.bob["iroha"].transaction([
+        network.bob["iroha"].command('TransferAsset', src_account_id=network.alice["id"],
+                                     dest_account_id=network.bob["id"], asset_id=ASSET_ID,
+                                     description='theft', amount="1")
+    ])
+    assert send_transaction(IrohaCrypto.sign_transaction(stolen, network.bob["private_key"]),
+                            network.connection)[0] == "REJECTED"
+    tx = transfer(network.alice, network.bob, "1")
+    assert send_transaction(tx, network.connection)[0] == "COMMITTED"
+    assert send_transaction(tx, network.connection)[0] == "COMMITTED"
+    assert balances(network)[network.bob["id"]] == 1
+
+
+def test_batch_and_submitter(network):
+    """
+    Test batches and the pipelined submitter commit every transaction across all peers
+    """
+
+    transactions = [transfer(network.alice, network.bob, "1") for _ in range(4)]
+    results = send_batch(transactions, network.connection)
+    assert [result[0] for result in results] == ["COMMITTED"] * 4
+    for transaction, result in zip(transactions, results):
+        # The final status first, as from send_transaction, with the hash and status timings alongside
+        status, status_code, error_code = result
+        assert result == (status, status_code, error_code)
+        assert result.hex_hash == binascii.hexlify(IrohaCrypto.hash(transaction)).decode()
+        assert "COMMITTED" in result.stage_times
+        assert list(result.stage_times.values()) == sorted(result.stage_times.values())
+        assert result.stage_times["COMMITTED"] == max(result.stage_times.values()) >= 0
+    assert send_batch([], None) == []
+    with TransactionSubmitter(network.connection.connections()) as submitter:
+        futures = submitter.submit_all([transfer(network.alice, network.bob, "0.5") for _ in range(4)])
+    assert [future.result()[0] for future in futures] == ["COMMITTED"] * 4
+    assert balances(network)[network.bob["id"]] == 6
+
+
+def test_submitter_window(network):
+    """
+    Test the submitter keeps no more than its window of transactions in flight to each peer
+    """
+
+    in_flight, most = {}, {}
+    lock = threading.Lock()
+    with TransactionSubmitter(network.connection.connections(), window=2) as submitter:
+        send_and_track = submitter._send_and_track
+
+        def counting_send_and_track(transaction, connection):
+            with lock:
+                in_flight[connection] = in_flight.get(connection, 0) + 1
+                most[connection] = max(most.get(connection, 0), in_flight[connection])
+            try:
+                return send_and_track(transaction, connection)
+            finally:
+                with lock:
+                    in_flight[connection] -= 1
+
+        submitter._send_and_track = counting_send_and_track
+        futures = submitter.submit_all([transfer(network.alice, network.bob, "0.1") for _ in range(16)])
+    assert [future.result()[0] for future in futures] == ["COMMITTED"] * 16
+    assert sorted(most.values()) == [2] * len(network.peers)
+
+
+def test_submitter_callback_on_failure(network):
+    """
+    Test the callback of a transaction that fails to send is called with the failed future
+    """
+
+    network.peers[0].down = True
+    connection = network.connection.connections()[0]
+    called = []
+    with TransactionSubmitter([connection]) as submitter:
+        future = submitter.submit(transfer(network.alice, network.bob, "1"), callback=called.append)
+        with pytest.raises(grpc.RpcError):
+            future.result()
+    assert called == [future]
+    assert isinstance(future.exception(), grpc.RpcError)
+
+
+def test_submitter_close_drains(network):
+    """
+    Test closing the submitter, or leaving its with block, waits for every transaction in flight
+    """
+
+    with TransactionSubmitter(network.connection.connections(), window=1) as submitter:
+        futures = submitter.submit_all([transfer(network.alice, network.bob, "0.1") for _ in range(8)])
+    assert all(future.done() for future in futures)
+    assert [future.result()[0] for future in futures] == ["COMMITTED"] * 8
+
+    submitter = TransactionSubmitter(network.connection.connections())
+    futures = submitter.submit_all([transfer(network.alice, network.bob, "0.1") for _ in range(4)])
+    submitter.close()
+    assert all(future.done() for future in futures)
+    with pytest.raises(RuntimeError):
+        submitter.submit(transfer(network.alice, network.bob, "0.1"))
+    assert balances(network)[network.bob["id"]] == decimal.Decimal("1.2")
+
+
+def test_atomic_batch_rejected_whole(network):
+    """
+    Test an atomic batch with one failing transaction commits none of them
+    """
+
+    transactions = [network.alice["iroha"].transaction([
+        network.alice["iroha"].command('TransferAsset', src_account_id=network.alice["id"],
+                                       dest_account_id=network.bob["id"], asset_id=ASSET_ID,
+                                       description='batch', amount=amount)
+    ]) for amount in ("4", "7")]
+    iroha.batch(transactions, atomic=True)
+    for tx in transactions:
+        IrohaCrypto.sign_transaction(tx, network.alice["private_key"])
+    network.connection.send_txs(transactions)
+    statuses = [status[0] for status in
+                (list(network.connection.tx_status_stream(tx))[-1] for tx in transactions)]
+    assert statuses == ["REJECTED", "REJECTED"]
+    assert balances(network)[network.alice["id"]] == 10
+
+
+def test_async_api(network, monkeypatch):
+    """
+    Test transactions, batches and block queries over asyncio channels, with many in flight on one event loop
+    """
+
+    monkeypatch.setattr(async_iroha, "peers", network.connection)
+    height = get_chain_height(network.connection)
+
+    async def run():
+        connections = async_connections(timeout=5)
+        try:
+            assert [connection._address for connection in connections] == \
+                [connection.address for connection in network.connection.connections()]
+            status = await async_send_transaction(transfer(network.alice, network.bob, "1"), connections[0])
+            assert status[0] == "COMMITTED"
+            statuses = await async_send_batch([transfer(network.alice, network.bob, "1") for _ in range(3)],
+                                              connections[1])
+            assert [status[0] for status in statuses] == ["COMMITTED"] * 3
+            assert await async_send_batch([], connections[1]) == []
+            # Concurrent sends from one loop, each to its own peer
+            statuses = await asyncio.gather(*(async_send_transaction(transfer(network.alice, network.bob, "1"),
+                                                                     connection) for connection in connections))
+            assert [status[0] for status in statuses] == ["COMMITTED"] * len(connections)
+            rejected = await async_send_transaction(transfer(network.alice, network.bob, "100"), connections[2])
+            assert rejected[0] == "REJECTED"
+
+            blocks = await asyncio.gather(*(async_get_block(h, connections[h % len(connections)])
+                                            for h in range(1, height + 1)))
+            assert [block.block_response.block for block in blocks] == network.ledger.blocks[:height]
+            missing = await async_get_block(network.ledger.height + 1, connections[0])
+            assert missing.HasField("error_response")
+            assert (await connections[0].tx_status(transfer(network.bob, network.alice, "1")))[0] == "NOT_RECEIVED"
+        finally:
+            for connection in connections:
+                await connection.close()
+
+    asyncio.run(run())
+    sent = 4 + len(network.peers)
+    assert balances(network) == {network.alice["id"]: 10 - sent, network.bob["id"]: sent}
+
+
+def commit_block(ledger):
+    """Commit a block of one admin transaction to a ledger that commits on demand"""
+
+    ledger.receive([IrohaCrypto.sign_transaction(iroha_admin.transaction([
+        iroha_admin.command('AddAssetQuantity', asset_id='coin#test', amount="1")
+    ], created_time=Iroha.now() + ledger.height), ADMIN_PRIVATE_KEY)])
+    return ledger.commit_round()
+
+
+def fork(blocks, height):
+    """A copy of a chain that holds different blocks from height on, each linked to the block before it"""
+
+    forked = []
+    for block in blocks:
+        block = block_pb2.Block.FromString(block.SerializeToString())
+        payload = block.block_v1.payload
+        if payload.height >= height:
+            payload.created_time += 1
+            payload.prev_block_hash = binascii.hexlify(IrohaCrypto.hash(forked[-1].block_v1)).decode()
+        forked.append(block)
+    return forked
+
+
+def test_add_peer_rolled_back():
+    """
+    Test a peer added by a transaction that is rejected is not kept
+    """
+
+    ledger = FakeLedger(commit_latency=None)
+    peers_query = IrohaCrypto.sign_query(iroha_admin.query("GetPeers"), ADMIN_PRIVATE_KEY)
+    genesis_peers = list(ledger.query(peers_query).peers_response.peers)
+    peer = primitive_pb2.Peer(address="127.0.0.1:10001", peer_key="ab" * 32)
+    ledger.receive([IrohaCrypto.sign_transaction(iroha_admin.transaction([
+        iroha_admin.command('AddPeer', peer=peer),
+        iroha_admin.command('AddAssetQuantity', asset_id='missing#test', amount="1"),
+    ]), ADMIN_PRIVATE_KEY)])
+    ledger.commit_round()
+    assert list(ledger.query(peers_query).peers_response.peers) == genesis_peers
+
+    ledger.receive([IrohaCrypto.sign_transaction(iroha_admin.transaction([
+        iroha_admin.command('AddPeer', peer=peer)
+    ]), ADMIN_PRIVATE_KEY)])
+    ledger.commit_round()
+    assert list(ledger.query(peers_query).peers_response.peers) == genesis_peers + [peer]
+
+
+def test_chain_height_and_iter_blocks():
+    """
+    Test the chain height is found exactly at and around powers of two, starting from the genesis block alone,
+    and blocks are iterated in order however the range is chunked
+    """
+
+    with FakeNetwork(peers=2, commit_latency=None) as network:
+        registry = network.registry()
+        try:
+            # The genesis block alone
+            assert get_chain_height(registry) == 1
+            assert [block.block_response.block.block_v1.payload.height
+                    for block in iter_blocks(1, 1, registry.connections())] == [1]
+            for height in range(2, 18):
+                commit_block(network.ledger)
+                assert network.ledger.height == height
+                assert get_chain_height(registry) == height
+
+            for chunk_size, max_workers in [(1, 1), (3, 2), (16, 8), (32, 8)]:
+                blocks = list(iter_blocks(1, 17, registry.connections(), max_workers, chunk_size))
+                assert [block.block_response.block.block_v1.payload.height for block in blocks] == list(range(1, 18))
+                assert [block.block_response.block for block in blocks] == network.ledger.blocks
+            assert list(iter_blocks(5, 4, registry.connections())) == []
+            assert [block.block_response.block.block_v1.payload.height
+                    for block in iter_blocks(16, 17, registry.connections(), chunk_size=1)] == [16, 17]
+            with pytest.raises(RuntimeError):
+                list(iter_blocks(15, 18, registry.connections(), chunk_size=2))
+        finally:
+            registry.close()
+
+
+@pytest.mark.parametrize("compress", [False, True])
+def test_block_archive(network, tmp_path, compress):
+    """
+    Test an archive reads back every block it was given, whole or over a range, compressed or not
+    """
+
+    height = get_chain_height(network.connection)
+    blocks = [block.block_response.block for block in iter_blocks(1, height, [network.connection])]
+    path = tmp_path / "node1.blocks"
+    with BlockArchiveWriter(path, compress=compress, segment_size=2) as archive:
+        for block in blocks:
+            archive.append(block)
+        with pytest.raises(ValueError):
+            archive.append(blocks[0])
+
+    with BlockArchiveReader(path) as archive:
+        assert (archive.first_height, archive.last_height, len(archive)) == (1, height, height)
+        assert list(archive.iter_blocks()) == blocks
+        assert archive.get_block_bytes(height) == blocks[-1].SerializeToString()
+        # Ranges that start and end inside a segment
+        assert list(archive.iter_blocks(2, height - 1)) == blocks[1:-1]
+        assert [block.block_v1.payload.height for block in archive.iter_blocks(height, height)] == [height]
+        for missing in (0, height + 1):
+            with pytest.raises(IndexError):
+                archive.get_block(missing)
+
+
+def test_archive_all_blocks_appends(network, tmp_path):
+    """
+    Test archiving again appends only the blocks committed since, and refuses blocks of another chain
+    """
+
+    archive_all_blocks(network.connection, "node1.blocks", str(tmp_path), compress=True)
+    height = get_chain_height(network.connection)
+    assert send_transaction(transfer(network.alice, network.bob, "1"), network.connection)[0] == "COMMITTED"
+    archive_all_blocks(network.connection, "node1.blocks", str(tmp_path), compress=True)
+    with BlockArchiveReader(tmp_path / "node1.blocks") as archive:
+        assert archive.last_height == get_chain_height(network.connection) > height
+        assert [block.block_v1.payload.height for block in archive.iter_blocks()] == \
+            list(range(1, archive.last_height + 1))
+        assert archive.get_block(archive.last_height) == get_block(archive.last_height, network.connection) \
+            .block_response.block
+
+    # A reopened writer continues from the last height, and a block that does not link onto it is refused
+    with BlockArchiveWriter(tmp_path / "other.blocks") as archive:
+        archive.append(get_block(1, network.connection))
+    with BlockArchiveWriter(tmp_path / "other.blocks") as archive:
+        assert archive.next_height == 2
+        block = get_block(2, network.connection)
+        block.block_response.block.block_v1.payload.prev_block_hash = "00" * 32
+        archive.append(block)
+    with pytest.raises(ChainMismatchError):
+        archive_all_blocks(network.connection, "other.blocks", str(tmp_path))
+
+
+def test_archive_index_rebuilt(network, tmp_path):
+    """
+    Test a missing, stale or part written index is rebuilt from the data, and a foreign index is refused
+    """
+
+    path = tmp_path / "node1.blocks"
+    index_path = tmp_path / "node1.blocks.index"
+    archive_all_blocks(network.connection, "node1.blocks", str(tmp_path), compress=True)
+    index = index_path.read_bytes()
+
+    def archived_heights():
+        with BlockArchiveReader(path) as archive:
+            return [block.block_v1.payload.height for block in archive.iter_blocks()]
+
+    # A lost index is written again as it was
+    index_path.unlink()
+    archive_all_blocks(network.connection, "node1.blocks", str(tmp_path), compress=True)
+    assert index_path.read_bytes() == index
+
+    # An index behind the data, as after a crash between writing the two, and a record written in part
+    for stale in (index[:-block_archive._INDEX_RECORD.size], index[:-3]):
+        index_path.write_bytes(stale)
+        with BlockArchiveWriter(path) as archive:
+            assert archive.next_height == get_chain_height(network.connection) + 1
+        assert index_path.read_bytes() == index
+
+    # A segment cut short at the end of the data is dropped, and the blocks after it are appended
+    with open(path, "ab") as f:
+        f.write(block_archive._SEGMENT_HEADER.pack(1, 1000) + b"partial")
+    assert send_transaction(transfer(network.alice, network.bob, "1"), network.connection)[0] == "COMMITTED"
+    archive_all_blocks(network.connection, "node1.blocks", str(tmp_path), compress=True)
+    assert archived_heights() == list(range(1, get_chain_height(network.connection) + 1))
+
+    index_path.write_bytes(b"XXXX" + index[4:])
+    with pytest.raises(ValueError):
+        BlockArchiveWriter(path)
+    with pytest.raises(ValueError):
+        archive_all_blocks(network.connection, "node1.blocks", str(tmp_path))
+
+
+def test_check_chain_consistency():
+    """
+    Test nodes holding the same chain are consistent whatever their heights, and the first height at which
+    diverging chains differ is found, wherever it is
+    """
+
+    with FakeNetwork(peers=1, commit_latency=None) as first, FakeNetwork(peers=1, commit_latency=None) as second, \
+            FakeNetwork(peers=1, commit_latency=None) as third:
+        for _ in range(8):
+            commit_block(first.ledger)
+        blocks = first.ledger.blocks
+        registries = [network.registry() for network in (first, second, third)]
+        try:
+            # The same chain, one node behind
+            second.ledger.blocks = list(blocks)
+            third.ledger.blocks = blocks[:7]
+            report = check_chain_consistency(registries)
+            assert report.consistent
+            assert report.heights == {"node1": 9, "node2": 9, "node3": 7}
+            assert (report.common_height, report.first_divergent_height, report.hashes) == (7, None, {})
+
+            for height in range(2, 10):
+                second.ledger.blocks = fork(blocks, height)
+                report = check_chain_consistency(registries[:2], names=["a", "b"])
+                assert not report.consistent
+                assert report.first_divergent_height == height
+                assert report.hashes == {block_hash(get_block(height, registries[0])): ["a"],
+                                         block_hash(get_block(height, registries[1])): ["b"]}
+
+            # Only the nodes on the other side of the divergence are grouped apart
+            second.ledger.blocks = fork(blocks, 4)
+            report = check_chain_consistency(registries)
+            assert (report.common_height, report.first_divergent_height) == (7, 4)
+            assert sorted(report.hashes.values()) == [["node1", "node3"], ["node2"]]
+        finally:
+            for registry in registries:
+                registry.close()
+
+
+def test_keystore(tmp_path, monkeypatch):
+    """
+    Test a keystore saves the keypairs it generates, and a keystore loaded from the file only generates new users
+    """
+
+    path = tmp_path / "keys" / "keystore.json"
+    keystore = Keystore(str(path))
+    users = keystore.users("keys", 3)
+    assert [user["id"] for user in users] == ["user0@keys", "user1@keys", "user2@keys"]
+    for user in users:
+        assert IrohaCrypto.derive_public_key(user["private_key"]).decode() == user["public_key"]
+
+    generated = []
+    monkeypatch.setattr(IrohaUtils, "generate_keypairs",
+                        lambda count, executor=None: generated.append(count) or IrohaUtils._generate_keypairs(count))
+    reloaded = Keystore(str(path))
+    assert len(reloaded) == 3 and "user2@keys" in reloaded
+    assert [(user["private_key"], user["public_key"]) for user in reloaded.users("keys", 3)] == \
+        [(user["private_key"], user["public_key"]) for user in users]
+    assert len(reloaded.users("keys", 5)) == 5
+    assert generated == [2]
+    assert len(Keystore(str(path))) == 5
+    assert len(Keystore().users("keys", 2)) == 2
+
+
+def test_pack_and_send_at_limits(network, monkeypatch):
+    """
+    Test commands are packed at most ACCOUNTS_PER_TRANSACTION to a transaction, and sent at most
+    TRANSACTIONS_PER_BATCH to a batch, spread over the peers
+    """
+
+    commands = [iroha_admin.command('AddAssetQuantity', asset_id=ASSET_ID, amount="1")
+                for _ in range(2 * ACCOUNTS_PER_TRANSACTION + 1)]
+    assert [len(tx.payload.reduced_payload.commands) for tx in pack_transactions(commands)] == \
+        [ACCOUNTS_PER_TRANSACTION, ACCOUNTS_PER_TRANSACTION, 1]
+    assert [len(tx.payload.reduced_payload.commands)
+            for tx in pack_transactions(commands[:ACCOUNTS_PER_TRANSACTION])] == [ACCOUNTS_PER_TRANSACTION]
+    assert pack_transactions([]) == []
+
+    batches = []
+    send_batch = IrohaUtils.send_batch
+    monkeypatch.setattr(IrohaUtils, "send_batch",
+                        lambda transactions, connection: batches.append((len(transactions), connection.name))
+                        or send_batch(transactions, connection))
+    transactions = pack_transactions(commands[:2 * TRANSACTIONS_PER_BATCH + 1], commands_per_transaction=1)
+    sign_transactions(transactions, ADMIN_PRIVATE_KEY)
+    results = send_packed(transactions, network.connection)
+    assert [result.status for result in results] == ["COMMITTED"] * len(transactions)
+    assert sorted(size for size, _ in batches) == [1, TRANSACTIONS_PER_BATCH, TRANSACTIONS_PER_BATCH]
+    assert len({name for _, name in batches}) == 3
+    assert send_packed([], network.connection) == []
+
+    # A transaction that is not committed fails the whole send
+    transactions = pack_transactions([iroha_admin.command(
+        'TransferAsset', src_account_id=network.alice["id"], dest_account_id=network.bob["id"], asset_id=ASSET_ID,
+        description='overdraft', amount="1000")])
+    sign_transactions(transactions, ADMIN_PRIVATE_KEY)
+    with pytest.raises(RuntimeError):
+        send_packed(transactions, network.connection)
+
+
+def test_provision_accounts(network, tmp_path):
+    """
+    Test more accounts than fit in one transaction are all created, with the keypairs kept in the keystore
+    """
+
+    count = ACCOUNTS_PER_TRANSACTION + 1
+    keystore = Keystore(str(tmp_path / "keystore.json"))
+    prefix = f"bulk{unique_suffix()}"
+    users = provision_accounts(DOMAIN_ID, count, keystore, network.connection, prefix=prefix)
+    assert len(users) == count and len(Keystore(keystore.path)) == count
+    for user in (users[0], users[-1]):
+        query = IrohaCrypto.sign_query(iroha_admin.query('GetAccount', account_id=user["id"]), ADMIN_PRIVATE_KEY)
+        assert network.connection.send_query(query).account_response.account.account_id == user["id"]
+
+    # Provisioning the same accounts again fails, as they exist
+    with pytest.raises(RuntimeError):
+        provision_accounts(DOMAIN_ID, 1, keystore, network.connection, prefix=prefix)
+
+
+def test_failover(network):
+    """
+    Test transactions and queries fail over from a peer that is down or failing
+    """
+
+    network.peers[0].down = True
+    network.peers[1].fail_next(2)
+    for _ in range(4):
+        assert send_transaction(transfer(network.alice, network.bob, "1"), network.connection)[0] == "COMMITTED"
+    assert balances(network)[network.bob["id"]] == 4
+
+
+def admin_transaction(amount):
+    return IrohaCrypto.sign_transaction(iroha_admin.transaction([
+        iroha_admin.command('AddAssetQuantity', asset_id='coin#test', amount=amount)
+    ]), ADMIN_PRIVATE_KEY)
+
+
+def test_status_stream_resumed_without_repeats():
+    """
+    Test a registry's status stream waits its timeout for each status rather than for the whole stream,
+    and resumes on another peer when a peer stops sending, without yielding a status twice
+    """
+
+    with FakeNetwork(peers=2, commit_latency=None) as network:
+        registry = network.registry(send_timeout=1)
+        try:
+            tx = admin_transaction("1")
+            registry.send_tx(tx)
+            statuses = registry.tx_status_stream(tx, timeout=0.5)
+            names = [next(statuses)[0], next(statuses)[0]]
+            # Time the caller spends between statuses does not count against the timeout
+            time.sleep(0.7)
+            network.ledger.commit_round()
+            names += [status[0] for status in statuses]
+            assert names == ["STATELESS_VALIDATION_SUCCESS", "ENOUGH_SIGNATURES_COLLECTED",
+                             "STATEFUL_VALIDATION_SUCCESS", "COMMITTED"]
+            assert all(connection.healthy for connection in registry.connections())
+
+            tx = admin_transaction("2")
+            registry.send_tx(tx)
+            statuses = registry.tx_status_stream(tx, timeout=0.5)
+            names = [next(statuses)[0], next(statuses)[0]]
+            streaming = next(connection for connection in registry.connections() if connection.outstanding)
+            next(peer for peer in network.peers if peer.address == streaming.address).stalled = True
+            network.ledger.commit_round()
+            start = time.monotonic()
+            names += [status[0] for status in statuses]
+            assert names == ["STATELESS_VALIDATION_SUCCESS", "ENOUGH_SIGNATURES_COLLECTED",
+                             "STATEFUL_VALIDATION_SUCCESS", "COMMITTED"]
+            assert time.monotonic() - start < 2
+            assert [connection.healthy for connection in registry.connections()] == \
+                [connection is not streaming for connection in registry.connections()]
+        finally:
+            registry.close()
+
+
+def test_status_stream_not_sent(network):
+    """
+    Test streaming the status of a transaction the registry never sent does not send it, even across a failover
+    """
+
+    tx = transfer(network.alice, network.bob, "1")
+    for peer in network.peers[:-1]:
+        peer.down = True
+    statuses = list(network.connection.tx_status_stream(tx))
+    assert statuses[-1][0] == "NOT_RECEIVED"
+    for peer in network.peers:
+        peer.down = False
+    assert balances(network)[network.bob["id"]] == 0
+
+
+def test_hedged_query_samples(network):
+    """
+    Test a query cancelled because it was hedged is not counted as a latency sample of its peer
+    """
+
+    slow, fast = network.connection.connections()[:2]
+    network.peers[0].rpc_latency = 0.5
+    try:
+        samples = len(slow._latencies)
+        query = IrohaCrypto.sign_query(iroha_admin.query('GetAccount', account_id=ADMIN_ACCOUNT_ID), ADMIN_PRIVATE_KEY)
+        call = slow.send_query_future(query)
+        time.sleep(0.1)
+        call.cancel()
+        assert fast.send_query_future(query).result().HasField("account_response")
+        deadline = time.monotonic() + 5
+        while slow.outstanding and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert slow.outstanding == 0
+        assert len(slow._latencies) == samples
+    finally:
+        network.peers[0].rpc_latency = 0.0
+
+
+def test_query_cache(network):
+    """
+    Test repeated reads are answered locally, and dropped when this or another client commits a block
+    """
+
+    with QueryCache(network.connection) as cache:
+        # The first read subscribes to blocks, and nothing is cached until the subscription is up
+        assert get_balances([network.alice["id"]], ASSET_ID, cache)[network.alice["id"]] == 10
+        deadline = time.monotonic() + 5
+        while cache.height is None and time.monotonic() < deadline:
+            time.sleep(0.01)
+        for _ in range(3):
+            assert get_balances([network.alice["id"]], ASSET_ID, cache)[network.alice["id"]] == 10
+        assert cache.hits == 2
+
+        # Committed by this client, so dropped before the status stream ends
+        assert send_transaction(transfer(network.alice, network.bob, "1"), cache)[0] == "COMMITTED"
+        assert get_balances([network.alice["id"]], ASSET_ID, cache)[network.alice["id"]] == 9
+
+        # Committed behind the back of the client, so dropped when the block is streamed
+        height = cache.height
+        network.ledger.receive([transfer(network.alice, network.bob, "1")])
+        while cache.height == height and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert cache.height > height
+        assert get_balances([network.alice["id"]], ASSET_ID, cache)[network.alice["id"]] == 8
+
+
+def test_query_cache_per_creator(network):
+    """
+    Test a response cached for one account is not given to a query of another account
+    """
+
+    with QueryCache(network.connection) as cache:
+        def get_account(user):
+            query = user["iroha"].query("GetAccount", account_id=ADMIN_ACCOUNT_ID)
+            IrohaCrypto.sign_query(query, user["private_key"])
+            return cache.send_query(query)
+
+        admin = {"iroha": iroha_admin, "private_key": ADMIN_PRIVATE_KEY}
+        get_account(admin)
+        deadline = time.monotonic() + 5
+        while cache.height is None and time.monotonic() < deadline:
+            time.sleep(0.01)
+        get_account(admin)
+        get_account(admin)
+        assert cache.hits == 1
+        get_account(network.alice)
+        assert cache.hits == 1
+        get_account(network.alice)
+        assert cache.hits == 2
+
+
+def test_block_subscriber(network):
+    """
+    Test blocks are delivered in order, once each, from the start of the chain and across a resubscription
+    """
+
+    blocks = []
+    subscriber = BlockSubscriber(network.connection, [blocks.append], from_height=1)
+    subscriber.RESUBSCRIBE_DELAY = 0.05
+    with subscriber:
+        assert subscriber.wait_for(get_chain_height(network.connection), 5)
+
+        # Blocks committed while no peer answers are backfilled once the stream is back
+        for peer in network.peers:
+            peer.down = True
+        deadline = time.monotonic() + 5
+        while subscriber.live and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert not subscriber.live
+        height = network.ledger.height
+        network.ledger.receive([transfer(network.alice, network.bob, "1")])
+        while network.ledger.height == height and time.monotonic() < deadline:
+            time.sleep(0.01)
+        for peer in network.peers:
+            peer.down = False
+        assert subscriber.wait_for(network.ledger.height, 10)
+
+        # And new blocks are pushed as they commit
+        assert send_transaction(transfer(network.alice, network.bob, "1"), network.connection)[0] == "COMMITTED"
+        assert subscriber.wait_for(network.ledger.height, 5)
+    heights = [block.block_response.block.block_v1.payload.height for block in blocks]
+    assert heights == list(range(1, network.ledger.height + 1))
+
+
+def test_block_subscriber_handler_failure(network):
+    """
+    Test a failing handler stops the subscriber at the block before, and wait_for raises its error
+    """
+
+    heights = []
+
+    def handler(block):
+        height = block.block_response.block.block_v1.payload.height
+        if height == 2:
+            raise ValueError("handler failed")
+        heights.append(height)
+
+    subscriber = BlockSubscriber(network.connection, [handler], from_height=1)
+    with subscriber:
+        with pytest.raises(ValueError):
+            subscriber.wait_for(2, 5)
+        assert subscriber.height == 1
+        assert isinstance(subscriber.error, ValueError)
+        assert subscriber.wait_for(1, 5)
+    assert heights == [1]
+
+
+def test_block_subscriber_stop_before_subscribing(network):
+    """
+    Test stopping a subscriber as it is about to subscribe opens no stream, so stop does not hang
+    """
+
+    opened = []
+
+    class Peers:
+        def select(self):
+            # Hold the subscriber between choosing a peer and subscribing until stop has been called
+            subscriber._stop.wait()
+            return self
+
+        def fetch_commits(self, query):
+            opened.append(query)
+            return network.connection.fetch_commits(query)
+
+    subscriber = BlockSubscriber(Peers())
+    subscriber.start()
+    stopping = threading.Thread(target=subscriber.stop)
+    stopping.start()
+    stopping.join(5)
+    assert not stopping.is_alive()
+    assert opened == []
+
+
+def test_paginated_iterators(network):
+    """
+    Test the paginated iterators read every asset and transaction once, in order, whatever the page size
+    """
+
+    domain_id = f"pages-{unique_suffix()}"
+    asset_ids = [f"asset{i}#{domain_id}" for i in range(5)]
+    tx = IrohaCrypto.sign_transaction(iroha_admin.transaction(
+        [iroha_admin.command('CreateDomain', domain_id=domain_id, default_role='user')] +
+        [iroha_admin.command('CreateAsset', asset_name=f"asset{i}", domain_id=domain_id, precision=0) for i in range(5)] +
+        [iroha_admin.command('AddAssetQuantity', asset_id=asset_id, amount="1") for asset_id in asset_ids]
+    ), ADMIN_PRIVATE_KEY)
+    assert send_transaction(tx, network.connection)[0] == "COMMITTED"
+    transactions = [transfer(network.alice, network.bob, "0.01") for _ in range(7)]
+    assert [result[0] for result in send_batch(transactions, network.connection)] == ["COMMITTED"] * 7
+
+    for page_size in (1, 2, 100):
+        held = [asset.asset_id for asset in iter_account_assets(ADMIN_ACCOUNT_ID, network.connection, page_size)]
+        assert [asset_id for asset_id in held if asset_id.endswith(domain_id)] == asset_ids
+        assert len(held) == len(set(held))
+
+    hashes = {IrohaCrypto.hash(tx) for tx in transactions}
+    sent = [tx for tx in iter_account_transactions(network.alice["id"], network.connection, 3)
+            if IrohaCrypto.hash(tx) in hashes]
+    assert len(sent) == 7
+    moved = list(iter_account_asset_transactions(network.bob["id"], ASSET_ID, network.connection, 2, prefetch=False))
+    assert hashes <= {IrohaCrypto.hash(tx) for tx in moved}
+
+    # Stopping early leaves no page query behind
+    pages = iter_account_transactions(network.alice["id"], network.connection, 1)
+    assert next(pages) is not None
+    pages.close()
+
+
+def test_page_size_below_one_refused(network):
+    """
+    Test a page size below 1 is refused as stateless invalid, rather than paging without end
+    """
+
+    for name, kwargs in [("GetAccountTransactions", {"account_id": network.alice["id"]}),
+                         ("GetAccountAssetTransactions", {"account_id": network.alice["id"], "asset_id": ASSET_ID})]:
+        query = IrohaCrypto.sign_query(iroha_admin.query(name, page_size=0, **kwargs), ADMIN_PRIVATE_KEY)
+        assert network.ledger.query(query).error_response.reason == qry_responses_pb2.ErrorResponse.STATELESS_INVALID
+    query = iroha_admin.query("GetAccountAssets", account_id=ADMIN_ACCOUNT_ID)
+    query.payload.get_account_assets.pagination_meta.page_size = 0
+    IrohaCrypto.sign_query(query, ADMIN_PRIVATE_KEY)
+    assert network.ledger.query(query).error_response.reason == qry_responses_pb2.ErrorResponse.STATELESS_INVALID
+
+    for pages in (iter_account_assets(ADMIN_ACCOUNT_ID, network.connection, 0),
+                  iter_account_transactions(network.alice["id"], network.connection, 0)):
+        with pytest.raises(RuntimeError):
+            next(pages)
+
+
+def transfer_command(sender, receiver, amount):
+    return sender["iroha"].command('TransferAsset', src_account_id=sender["id"], dest_account_id=receiver["id"],
+                                   asset_id=ASSET_ID, description='coalesced', amount=amount)
+
+
+def test_command_coalescer(network):
+    """
+    Test commands are packed into transactions per creator and batches of one proposal, sent when full or due
+    """
+
+    first_height = network.ledger.height
+    with CommandCoalescer(network.connection, max_proposal_size=3, commands_per_transaction=2,
+                          max_delay=0.05) as coalescer:
+        futures = [coalescer.submit(transfer_command(network.alice, network.bob, "0.5"),
+                                    network.alice["iroha"], network.alice["private_key"]) for _ in range(5)]
+        futures += [coalescer.submit(transfer_command(network.bob, network.alice, "20"),
+                                     network.bob["iroha"], network.bob["private_key"])]
+        assert [future.result()[0] for future in futures] == ["COMMITTED"] * 5 + ["REJECTED"]
+        # Sent once due, without filling a batch
+        assert coalescer.submit(transfer_command(network.alice, network.bob, "1"),
+                                network.alice["iroha"], network.alice["private_key"]).result(5)[0] == "COMMITTED"
+    assert balances(network)[network.bob["id"]] == decimal.Decimal("3.5")
+
+    transactions = [tx for block in network.ledger.blocks[first_height:] for tx in block.block_v1.payload.transactions]
+    assert [len(tx.payload.reduced_payload.commands) for tx in transactions] == [2, 2, 1, 1]
+    assert all(len(block.block_v1.payload.transactions) <= 3 for block in network.ledger.blocks[first_height:])
+
+
+def test_command_coalescer_atomic(network):
+    """
+    Test a failing command of an atomic batch rejects every command coalesced with it
+    """
+
+    with CommandCoalescer(network.connection, commands_per_transaction=1, atomic=True) as coalescer:
+        futures = [coalescer.submit(transfer_command(network.alice, network.bob, "1"),
+                                    network.alice["iroha"], network.alice["private_key"]),
+                   coalescer.submit(transfer_command(network.bob, network.alice, "2"),
+                                    network.bob["iroha"], network.bob["private_key"])]
+    assert [future.result()[0] for future in futures] == ["REJECTED", "REJECTED"]
+    assert balances(network)[network.alice["id"]] == 10
+
+
+def test_log_all_blocks(network, tmp_path):
+    """
+    Test a full log keeps no sync state, and an incremental log appends only new blocks in its own format,
+    one JSON block per line unless text is asked for
+    """
+
+    logs = str(tmp_path)
+    log_all_blocks(network.connection, "node1.log", logs, block_format="text")
+    height = get_chain_height(network.connection)
+    assert (tmp_path / "node1.log").read_text().count("block_v1 {") == height
+    assert not (tmp_path / "node1.log.sync").exists()
+
+    log_all_blocks(network.connection, "node1.jsonl", logs, incremental=True)
+    assert json.loads((tmp_path / "node1.jsonl.sync").read_text())["height"] == height
+    assert send_transaction(transfer(network.alice, network.bob, "1"), network.connection)[0] == "COMMITTED"
+    log_all_blocks(network.connection, "node1.jsonl", logs, incremental=True)
+    lines = (tmp_path / "node1.jsonl").read_text().splitlines()
+    assert [int(json.loads(line)["blockV1"]["payload"]["height"]) for line in lines] == \
+        list(range(1, get_chain_height(network.connection) + 1))
+
+    # Appending another format to the log is refused, and leaves it as it was
+    with pytest.raises(ValueError):
+        log_all_blocks(network.connection, "node1.jsonl", logs, incremental=True, block_format="text")
+    assert (tmp_path / "node1.jsonl").read_text().splitlines() == lines
+
+    # A full rewrite drops the sync state, which no longer describes the log
+    log_all_blocks(network.connection, "node1.jsonl", logs)
+    assert not (tmp_path / "node1.jsonl.sync").exists()
+
+    # A log synced with a chain the node no longer holds is refused
+    log_all_blocks(network.connection, "node2.jsonl", logs, incremental=True)
+    state = json.loads((tmp_path / "node2.jsonl.sync").read_text())
+    state["hash"] = "00" * 32
+    (tmp_path / "node2.jsonl.sync").write_text(json.dumps(state))
+    with pytest.raises(ChainMismatchError):
+        log_all_blocks(network.connection, "node2.jsonl", logs, incremental=True)
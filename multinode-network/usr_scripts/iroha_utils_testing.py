@@ -0,0 +1,245 @@
+#! /bin/python
+
+"""
+Unit tests of the parts of IrohaUtils.py and profiling.py that need no peers
+
+Run with pytest -rA -v iroha_utils_testing.py
+"""
+from IrohaUtils import *
+from profiling import Profiler, LatencyHistogram, StageLatencyRecorder
+import asyncio
+import inspect
+import pytest
+
+
+def histogram_of(microseconds):
+    histogram = LatencyHistogram()
+    for value in microseconds:
+        histogram.record(value * LatencyHistogram.UNIT)
+    return histogram
+
+
+def test_histogram_percentile_nearest_rank():
+    """
+    Test percentiles are the smallest value with at least that share of values at or below it
+    """
+
+    histogram = histogram_of(range(1, 11))
+    assert histogram.percentile(0) == pytest.approx(1e-6)
+    assert histogram.percentile(10) == pytest.approx(1e-6)
+    assert histogram.percentile(11) == pytest.approx(2e-6)
+    assert histogram.percentile(50) == pytest.approx(5e-6)
+    assert histogram.percentile(85) == pytest.approx(9e-6)
+    assert histogram.percentile(100) == pytest.approx(10e-6)
+    assert histogram_of(range(1, 1001)).percentile(99.9) == pytest.approx(999e-6, rel=1 / 64)
+    assert LatencyHistogram().percentile(50) is None
+
+
+def test_histogram_relative_error():
+    """
+    Test large values land in buckets within the relative error of the histogram, and the extremes are exact
+    """
+
+    values = [200, 1234, 98765, 1234567, 60 * 10 ** 6]
+    histogram = histogram_of(values)
+    bound = 1 / 2 ** (LatencyHistogram.SUB_BUCKET_BITS - 1)
+    for i, value in enumerate(values):
+        assert histogram.percentile((i + 1) / len(values) * 100) == pytest.approx(value * 1e-6, rel=bound)
+    assert (histogram.min, histogram.max, histogram.count) == (200, 60 * 10 ** 6, 5)
+    assert histogram.mean == pytest.approx(sum(values) / len(values) * 1e-6)
+    for value in values:
+        low, high = LatencyHistogram._bounds(LatencyHistogram._index(value))
+        assert low <= value <= high
+
+
+def test_histogram_merge_and_export():
+    """
+    Test merging two histograms gives the same counts as recording every value in one
+    """
+
+    merged = histogram_of(range(1, 500, 2))
+    merged.merge(histogram_of(range(2, 501, 2)))
+    merged.merge(LatencyHistogram())
+    assert merged.to_dict() == histogram_of(range(1, 501)).to_dict()
+    summary = merged.to_dict()
+    assert summary["count"] == 500
+    assert sum(summary["buckets"].values()) == 500
+    assert summary["min"] == pytest.approx(1e-6) and summary["max"] == pytest.approx(500e-6)
+
+
+def test_stage_recorder():
+    """
+    Test the time to reach each status is recorded per stage and per peer, with the total since sending
+    """
+
+    recorder = StageLatencyRecorder()
+    start = time.monotonic()
+    recorder.sent(b"tx1")
+    recorder.sent(b"tx1")
+    recorder.record(b"tx1", "node1", [("ENOUGH_SIGNATURES_COLLECTED", start + 1),
+                                      ("STATEFUL_VALIDATION_SUCCESS", start + 1.5), ("COMMITTED", start + 3.5)])
+    stages = dict(recorder.transactions[0]["stages"])
+    assert list(stages) == ["ENOUGH_SIGNATURES_COLLECTED", "STATEFUL_VALIDATION_SUCCESS", "COMMITTED", "TOTAL"]
+    assert stages["ENOUGH_SIGNATURES_COLLECTED"] == pytest.approx(1, abs=0.1)
+    assert stages["STATEFUL_VALIDATION_SUCCESS"] == pytest.approx(0.5)
+    assert stages["COMMITTED"] == pytest.approx(2)
+    assert stages["TOTAL"] == pytest.approx(3.5, abs=0.1)
+    assert recorder.transactions[0]["hash"] == binascii.hexlify(b"tx1").decode()
+
+    # Without a send time the first stage is unknown, so it and the total are left out
+    recorder.record(b"tx2", "node2", [("ENOUGH_SIGNATURES_COLLECTED", start), ("COMMITTED", start + 2)])
+    assert recorder.transactions[1]["stages"] == [["COMMITTED", 2]]
+    recorder.record(b"tx3", "node2", [])
+    assert len(recorder.transactions) == 2
+
+    assert recorder.stages["COMMITTED"].count == 2
+    assert recorder.stages["TOTAL"].count == 1
+    assert set(recorder.peers) == {"node1", "node2"}
+    assert recorder.peers["node2"]["COMMITTED"].percentile(50) == pytest.approx(2, rel=1 / 64)
+    exported = recorder.to_dict()
+    assert exported["stages"]["COMMITTED"]["count"] == 2
+    assert exported["peers"]["node1"]["TOTAL"]["count"] == 1
+    table = recorder.format_table().splitlines()
+    assert table[0].split() == ["peer", "stage", "count", "p50", "ms", "p90", "ms", "p99", "ms", "max", "ms"]
+    assert len(table) == 1 + 4 + 4 + 1
+
+
+def test_stage_recorder_forgets_oldest():
+    """
+    Test sent transactions that never get a status stream are forgotten beyond max_transactions
+    """
+
+    recorder = StageLatencyRecorder(max_transactions=2)
+    for tx_hash in (b"tx1", b"tx2", b"tx3"):
+        recorder.sent(tx_hash)
+    now = time.monotonic()
+    recorder.record(b"tx1", "node1", [("ENOUGH_SIGNATURES_COLLECTED", now), ("COMMITTED", now + 1)])
+    recorder.record(b"tx3", "node1", [("ENOUGH_SIGNATURES_COLLECTED", now), ("COMMITTED", now + 1)])
+    assert [len(transaction["stages"]) for transaction in recorder.transactions] == [1, 3]
+
+
+def unsigned_transactions(count):
+    return [iroha_admin.transaction([
+        iroha_admin.command('AddAssetQuantity', asset_id='coin#test', amount=str(i + 1))
+    ], created_time=1700000000000 + i) for i in range(count)]
+
+
+@pytest.mark.parametrize("pool", ["none", "max_workers", "executor"])
+def test_sign_transactions_matches_iroha(pool):
+    """
+    Test bulk signing, in this process, across a pool of its own or across a pool passed in,
+    gives the bytes IrohaCrypto.sign_transaction gives
+    """
+
+    user = new_user("signer", "test")
+    expected = unsigned_transactions(5)
+    for i, transaction in enumerate(expected):
+        IrohaCrypto.sign_transaction(transaction, *([ADMIN_PRIVATE_KEY, user["private_key"]] if i == 0 else
+                                                    [ADMIN_PRIVATE_KEY]))
+    transactions = unsigned_transactions(5)
+    keys = [[ADMIN_PRIVATE_KEY, user["private_key"]]] + [ADMIN_PRIVATE_KEY] * 4
+    if pool == "executor":
+        with signing_pool(2) as executor:
+            hashes = sign_transactions(transactions, keys, chunk_size=2, executor=executor)
+            # The pool is left open for the caller to reuse
+            assert len(generate_keypairs(3, chunk_size=2, executor=executor)) == 3
+    else:
+        hashes = sign_transactions(transactions, keys, max_workers=2 if pool == "max_workers" else 1, chunk_size=2)
+    assert [tx.SerializeToString() for tx in transactions] == [tx.SerializeToString() for tx in expected]
+    assert hashes == [IrohaCrypto.hash(tx) for tx in expected]
+    with pytest.raises(ValueError):
+        sign_transactions(unsigned_transactions(2), [ADMIN_PRIVATE_KEY])
+
+
+@trace
+def traced_function(value, connection=None):
+    if value < 0:
+        raise ValueError(value)
+    return value * 2
+
+@trace
+def traced_generator(count, connection=None):
+    for i in range(count):
+        if i < 0:
+            raise ValueError(i)
+        yield i
+    return count
+
+@trace
+async def traced_coroutine(value, connection=None):
+    await asyncio.sleep(0.01)
+    if value < 0:
+        raise ValueError(value)
+    return value * 2
+
+
+def stats(profiler, func, peer=None):
+    return profiler.stats[(func.__qualname__, peer)]
+
+
+def test_trace_function():
+    """
+    Test a traced function reports each call and error to the active profiler, and only while one is active
+    """
+
+    assert traced_function(1) == 2
+    with Profiler(spans=True) as profiler:
+        assert traced_function(2) == 4
+        assert traced_function(3, connection=net_1) == 6
+        with pytest.raises(ValueError):
+            traced_function(-1)
+    assert traced_function(4) == 8
+    assert traced_function.__name__ == "traced_function"
+    calls = stats(profiler, traced_function)
+    assert (calls["calls"], calls["errors"], calls["in_flight"], calls["max_in_flight"]) == (2, 1, 0, 1)
+    assert stats(profiler, traced_function, net_1.name)["calls"] == 1
+    assert [span["args"]["error"] for span in profiler.spans] == [False, False, True]
+    assert "traced_function" in profiler.format_table()
+
+
+def test_trace_generator():
+    """
+    Test a traced generator is timed until it is exhausted or closed, and stays a generator
+    """
+
+    with Profiler() as profiler:
+        generator = traced_generator(3)
+        assert inspect.isgenerator(generator)
+        # Timing starts at the first next, not the call
+        assert ("traced_generator", None) not in profiler.stats
+        assert list(generator) == [0, 1, 2]
+
+        # Closing a generator early is not an error
+        generator = traced_generator(3)
+        assert next(generator) == 0
+        assert stats(profiler, traced_generator)["in_flight"] == 1
+        generator.close()
+
+        # The return value is passed through yield from
+        def delegate():
+            return (yield from traced_generator(2))
+        generator = delegate()
+        assert list(itertools.islice(generator, 2)) == [0, 1]
+        with pytest.raises(StopIteration) as stop:
+            next(generator)
+        assert stop.value.value == 2
+    calls = stats(profiler, traced_generator)
+    assert (calls["calls"], calls["errors"], calls["in_flight"], calls["cpu"]) == (3, 0, 0, 0.0)
+
+
+def test_trace_coroutine():
+    """
+    Test a traced coroutine is timed until it finishes, with concurrent calls counted in flight
+    """
+
+    async def run():
+        assert await asyncio.gather(traced_coroutine(1), traced_coroutine(2)) == [2, 4]
+        with pytest.raises(ValueError):
+            await traced_coroutine(-1)
+
+    assert asyncio.iscoroutinefunction(traced_coroutine)
+    with Profiler() as profiler:
+        asyncio.run(run())
+    calls = stats(profiler, traced_coroutine)
+    assert (calls["calls"], calls["errors"], calls["in_flight"], calls["max_in_flight"]) == (3, 1, 0, 2)
+    assert calls["wall"] >= 0.03
@@ -0,0 +1,349 @@
+#! /bin/python
+
+"""
+Mirror the asset movements of the chain into a local SQLite database, for reports that would otherwise query the peers
+Blocks are read once, from get_block or a BlockSubscriber, and CreateAccount, AddAssetQuantity, SubtractAssetQuantity
+and TransferAsset commands are applied to indexed tables of accounts, balances and movements. Balances, the history of
+an account and the volume of an asset are then single indexed lookups, and never touch the consensus nodes
+
+Amounts are kept as decimal strings, as Iroha writes them, and summed with Decimal, so no precision is lost.
+The height and hash of the last block applied are stored with the tables, so a mirror saved to a file
+only reads the blocks committed since it was last synced, and refuses blocks that do not link onto it
+
+Usage:
+    python ledger_mirror.py --db mirror.db                     Sync the mirror, then print the balances of every asset
+    python ledger_mirror.py --db mirror.db --account admin@test  Also print the history of an account
+    python ledger_mirror.py --db mirror.db --follow              Keep applying blocks as they commit, until Ctrl-C
+"""
+from IrohaUtils import *
+import argparse
+import binascii
+import decimal
+import logging
+import sqlite3
+import sys
+import threading
+import time
+from collections import namedtuple
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sync (id INTEGER PRIMARY KEY CHECK (id = 0), height INTEGER NOT NULL, hash TEXT);
+CREATE TABLE IF NOT EXISTS accounts (
+    account_id TEXT PRIMARY KEY, domain_id TEXT NOT NULL, public_key TEXT NOT NULL, height INTEGER NOT NULL);
+CREATE INDEX IF NOT EXISTS accounts_domain ON accounts (domain_id);
+CREATE TABLE IF NOT EXISTS balances (
+    account_id TEXT NOT NULL, asset_id TEXT NOT NULL, balance TEXT NOT NULL, PRIMARY KEY (asset_id, account_id));
+CREATE INDEX IF NOT EXISTS balances_account ON balances (account_id);
+CREATE TABLE IF NOT EXISTS movements (
+    id INTEGER PRIMARY KEY, height INTEGER NOT NULL, tx_hash TEXT NOT NULL, command_index INTEGER NOT NULL,
+    created_time INTEGER NOT NULL, kind TEXT NOT NULL, src_account_id TEXT, dest_account_id TEXT,
+    asset_id TEXT NOT NULL, amount TEXT NOT NULL, description TEXT);
+CREATE INDEX IF NOT EXISTS movements_src ON movements (src_account_id, height);
+CREATE INDEX IF NOT EXISTS movements_dest ON movements (dest_account_id, height);
+CREATE INDEX IF NOT EXISTS movements_asset ON movements (asset_id, height);
+"""
+
+_MOVEMENT_COLUMNS = ("height, tx_hash, command_index, created_time, kind, src_account_id, dest_account_id, "
+                     "asset_id, amount, description")
+
+
+class Movement(namedtuple("Movement", _MOVEMENT_COLUMNS.split(", "))):
+    """One change of balance, from a TransferAsset, AddAssetQuantity or SubtractAssetQuantity command
+
+    Attributes:
+        height (int): The height of the block it was committed in
+        tx_hash (String): The hex encoded hash of its transaction
+        command_index (int): The index of the command in its transaction
+        created_time (int): The creation time of its transaction, in milliseconds since the epoch
+        kind (String): transfer, add or subtract
+        src_account_id (String): The account the amount left, None for add
+        dest_account_id (String): The account the amount reached, None for subtract
+        asset_id (String): The asset moved
+        amount (Decimal): The amount moved
+        description (String): The description of a transfer, None otherwise
+    """
+
+    __slots__ = ()
+
+
+class _DecimalSum:
+    """SQLite aggregate summing decimal strings exactly"""
+
+    def __init__(self):
+        self.total = decimal.Decimal(0)
+
+    def step(self, value):
+        if value is not None:
+            self.total += decimal.Decimal(value)
+
+    def finalize(self):
+        return str(self.total)
+
+
+class LedgerMirror:
+    """A SQLite database of the accounts, balances and asset movements of the chain, up to the last block applied
+    Blocks must be applied in order of height. Blocks already applied are skipped, so the same blocks can
+    be given again, e.g. by a subscriber resubscribing. Safe to query while another thread applies blocks
+
+    Usage:
+        mirror = LedgerMirror("mirror.db")
+        mirror.sync(peers)
+        mirror.balance("admin@test", "coin#test")
+    """
+
+    def __init__(self, path=":memory:"):
+        """
+        Args:
+            path (String, optional): The database file, created if it does not exist. Defaults to in memory
+        """
+
+        self.path = path
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.create_aggregate("decimal_sum", 1, _DecimalSum)
+        self._lock = threading.Lock()
+        with self._lock, self._db:
+            self._db.executescript(SCHEMA)
+            self._db.execute("INSERT OR IGNORE INTO sync VALUES (0, 0, NULL)")
+            self.height, self.hash = self._db.execute("SELECT height, hash FROM sync").fetchone()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._db.close()
+
+    # Applying blocks ----------------------------------------------------------
+
+    def apply_block(self, block):
+        """Apply the commands of a block, in one database transaction
+
+        Args:
+            block (JSON): A block response, as from get_block, iter_blocks or a BlockSubscriber
+
+        Throws:
+            ValueError if the block is not the next one after the last applied
+            ChainMismatchError if the block does not link onto the last block applied
+        """
+
+        payload = block.block_response.block.block_v1.payload
+        with self._lock:
+            if payload.height <= self.height:
+                return
+            if payload.height != self.height + 1:
+                raise ValueError(f"Block {payload.height} is not the next block, the mirror is at {self.height}")
+            if self.hash is not None and payload.prev_block_hash != self.hash:
+                raise ChainMismatchError(
+                    f"Block {payload.height} has prev_block_hash {payload.prev_block_hash}, expected {self.hash}")
+            new_hash = block_hash(block)
+            with self._db:
+                for transaction in payload.transactions:
+                    self._apply_transaction(transaction, payload.height)
+                self._db.execute("UPDATE sync SET height = ?, hash = ?", (payload.height, new_hash))
+            self.height, self.hash = payload.height, new_hash
+
+    def apply_blocks(self, blocks):
+        for block in blocks:
+            self.apply_block(block)
+
+    def _apply_transaction(self, transaction, height):
+        reduced = transaction.payload.reduced_payload
+        creator = reduced.creator_account_id
+        tx_hash = None
+        for index, command in enumerate(reduced.commands):
+            kind = command.WhichOneof("command")
+            if kind == "create_account":
+                c = command.create_account
+                self._db.execute("INSERT OR IGNORE INTO accounts VALUES (?, ?, ?, ?)",
+                                 (f"{c.account_name}@{c.domain_id}", c.domain_id, c.public_key, height))
+                continue
+            if kind == "transfer_asset":
+                c = command.transfer_asset
+                movement = ("transfer", c.src_account_id, c.dest_account_id, c.asset_id, c.amount, c.description)
+            elif kind == "add_asset_quantity":
+                c = command.add_asset_quantity
+                movement = ("add", None, creator, c.asset_id, c.amount, None)
+            elif kind == "subtract_asset_quantity":
+                c = command.subtract_asset_quantity
+                movement = ("subtract", creator, None, c.asset_id, c.amount, None)
+            else:
+                continue
+            if tx_hash is None:
+                tx_hash = binascii.hexlify(IrohaCrypto.hash(transaction)).decode()
+            _, src, dest, asset_id, amount, _ = movement
+            self._db.execute(f"INSERT INTO movements ({_MOVEMENT_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                             (height, tx_hash, index, reduced.created_time) + movement)
+            if src is not None:
+                self._change_balance(src, asset_id, -decimal.Decimal(amount))
+            if dest is not None:
+                self._change_balance(dest, asset_id, decimal.Decimal(amount))
+
+    def _change_balance(self, account_id, asset_id, change):
+        row = self._db.execute("SELECT balance FROM balances WHERE asset_id = ? AND account_id = ?",
+                               (asset_id, account_id)).fetchone()
+        balance = (decimal.Decimal(row[0]) if row else decimal.Decimal(0)) + change
+        self._db.execute("INSERT OR REPLACE INTO balances VALUES (?, ?, ?)", (account_id, asset_id, str(balance)))
+
+    @trace
+    def sync(self, connection, connections=None, max_workers=8):
+        """Apply every block committed since the last one applied
+
+        Args:
+            connection (IrohaGrpc): The connection to a node to find the chain height on
+            connections (list of IrohaGrpc, optional): Nodes to spread the download over. Defaults to connection
+
+        Returns:
+            int: The height of the mirror
+        """
+
+        height = get_chain_height(connection)
+        if height > self.height:
+            logging.info(f"MIRRORING BLOCKS {self.height + 1} TO {height}")
+            self.apply_blocks(iter_blocks(self.height + 1, height, connections or [connection], max_workers))
+        return self.height
+
+    def follow(self, connection):
+        """Keep applying blocks as they commit, from the block after the last one applied
+        If a block fails to apply, the subscriber stops with the mirror at the block before, and its wait_for
+        raises the error; following again resumes from the failed block
+
+        Returns:
+            BlockSubscriber: The running subscriber, stop it to stop following
+        """
+
+        return BlockSubscriber(connection, [self.apply_block], from_height=self.height + 1).start()
+
+    # Reports ------------------------------------------------------------------
+
+    def _query(self, sql, parameters=()):
+        with self._lock:
+            return self._db.execute(sql, parameters).fetchall()
+
+    def balance(self, account_id, asset_id):
+        """The balance of an asset held by an account, 0 if it holds none"""
+
+        rows = self._query("SELECT balance FROM balances WHERE asset_id = ? AND account_id = ?", (asset_id, account_id))
+        return decimal.Decimal(rows[0][0]) if rows else decimal.Decimal(0)
+
+    def balances(self, asset_id):
+        """
+        Returns:
+            dict of String to Decimal: The balance of every account that has held the asset
+        """
+
+        return {account_id: decimal.Decimal(balance) for account_id, balance in
+                self._query("SELECT account_id, balance FROM balances WHERE asset_id = ? ORDER BY account_id",
+                            (asset_id,))}
+
+    def account_balances(self, account_id):
+        """
+        Returns:
+            dict of String to Decimal: The balance of every asset the account has held
+        """
+
+        return {asset_id: decimal.Decimal(balance) for asset_id, balance in
+                self._query("SELECT asset_id, balance FROM balances WHERE account_id = ? ORDER BY asset_id",
+                            (account_id,))}
+
+    def accounts(self, domain_id=None):
+        """The ids of the accounts created, in a domain if given"""
+
+        if domain_id is None:
+            rows = self._query("SELECT account_id FROM accounts ORDER BY account_id")
+        else:
+            rows = self._query("SELECT account_id FROM accounts WHERE domain_id = ? ORDER BY account_id", (domain_id,))
+        return [account_id for account_id, in rows]
+
+    def assets(self):
+        """The ids of the assets ever held"""
+        return [asset_id for asset_id, in self._query("SELECT DISTINCT asset_id FROM balances ORDER BY asset_id")]
+
+    def history(self, account_id, asset_id=None, limit=None):
+        """The movements to and from an account, oldest first
+
+        Args:
+            account_id (String): The account
+            asset_id (String, optional): Only movements of this asset. Defaults to all assets
+            limit (int, optional): Only the most recent limit movements. Defaults to all
+
+        Returns:
+            list of Movement: The movements, in order of height and position in the block
+        """
+
+        asset_filter = "" if asset_id is None else " AND asset_id = ?"
+        parameters = ((account_id,) if asset_id is None else (account_id, asset_id)) * 2
+        order = "ORDER BY id"
+        if limit is not None:
+            order += " DESC LIMIT ?"
+            parameters += (limit,)
+        # One indexed lookup per side, rather than an OR that scans the table
+        rows = self._query(
+            f"SELECT id, {_MOVEMENT_COLUMNS} FROM movements WHERE src_account_id = ?{asset_filter} UNION "
+            f"SELECT id, {_MOVEMENT_COLUMNS} FROM movements WHERE dest_account_id = ?{asset_filter} {order}", parameters)
+        if limit is not None:
+            rows.reverse()
+        return [Movement(*row[1:9], decimal.Decimal(row[9]), row[10]) for row in rows]
+
+    def volume(self, asset_id, first_height=1, last_height=None):
+        """The transfers of an asset over a range of blocks
+
+        Args:
+            asset_id (String): The asset
+            first_height (int, optional): The first block counted. Defaults to 1
+            last_height (int, optional): The last block counted, inclusive. Defaults to the last block applied
+
+        Returns:
+            (int, Decimal): The number of transfers and the total amount transferred
+        """
+
+        count, total = self._query(
+            "SELECT count(*), decimal_sum(amount) FROM movements "
+            "WHERE asset_id = ? AND height BETWEEN ? AND ? AND kind = 'transfer'",
+            (asset_id, first_height, self.height if last_height is None else last_height))[0]
+        return count, decimal.Decimal(total)
+
+
+def print_report(mirror, account_id=None):
+    print(f"{bcolors.OKGREEN}{'-'*80}{bcolors.ENDC}")
+    print(f"Mirrored {mirror.height} blocks, {len(mirror.accounts())} accounts")
+    for asset_id in mirror.assets():
+        count, total = mirror.volume(asset_id)
+        print(f"{asset_id}: {count} transfers totalling {total}")
+        for holder, balance in mirror.balances(asset_id).items():
+            print(f"\t{holder:40} {balance}")
+    if account_id is not None:
+        print(f"History of {account_id}:")
+        for movement in mirror.history(account_id):
+            print(f"\t{movement.height:6} {movement.kind:8} {movement.src_account_id or '-':30} -> "
+                  f"{movement.dest_account_id or '-':30} {movement.amount} {movement.asset_id}")
+    print(f"{bcolors.OKGREEN}{'-'*80}{bcolors.ENDC}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Mirror the asset movements of the chain into SQLite")
+    parser.add_argument("--db", default="mirror.db", help="database file to sync")
+    parser.add_argument("--account", help="also print the history of this account")
+    parser.add_argument("--follow", action="store_true", help="keep applying blocks as they commit, until Ctrl-C")
+    args = parser.parse_args(argv)
+
+    with LedgerMirror(args.db) as mirror:
+        mirror.sync(peers, peers.connections())
+        print_report(mirror, args.account)
+        if args.follow:
+            subscriber = mirror.follow(peers)
+            logging.info(f"FOLLOWING BLOCKS FROM {mirror.height}, CTRL-C TO STOP")
+            try:
+                while subscriber.error is None:
+                    time.sleep(1)
+            except KeyboardInterrupt:
+                pass
+            finally:
+                subscriber.stop()
+            print_report(mirror, args.account)
+            if subscriber.error is not None:
+                raise subscriber.error
+
+if __name__=="__main__":
+    logging.basicConfig(level=logging.INFO)
+    main(sys.argv[1:])
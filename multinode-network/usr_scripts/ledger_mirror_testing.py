@@ -0,0 +1,127 @@
+#! /bin/python
+
+"""
+Test the ledger mirror against the in-process fake network of fake_iroha.py, so no network or docker is needed
+The balances the mirror reports are checked against GetAccountAssets queries of the same chain
+
+Run with pytest -rA -v ledger_mirror_testing.py
+"""
+from fake_iroha import FakeNetwork
+from ledger_mirror import *
+import pytest
+
+DOMAIN_ID = f"mirror-{unique_suffix()}"
+ASSET_ID = f"coin#{DOMAIN_ID}"
+
+
+@pytest.fixture(name="network", scope="module")
+def network_fixture():
+    """Fake peers with a domain, an asset, and alice and bob funded with 10 each"""
+
+    with FakeNetwork(peers=2, commit_latency=0.02) as network:
+        registry = network.registry()
+        alice, bob = new_user("alice", DOMAIN_ID), new_user("bob", DOMAIN_ID)
+        tx = IrohaCrypto.sign_transaction(iroha_admin.transaction([
+            iroha_admin.command('CreateDomain', domain_id=DOMAIN_ID, default_role='user'),
+            iroha_admin.command('CreateAsset', asset_name='coin', domain_id=DOMAIN_ID, precision=2),
+            iroha_admin.command('CreateAccount', account_name='alice', domain_id=DOMAIN_ID, public_key=alice["public_key"]),
+            iroha_admin.command('CreateAccount', account_name='bob', domain_id=DOMAIN_ID, public_key=bob["public_key"]),
+            iroha_admin.command('AddAssetQuantity', asset_id=ASSET_ID, amount="25.00"),
+            iroha_admin.command('TransferAsset', src_account_id=ADMIN_ACCOUNT_ID, dest_account_id=alice["id"],
+                                asset_id=ASSET_ID, description='funds', amount="10.00"),
+            iroha_admin.command('TransferAsset', src_account_id=ADMIN_ACCOUNT_ID, dest_account_id=bob["id"],
+                                asset_id=ASSET_ID, description='funds', amount="10.00"),
+        ]), ADMIN_PRIVATE_KEY)
+        assert send_transaction(tx, registry)[0] == "COMMITTED"
+        network.alice, network.bob, network.connection = alice, bob, registry
+        yield network
+        registry.close()
+
+
+def transfer(sender, receiver, amount):
+    tx = sender["iroha"].transaction([
+        sender["iroha"].command('TransferAsset', src_account_id=sender["id"], dest_account_id=receiver["id"],
+                                asset_id=ASSET_ID, description='test', amount=amount)
+    ])
+    return IrohaCrypto.sign_transaction(tx, sender["private_key"])
+
+
+def test_sync_and_report(network, tmp_path):
+    """
+    Test a synced mirror reports the same balances as the peers, with history and volume, and resumes from its file
+    """
+
+    path = str(tmp_path / "mirror.db")
+    with LedgerMirror(path) as mirror:
+        assert mirror.sync(network.connection) == get_chain_height(network.connection)
+        assert set(mirror.accounts(DOMAIN_ID)) == {network.alice["id"], network.bob["id"]}
+        assert mirror.balances(ASSET_ID) == get_balances([ADMIN_ACCOUNT_ID, network.alice["id"], network.bob["id"]],
+                                                         ASSET_ID, network.connection)
+
+    assert send_transaction(transfer(network.alice, network.bob, "2.25"), network.connection)[0] == "COMMITTED"
+    with LedgerMirror(path) as mirror:
+        height = mirror.height
+        assert mirror.sync(network.connection) == height + 1
+        assert mirror.balance(network.alice["id"], ASSET_ID) == decimal.Decimal("7.75")
+        assert mirror.balance(network.bob["id"], ASSET_ID) == decimal.Decimal("12.25")
+        history = mirror.history(network.bob["id"], ASSET_ID)
+        assert [(movement.kind, movement.amount) for movement in history] == \
+            [("transfer", decimal.Decimal("10.00")), ("transfer", decimal.Decimal("2.25"))]
+        assert mirror.history(network.bob["id"], limit=1) == history[-1:]
+        assert mirror.volume(ASSET_ID) == (3, decimal.Decimal("22.25"))
+        assert mirror.volume(ASSET_ID, first_height=height + 1) == (1, decimal.Decimal("2.25"))
+
+
+def test_follow(network):
+    """
+    Test a following mirror applies blocks as they commit, and refuses a block that does not link onto it
+    """
+
+    with LedgerMirror() as mirror:
+        mirror.sync(network.connection)
+        subscriber = mirror.follow(network.connection)
+        try:
+            assert send_transaction(transfer(network.bob, network.alice, "1"), network.connection)[0] == "COMMITTED"
+            assert subscriber.wait_for(network.ledger.height, 5)
+        finally:
+            subscriber.stop()
+        assert mirror.balances(ASSET_ID) == get_balances([ADMIN_ACCOUNT_ID, network.alice["id"], network.bob["id"]],
+                                                         ASSET_ID, network.connection)
+
+        block = get_block(mirror.height, network.connection)
+        block.block_response.block.block_v1.payload.height = mirror.height + 1
+        with pytest.raises(ChainMismatchError):
+            mirror.apply_block(block)
+
+
+def test_follow_failure(network, monkeypatch):
+    """
+    Test a block that fails to apply stops the mirror following at the block before, and following again resumes
+    """
+
+    with LedgerMirror() as mirror:
+        mirror.sync(network.connection)
+        height = mirror.height
+        apply_transaction = mirror._apply_transaction
+
+        def fail(transaction, height):
+            raise sqlite3.OperationalError("disk I/O error")
+
+        monkeypatch.setattr(mirror, "_apply_transaction", fail)
+        subscriber = mirror.follow(network.connection)
+        try:
+            assert send_transaction(transfer(network.alice, network.bob, "1"), network.connection)[0] == "COMMITTED"
+            with pytest.raises(sqlite3.OperationalError):
+                subscriber.wait_for(height + 1, 5)
+        finally:
+            subscriber.stop()
+        assert mirror.height == height
+
+        monkeypatch.setattr(mirror, "_apply_transaction", apply_transaction)
+        subscriber = mirror.follow(network.connection)
+        try:
+            assert subscriber.wait_for(network.ledger.height, 5)
+        finally:
+            subscriber.stop()
+        assert mirror.balances(ASSET_ID) == get_balances([ADMIN_ACCOUNT_ID, network.alice["id"], network.bob["id"]],
+                                                         ASSET_ID, network.connection)
@@ -0,0 +1,301 @@
+#! /bin/python
+
+"""
+Generate TransferAsset load on the multinode Iroha network, to measure what it can sustain
+A new domain, asset and set of funded accounts is created first, so this can run against a network already in use.
+Transfers between random pairs of those accounts are then sent across all peers, either
+
+- open-loop, at a fixed target rate (--rate), regardless of how fast the network answers, or
+- closed-loop, with a fixed number of transactions in flight (--concurrency), each sent when the last finishes
+
+Committed transactions per second, the rejection rate and end-to-end latency percentiles are reported.
+In open-loop mode latency is measured from when a transaction was due to be sent, so a saturated client
+still shows up as latency rather than hiding it
+
+Usage:
+    python load_generator.py --accounts 20 --rate 5 --duration 60
+    python load_generator.py --accounts 20 --concurrency 10 --duration 60 --json results.json
+    python load_generator.py --accounts 20 --rate 5 --json results.json --metrics results.metrics.json
+    python load_generator.py --accounts 20 --concurrency 10 --stages results.stages.json
+"""
+from IrohaUtils import *
+from profiling import StageLatencyRecorder
+from peer_registry import PeerConnection
+from metrics_collector import MetricsRecorder, metrics_endpoints
+import argparse
+import grpc
+import json
+import logging
+import math
+import random
+import sys
+import threading
+import time
+
+FAILED_STATUSES = ("REJECTED", "STATELESS_VALIDATION_FAILED", "STATEFUL_VALIDATION_FAILED", "MST_EXPIRED")
+
+
+def _send_all(transactions, connection):
+    """Send setup transactions pipelined and check every one is committed"""
+
+    with TransactionSubmitter(connection.connections()) as submitter:
+        statuses = [future.result() for future in submitter.submit_all(transactions)]
+    for status in statuses:
+        assert status[0] == "COMMITTED", f"Setup transaction failed with {status}"
+
+def set_up_accounts(domain_id, count, balance="1000.00", asset_name="coin", connection=peers,
+                    commands_per_tx=ACCOUNTS_PER_TRANSACTION, keystore=None, executor=None):
+    """
+    Create a domain, an asset, and count accounts in that domain each holding balance of the asset
+    Commands are packed commands_per_tx to a transaction and sent in batches, so setup takes a few consensus rounds
+
+    Args:
+        domain_id (String): The new domain to create the asset and accounts in
+        count (int): The number of accounts to create
+        balance (String, optional): The starting balance of each account. Defaults to 1000.00
+        asset_name (String, optional): The name of the new asset. Defaults to coin
+        connection (PeerRegistry, optional): The peers to send setup transactions to. Defaults to all peers
+        commands_per_tx (int, optional): The most commands packed into one transaction. Defaults to ACCOUNTS_PER_TRANSACTION
+        keystore (Keystore, optional): Reuse and save account keypairs here. Defaults to fresh keypairs
+        executor (concurrent.futures.Executor, optional): A pool to generate keypairs and sign across, e.g. from
+            signing_pool. Defaults to this process
+
+    Returns:
+        (list of dict, String): The new users, as from new_user, and the id of the asset
+    """
+
+    asset_id = f"{asset_name}#{domain_id}"
+    logging.info(f"CREATING DOMAIN {domain_id} AND ASSET {asset_id}")
+    tx = IrohaCrypto.sign_transaction(iroha_admin.transaction([
+        iroha_admin.command('CreateDomain', domain_id=domain_id, default_role='user'),
+        iroha_admin.command('CreateAsset', asset_name=asset_name, domain_id=domain_id, precision=2),
+        iroha_admin.command('AddAssetQuantity', asset_id=asset_id, amount=f"{float(balance) * count:.2f}"),
+    ]), ADMIN_PRIVATE_KEY)
+    _send_all([tx], connection)
+
+    users = provision_accounts(domain_id, count, keystore, connection, accounts_per_transaction=commands_per_tx,
+                               executor=executor)
+
+    logging.info(f"FUNDING {count} ACCOUNTS WITH {balance} {asset_id}")
+    transactions = pack_transactions([
+        iroha_admin.command('TransferAsset', src_account_id=ADMIN_ACCOUNT_ID, dest_account_id=user["id"],
+                            asset_id=asset_id, description='Load test funds', amount=balance) for user in users
+    ], commands_per_transaction=commands_per_tx)
+    sign_transactions(transactions, ADMIN_PRIVATE_KEY, executor=executor)
+    send_packed(transactions, connection)
+
+    logging.info("SET UP COMPLETE")
+    return users, asset_id
+
+def random_transfer(users, asset_id, amount="0.01"):
+    """Build and sign a transfer of amount between two random, distinct users"""
+
+    src, dest = random.sample(users, 2)
+    tx = src["iroha"].transaction([
+        src["iroha"].command('TransferAsset', src_account_id=src["id"], dest_account_id=dest["id"],
+                             asset_id=asset_id, description='Load test', amount=amount)
+    ])
+    return IrohaCrypto.sign_transaction(tx, src["private_key"])
+
+def open_loop(users, asset_id, rate, duration, connection=peers, window=100):
+    """
+    Send random transfers at a fixed rate for a duration, whatever the network's response
+
+    Args:
+        users (list of dict): The funded users to transfer between
+        asset_id (String): The asset to transfer
+        rate (float): Transactions to send per second
+        duration (float): Seconds to send for
+        connection (PeerRegistry, optional): The peers to send to, each transaction to the peer the policy of the
+            registry selects. Defaults to all peers
+        window (int, optional): The most transactions in flight per peer. Defaults to 100
+
+    Returns:
+        list of (float, String): The latency and final status of each transaction
+
+    Throws:
+        ValueError: If rate is not above 0
+    """
+
+    if rate <= 0:
+        raise ValueError(f"Expected a rate above 0 transactions per second, got {rate}")
+    results = []
+    lock = threading.Lock()
+
+    def record(due, future):
+        latency = time.monotonic() - due
+        status = future.result()[0] if future.exception() is None else "ERROR"
+        with lock:
+            results.append((latency, status))
+
+    with TransactionSubmitter(connection.connections(), window=window) as submitter:
+        start = time.monotonic()
+        sent = 0
+        while sent / rate < duration:
+            due = start + sent / rate
+            delay = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            submitter.submit(random_transfer(users, asset_id), connection.select(),
+                             callback=lambda f, due=due: record(due, f))
+            sent += 1
+    return results
+
+def closed_loop(users, asset_id, concurrency, duration, connection=peers):
+    """
+    Send random transfers from concurrency workers for a duration, each sending its next once the last is final
+
+    Args:
+        users (list of dict): The funded users to transfer between
+        asset_id (String): The asset to transfer
+        concurrency (int): The number of transactions kept in flight
+        duration (float): Seconds to send for
+        connection (PeerRegistry, optional): The peers to send transactions to. Defaults to all peers
+
+    Returns:
+        list of (float, String): The latency and final status of each transaction
+    """
+
+    results = []
+    lock = threading.Lock()
+    end = time.monotonic() + duration
+
+    def worker():
+        while time.monotonic() < end:
+            tx = random_transfer(users, asset_id)
+            start = time.monotonic()
+            try:
+                status = send_transaction(tx, connection)[0]
+            except Exception as e:
+                # Counted rather than raised, so one failure neither ends the worker nor goes missing from the results
+                if not isinstance(e, grpc.RpcError):
+                    logging.warning(f"TRANSACTION FAILED TO SEND: {e!r}")
+                status = "ERROR"
+            with lock:
+                results.append((time.monotonic() - start, status))
+
+    workers = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    return results
+
+def percentile(values, p):
+    """The p-th percentile of a list of values, nearest rank. None if there are no values"""
+
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, math.ceil(p * len(values) / 100) - 1))]
+
+def summarise(results, elapsed):
+    """
+    Summarise the results of a load run
+
+    Args:
+        results (list of (float, String)): The latency and final status of each transaction
+        elapsed (float): Seconds from the start of the run until the last transaction was final
+
+    Returns:
+        dict: Counts of each outcome, committed tx/s, rejection rate and committed latency percentiles in seconds
+    """
+
+    committed = [latency for latency, status in results if status == "COMMITTED"]
+    rejected = sum(1 for _, status in results if status in FAILED_STATUSES)
+    errors = sum(1 for _, status in results if status == "ERROR")
+    return {
+        "sent": len(results),
+        "committed": len(committed),
+        "rejected": rejected,
+        "errors": errors,
+        "elapsed": elapsed,
+        "committed_tps": len(committed) / elapsed if elapsed else 0.0,
+        "rejection_rate": rejected / len(results) if results else 0.0,
+        "latency_p50": percentile(committed, 50),
+        "latency_p90": percentile(committed, 90),
+        "latency_p99": percentile(committed, 99),
+        "latency_max": max(committed) if committed else None,
+    }
+
+def run_load(users, asset_id, duration, rate=None, concurrency=None, connection=peers):
+    """
+    Run open-loop load if rate is given, else closed-loop load, and summarise it
+
+    Returns:
+        dict: The summary, as from summarise, with the mode and its target
+    """
+
+    start = time.monotonic()
+    if rate:
+        results = open_loop(users, asset_id, rate, duration, connection)
+    else:
+        results = closed_loop(users, asset_id, concurrency, duration, connection)
+    summary = summarise(results, time.monotonic() - start)
+    summary.update({"mode": "open" if rate else "closed", "rate": rate, "concurrency": concurrency})
+    return summary
+
+def print_summary(summary):
+    def ms(seconds):
+        return "-" if seconds is None else f"{seconds * 1000:.0f} ms"
+
+    print(f"{bcolors.OKGREEN}{'-'*80}{bcolors.ENDC}")
+    print(f"Mode: {summary['mode']}-loop, rate {summary['rate']}, concurrency {summary['concurrency']}")
+    print(f"Sent {summary['sent']}, committed {summary['committed']}, rejected {summary['rejected']}, "
+          f"errors {summary['errors']} in {summary['elapsed']:.1f} s")
+    print(f"Committed throughput: {summary['committed_tps']:.2f} tx/s")
+    print(f"Rejection rate: {summary['rejection_rate']:.1%}")
+    print(f"Latency p50 {ms(summary['latency_p50'])}, p90 {ms(summary['latency_p90'])}, "
+          f"p99 {ms(summary['latency_p99'])}, max {ms(summary['latency_max'])}")
+    print(f"{bcolors.OKGREEN}{'-'*80}{bcolors.ENDC}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate TransferAsset load on the multinode Iroha network")
+    mode = parser.add_mutually_exclusive_group(required=True)
+    mode.add_argument("--rate", type=float, help="open-loop: transactions per second to send")
+    mode.add_argument("--concurrency", type=int, help="closed-loop: transactions to keep in flight")
+    parser.add_argument("--accounts", type=int, default=20, help="accounts to create and transfer between")
+    parser.add_argument("--duration", type=float, default=60, help="seconds to generate load for")
+    parser.add_argument("--domain", default=f"load{int(time.time())}", help="new domain to create accounts in")
+    parser.add_argument("--keystore", help="reuse account keypairs from this file, saving any new ones to it")
+    parser.add_argument("--policy", default="round_robin", choices=PeerRegistry.POLICIES,
+                        help="how to choose the peer for each transaction")
+    parser.add_argument("--json", help="also write the summary to this file as JSON")
+    parser.add_argument("--metrics", help="also record node metrics during the run to this file as JSON")
+    parser.add_argument("--metrics-interval", type=float, default=1.0, help="seconds between metrics scrapes")
+    parser.add_argument("--stages", help="also time each status transition, writing per stage and per peer "
+                                         "latency histograms to this file as JSON")
+    args = parser.parse_args(argv)
+    if args.accounts < 2:
+        parser.error("--accounts must be at least 2")
+    if args.rate is not None and args.rate <= 0:
+        parser.error("--rate must be above 0")
+
+    peers.policy = args.policy
+    # main runs below the __main__ guard of the script, so workers can be spawned
+    with signing_pool() as executor:
+        users, asset_id = set_up_accounts(args.domain, args.accounts,
+                                          keystore=Keystore(args.keystore) if args.keystore else None,
+                                          executor=executor)
+    logging.info(f"GENERATING LOAD FOR {args.duration}s")
+    if args.stages:
+        PeerConnection.stage_recorder = StageLatencyRecorder()
+    if args.metrics:
+        with MetricsRecorder(metrics_endpoints(), args.metrics_interval) as recorder:
+            summary = run_load(users, asset_id, args.duration, args.rate, args.concurrency)
+        recorder.save(args.metrics)
+    else:
+        summary = run_load(users, asset_id, args.duration, args.rate, args.concurrency)
+    print_summary(summary)
+    if args.stages:
+        print(PeerConnection.stage_recorder.format_table())
+        PeerConnection.stage_recorder.save(args.stages)
+        PeerConnection.stage_recorder = None
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(summary, f, indent=2)
+    return summary
+
+if __name__=="__main__":
+    logging.basicConfig(level=logging.INFO)
+    main(sys.argv[1:])
@@ -0,0 +1,98 @@
+#! /bin/python
+
+"""
+Test the load generator's summary statistics, that closed-loop workers count failures rather than dying,
+and that open-loop load is sent to the peers the registry selects
+
+Run with pytest -rA -v load_generator_testing.py
+"""
+from load_generator import *
+from fake_iroha import FakeNetwork
+import pytest
+
+
+def test_percentile():
+    """
+    Test percentiles are the smallest value with at least that share of values at or below it
+    """
+
+    values = [10, 1, 9, 2, 8, 3, 7, 4, 6, 5]
+    assert percentile(values, 0) == 1
+    assert percentile(values, 10) == 1
+    assert percentile(values, 11) == 2
+    assert percentile(values, 50) == 5
+    assert percentile(values, 85) == 9
+    assert percentile(values, 100) == 10
+    assert percentile(list(range(1, 1001)), 99.9) == 999
+    assert percentile([0.5], 99) == 0.5
+    assert percentile([], 50) is None
+
+
+def test_summarise():
+    """
+    Test outcomes are counted by status, and throughput and latency only cover committed transactions
+    """
+
+    results = [(0.1 * i, "COMMITTED") for i in range(1, 11)] + \
+        [(5.0, "REJECTED"), (6.0, "STATEFUL_VALIDATION_FAILED"), (7.0, "ERROR"), (8.0, "ENOUGH_SIGNATURES_COLLECTED")]
+    summary = summarise(results, 2.0)
+    assert {key: summary[key] for key in ("sent", "committed", "rejected", "errors")} == \
+        {"sent": 14, "committed": 10, "rejected": 2, "errors": 1}
+    assert summary["committed_tps"] == 5.0
+    assert summary["rejection_rate"] == pytest.approx(2 / 14)
+    assert summary["latency_p50"] == pytest.approx(0.5)
+    assert summary["latency_p90"] == pytest.approx(0.9)
+    assert summary["latency_p99"] == summary["latency_max"] == pytest.approx(1.0)
+
+    empty = summarise([], 0)
+    assert (empty["sent"], empty["committed_tps"], empty["rejection_rate"]) == (0, 0.0, 0.0)
+    assert empty["latency_p50"] is None and empty["latency_max"] is None
+
+
+def test_closed_loop_counts_errors():
+    """
+    Test a failure that is not a gRPC error is counted as ERROR, and every worker runs until the end
+    """
+
+    users = [new_user("alice", "test"), new_user("bob", "test")]
+    # A registry with no peers fails every send with a LookupError
+    results = closed_loop(users, "coin#test", concurrency=2, duration=0.1, connection=PeerRegistry())
+    assert results
+    assert {status for _, status in results} == {"ERROR"}
+    assert summarise(results, 0.1)["errors"] == len(results)
+
+
+def test_open_loop_selects_peer_per_transaction(monkeypatch):
+    """
+    Test open-loop load sends each transaction to the peer the registry's policy selects
+    """
+
+    users = [new_user("alice", "test"), new_user("bob", "test")]
+    with FakeNetwork(peers=3, commit_latency=0.02) as network:
+        registry = network.registry(policy="least_outstanding")
+        selected = []
+        select = registry.select
+
+        def counting_select(*args, **kwargs):
+            selected.append(select(*args, **kwargs))
+            return selected[-1]
+
+        monkeypatch.setattr(registry, "select", counting_select)
+        results = open_loop(users, "coin#test", rate=50, duration=0.2, connection=registry)
+        registry.close()
+    assert len(results) == len(selected) == 10
+    # Neither user exists, so every transfer is rejected rather than lost
+    assert {status for _, status in results} <= set(FAILED_STATUSES)
+
+
+def test_open_loop_rejects_rate():
+    """
+    Test a rate that is not above 0 is refused, rather than dividing by zero or sending nothing
+    """
+
+    users = [new_user("alice", "test"), new_user("bob", "test")]
+    for rate in (0, -1):
+        with pytest.raises(ValueError):
+            open_loop(users, "coin#test", rate, 1, connection=PeerRegistry())
+        with pytest.raises(SystemExit):
+            main(["--rate", str(rate)])
@@ -2,11 +2,11 @@
 
 """
 Test multinode Iroha network with several scenarios of a malicious client, with logging of outputs
-This module assumes a fresh network, so make sure to run manage-network restart
-Also note these tests are ordered. Some tests create objects that will be used by later tests
-Do NOT employ pytest-random, as tests will fail. This is intended
+Each run, and each pytest-xdist worker, sets up its own domain, role, asset and users, so this module can run
+alongside other tests, on a network already in use, and spread over workers, e.g. pytest -n 4 malicious_client_testing.py
+Balances are reset before each test, so tests do not depend on each other or on their order
 
-We start this test by setting up a new domain (pytest) with a basic_role that can only transfer and receive assets
+We start this test by setting up a new domain (pytest-...) with a basic_user role that can only transfer and receive assets
 There are users a, b, and c. Each will start with 100 coins
 Throughout these tests, user_a will be considered as the malicious one. Other users will remain "honest"
 """
@@ -14,14 +14,26 @@ from time import sleep
 from _pytest.fixtures import yield_fixture
 from iroha import primitive_pb2
 from IrohaUtils import *
+from peer_registry import (IROHA_HOST_ADDR_1, IROHA_PORT_1, IROHA_HOST_ADDR_2, IROHA_PORT_2, IROHA_HOST_ADDR_3,
+                           IROHA_PORT_3, IROHA_HOST_ADDR_4, IROHA_PORT_4)
+from query_cache import QueryCache
 import pytest
 import logging
 import socket
 
 
-user_a = new_user("user_a", "pytest")
-user_b = new_user("user_b", "pytest")
-user_c = new_user("user_c", "pytest")
+# Names unique to this run and worker, so concurrent runs do not share state
+RUN_SUFFIX = unique_suffix()
+DOMAIN_ID = f"pytest-{RUN_SUFFIX}"
+ROLE_NAME = f"basic_user_{RUN_SUFFIX}"
+ASSET_ID = f"coin#{DOMAIN_ID}"
+
+user_a = new_user("user_a", DOMAIN_ID)
+user_b = new_user("user_b", DOMAIN_ID)
+user_c = new_user("user_c", DOMAIN_ID)
+
+# Balances are read before and after every test, so reads are answered locally until the next block commits
+net_1_cache = QueryCache(net_1)
 
 def node_locations():
     return[
@@ -73,7 +85,7 @@ def set_up_test_environment(node_locations):
     commands = [
         # A basic user that can send and receive assets, and that's all
         # Will use "can grant..." to allow admin to reset the account balances between tests
-        iroha_admin.command("CreateRole", role_name="basic_user", permissions=[
+        iroha_admin.command("CreateRole", role_name=ROLE_NAME, permissions=[
             primitive_pb2.can_receive,
             primitive_pb2.can_transfer,
             primitive_pb2.can_grant_can_transfer_my_assets
@@ -90,7 +102,7 @@ def set_up_test_environment(node_locations):
     # Domain Creation ---------------------------------------------------------
     logging.info("CREATING DOMAIN")
     commands = [
-        iroha_admin.command('CreateDomain', domain_id='pytest', default_role='basic_user')
+        iroha_admin.command('CreateDomain', domain_id=DOMAIN_ID, default_role=ROLE_NAME)
     ]
     tx = IrohaCrypto.sign_transaction(
         iroha_admin.transaction(commands), ADMIN_PRIVATE_KEY)
@@ -104,7 +116,7 @@ def set_up_test_environment(node_locations):
     logging.info("CREATING ASSETS")
     commands = [
         iroha_admin.command('CreateAsset', asset_name='coin',
-                      domain_id='pytest', precision=2)
+                      domain_id=DOMAIN_ID, precision=2)
     ]
     tx = IrohaCrypto.sign_transaction(
         iroha_admin.transaction(commands), ADMIN_PRIVATE_KEY)
@@ -118,11 +130,11 @@ def set_up_test_environment(node_locations):
     logging.info("CREATING USERS")
     commands = [
         # Create users a,b,c
-        iroha_admin.command('CreateAccount', account_name=user_a["name"], domain_id='pytest',
+        iroha_admin.command('CreateAccount', account_name=user_a["name"], domain_id=DOMAIN_ID,
                           public_key=user_a["public_key"]),
-        iroha_admin.command('CreateAccount', account_name=user_b["name"], domain_id='pytest',
+        iroha_admin.command('CreateAccount', account_name=user_b["name"], domain_id=DOMAIN_ID,
                           public_key=user_b["public_key"]),
-        iroha_admin.command('CreateAccount', account_name=user_c["name"], domain_id='pytest',
+        iroha_admin.command('CreateAccount', account_name=user_c["name"], domain_id=DOMAIN_ID,
                           public_key=user_c["public_key"])
     ]
     tx = IrohaCrypto.sign_transaction(
@@ -150,27 +162,27 @@ def set_up_test_environment(node_locations):
 
     # Asset Quantity Creation and Transfer ------------------------------------
     logging.info("ADDING ASSETS TO USERS")
-    logging.info("ATTEMPTING TO ADD 1000 coin#pytest TO admin@test")
+    logging.info(f"ATTEMPTING TO ADD 1000 {ASSET_ID} TO admin@test")
     tx = iroha_admin.transaction([
         iroha_admin.command('AddAssetQuantity',
-                      asset_id='coin#pytest', amount='1000.00')
+                      asset_id=ASSET_ID, amount='1000.00')
     ])
     tx = IrohaCrypto.sign_transaction(tx, ADMIN_PRIVATE_KEY)
     logging.debug(tx)
     status = send_transaction(tx, net_1)
     logging.debug(status)
     assert status[0] == "COMMITTED"
-    logging.info("SUCCESSFULLY ADDED coin#pytest TO admin@test")
+    logging.info(f"SUCCESSFULLY ADDED {ASSET_ID} TO admin@test")
 
     logging.info("TRANSFERING ASSET TO USERS")
     commands = [
         # Create users a,b,c
         iroha_admin.command('TransferAsset', src_account_id='admin@test', dest_account_id=user_a["id"],
-                          asset_id='coin#pytest', amount="100"),
+                          asset_id=ASSET_ID, amount="100"),
         iroha_admin.command('TransferAsset', src_account_id='admin@test', dest_account_id=user_b["id"],
-                          asset_id='coin#pytest', amount="100"),
+                          asset_id=ASSET_ID, amount="100"),
         iroha_admin.command('TransferAsset', src_account_id='admin@test', dest_account_id=user_c["id"],
-                          asset_id='coin#pytest', amount="100")
+                          asset_id=ASSET_ID, amount="100")
     ]
     tx = IrohaCrypto.sign_transaction(
         iroha_admin.transaction(commands), ADMIN_PRIVATE_KEY)
@@ -198,45 +210,17 @@ def set_user_asset_balance_fixture():
 def set_user_asset_balance():
     """
     Set the asset balance of all users to 100 before each test
+    All balances are read at once, and only the difference is committed in one transaction,
+    so nothing is committed if the last test left every balance at 100
     """
 
     logging.info("RESET ACCOUNT BALANCES")
-
-    commands = []
-    for user in [user_a, user_b, user_c]:
-        logging.debug(f"SETTING {user['id']} BALANCE")
-        user_assets = get_user_assets(user['id'])
-        logging.debug(f"User assets: {user_assets}")
-        # Because there is only one asset, we can hardcode index 0
-        user_coin_balance = user_assets[0].balance
-        logging.debug(f"User coin#pytest balance {user_coin_balance}")
-        # Give admin 100, add 100 coins to user
-        new_commands = [
-            iroha_admin.command('AddAssetQuantity',
-                      asset_id='coin#pytest', amount='100'),
-            iroha_admin.command('TransferAsset', src_account_id='admin@test', dest_account_id=user["id"],
-                            asset_id='coin#pytest', description="Top up 100 coin", amount="100")
-        ]
-
-        #Note the Iroha considers a movement of 0 coins stateless invalid, so lets handle this case
-        if user_coin_balance != '0':
-            # subtract balance from user
-            new_commands.append(
-            iroha_admin.command('TransferAsset', src_account_id=user["id"], dest_account_id='admin@test',
-                        asset_id="coin#pytest", description="Transfer excess user balance back", amount=f"{user_coin_balance}")
-            )
-        for c in new_commands:
-            commands.append(c)
-        
-    tx = IrohaCrypto.sign_transaction(
-        iroha_admin.transaction(commands), ADMIN_PRIVATE_KEY)
-    logging.debug(tx)
-    status = send_transaction(tx, net_1)
+    user_ids = [user["id"] for user in [user_a, user_b, user_c]]
+    status = reset_balances({user_id: "100" for user_id in user_ids}, ASSET_ID, net_1_cache)
     logging.debug(status)
-    assert status[0] == "COMMITTED"
-    for user in [user_a, user_b, user_c]:
-        user_assets = get_user_assets(user['id'])
-        assert str(user_assets) == f'[asset_id: "coin#pytest"\naccount_id: "{user["id"]}"\nbalance: "100"\n]'
+    assert status is None or status[0] == "COMMITTED"
+    # Read back from the peer, not the cache, so the reset itself is checked
+    assert get_balances(user_ids, ASSET_ID, net_1) == {user_id: 100 for user_id in user_ids}
     logging.debug(f"USERS BALANCE SET")
 
 # Attempt an honest spend to test
@@ -249,7 +233,7 @@ def test_honest_transfer():
     logging.info("HONEST TRANSFER 10 COIN FROM B to C")
     command = [
         user_b["iroha"].command("TransferAsset", src_account_id=user_b["id"], dest_account_id=user_c["id"],
-                            asset_id="coin#pytest", amount="10")
+                            asset_id=ASSET_ID, amount="10")
     ]
     tx = IrohaCrypto.sign_transaction(
         user_b["iroha"].transaction(command), user_b["private_key"])
@@ -261,8 +245,8 @@ def test_honest_transfer():
     # Now check that both parties have the correct asset total
     user_b_assets = get_user_assets(user_b["id"])
     user_c_assets = get_user_assets(user_c["id"])
-    assert str(user_b_assets) == f'[asset_id: "coin#pytest"\naccount_id: "{user_b["id"]}"\nbalance: "90"\n]'
-    assert str(user_c_assets) == f'[asset_id: "coin#pytest"\naccount_id: "{user_c["id"]}"\nbalance: "110"\n]'
+    assert str(user_b_assets) == f'[asset_id: "{ASSET_ID}"\naccount_id: "{user_b["id"]}"\nbalance: "90"\n]'
+    assert str(user_c_assets) == f'[asset_id: "{ASSET_ID}"\naccount_id: "{user_c["id"]}"\nbalance: "110"\n]'
     logging.info("HONEST TRANSFER COMPLETE")
 
 # Attempt to commit Double Spending
@@ -274,9 +258,9 @@ def test_double_spending_same_transaction():
     logging.info("ATTEMPTING DOUBLE SPEND ONE TRANSACTION")
     tx = user_a["iroha"].transaction([
         user_a["iroha"].command('TransferAsset', src_account_id=f'{user_a["id"]}', dest_account_id=f'{user_b["id"]}',
-                          asset_id='coin#pytest', amount="100"),
+                          asset_id=ASSET_ID, amount="100"),
         user_a["iroha"].command('TransferAsset', src_account_id=f'{user_a["id"]}', dest_account_id=f'{user_c["id"]}',
-                          asset_id='coin#pytest', amount="100"),
+                          asset_id=ASSET_ID, amount="100"),
         
     ])
     tx = IrohaCrypto.sign_transaction(tx, user_a["private_key"])
@@ -289,7 +273,7 @@ def test_double_spending_same_transaction():
     # Now check no coin has left user A's account or entered user B or C
     for user in [user_a, user_b, user_c]:
         user_assets = get_user_assets(user['id'])
-        assert str(user_assets) == f'[asset_id: "coin#pytest"\naccount_id: "{user["id"]}"\nbalance: "100"\n]'
+        assert str(user_assets) == f'[asset_id: "{ASSET_ID}"\naccount_id: "{user["id"]}"\nbalance: "100"\n]'
 
     logging.info("NO COIN HAS BEEN TRANSFERRED")    
 
@@ -305,11 +289,11 @@ def test_double_spending_two_transactions():
     logging.info("ATTEMPTING DOUBLE SPEND ON TWO TRANSACTIONS")
     tx_1 = user_a["iroha"].transaction([
         user_a["iroha"].command('TransferAsset', src_account_id=f'{user_a["id"]}', dest_account_id=f'{user_b["id"]}',
-                          asset_id='coin#pytest', amount="100")
+                          asset_id=ASSET_ID, amount="100")
     ])
     tx_2 = user_a["iroha"].transaction([
         user_a["iroha"].command('TransferAsset', src_account_id=f'{user_a["id"]}', dest_account_id=f'{user_c["id"]}',
-                          asset_id='coin#pytest', amount="100")
+                          asset_id=ASSET_ID, amount="100")
     ])
 
     tx_1 = IrohaCrypto.sign_transaction(tx_1, user_a["private_key"])
@@ -377,9 +361,9 @@ def test_create_account_without_permission():
     """
 
     logging.info("ATTEMPTING TO CREATE NEW USER AS USER_A")
-    user_x = new_user("user_x", "pytest")
+    user_x = new_user("user_x", DOMAIN_ID)
     commands = [
-        user_a["iroha"].command('CreateAccount', account_name=f'{user_x["name"]}', domain_id='pytest',
+        user_a["iroha"].command('CreateAccount', account_name=f'{user_x["name"]}', domain_id=DOMAIN_ID,
                           public_key=user_x["public_key"]),
         
     ]
@@ -400,7 +384,7 @@ def test_sign_as_other_user():
     logging.info("ATTEMPTING TO SIGN AS OTHER USER, OWN PRIVATE KEY")
     commands = [
         user_a["iroha"].command("TransferAsset", src_account_id=f'{user_c["id"]}', dest_account_id=f'{user_a["id"]}',
-                    asset_id="coin#pytest", amount="10")
+                    asset_id=ASSET_ID, amount="10")
     ]
 
     tx = IrohaCrypto.sign_transaction(
@@ -421,7 +405,7 @@ def test_sign_as_other_user_compromised_private_key():
     logging.info("ATTEMPTING TO SIGN AS OTHER USER, COMPROMISED OTHER USER PRIVATE KEY")
     commands = [
         user_a["iroha"].command("TransferAsset", src_account_id=f'{user_c["id"]}', dest_account_id=f'{user_a["id"]}',
-                    asset_id="coin#pytest", amount="10")
+                    asset_id=ASSET_ID, amount="10")
     ]
 
     # Because private key is compromised, blockchain identity user_c["iroha"] can be used
@@ -446,7 +430,7 @@ def test_replay_own_transaction():
 
     commands = [
         user_a["iroha"].command("TransferAsset", src_account_id=f'{user_a["id"]}', dest_account_id=f'{user_c["id"]}',
-                    asset_id="coin#pytest", amount="10")
+                    asset_id=ASSET_ID, amount="10")
     ]
 
     tx = IrohaCrypto.sign_transaction(
@@ -464,8 +448,8 @@ def test_replay_own_transaction():
     # As it turns out, Iroha *will* accept a committed transaction again but returns the old response without replaying the effect 
     user_a_assets = get_user_assets(user_a['id'])
     user_c_assets = get_user_assets(user_c["id"])
-    assert str(user_a_assets) == f'[asset_id: "coin#pytest"\naccount_id: "{user_a["id"]}"\nbalance: "90"\n]'
-    assert str(user_c_assets) == f'[asset_id: "coin#pytest"\naccount_id: "{user_c["id"]}"\nbalance: "110"\n]'
+    assert str(user_a_assets) == f'[asset_id: "{ASSET_ID}"\naccount_id: "{user_a["id"]}"\nbalance: "90"\n]'
+    assert str(user_c_assets) == f'[asset_id: "{ASSET_ID}"\naccount_id: "{user_c["id"]}"\nbalance: "110"\n]'
     logging.info("REPLAY FAILED")
 
 # Attempt replay attack of others transaction
@@ -478,7 +462,7 @@ def test_replay_others_transaction():
     logging.debug("User C sends some coin to User B")
     commands = [
         user_c["iroha"].command("TransferAsset", src_account_id=f'{user_c["id"]}', dest_account_id=f'{user_b["id"]}',
-                    asset_id="coin#pytest", amount="10")
+                    asset_id=ASSET_ID, amount="10")
     ]
 
     tx = user_c["iroha"].transaction(commands)
@@ -499,8 +483,8 @@ def test_replay_others_transaction():
     # Again, the response code is from the first transaction, so is "committed" but the effect takes hold once
     user_b_assets = get_user_assets(user_b['id'])
     user_c_assets = get_user_assets(user_c["id"])
-    assert str(user_b_assets) == f'[asset_id: "coin#pytest"\naccount_id: "{user_b["id"]}"\nbalance: "110"\n]'
-    assert str(user_c_assets) == f'[asset_id: "coin#pytest"\naccount_id: "{user_c["id"]}"\nbalance: "90"\n]'
+    assert str(user_b_assets) == f'[asset_id: "{ASSET_ID}"\naccount_id: "{user_b["id"]}"\nbalance: "110"\n]'
+    assert str(user_c_assets) == f'[asset_id: "{ASSET_ID}"\naccount_id: "{user_c["id"]}"\nbalance: "90"\n]'
     logging.info("REPLAY ATTACK FAILED")
 
 def get_user_assets(user_id):
@@ -516,7 +500,7 @@ def get_user_assets(user_id):
 
     query = iroha_admin.query("GetAccountAssets", account_id=f"{user_id}")
     IrohaCrypto.sign_query(query, ADMIN_PRIVATE_KEY)
-    response = net_1.send_query(query)
+    response = net_1_cache.send_query(query)
     data = response.account_assets_response.account_assets
     return data
 
@@ -584,4 +568,11 @@ if __name__=="__main__":
     logging.info("SAVE BLOCKCHAIN LOGS TO malicious_client_testing_logs/")
     for i, grpc in enumerate(node_grpcs()):
         logging.info(f"\tSAVING LOGS OF node{i+1}")
-        log_all_blocks(grpc, f"node{i+1}.log", "malicious_client_testing_logs")
\ No newline at end of file
+        log_all_blocks(grpc, f"node{i+1}.jsonl", "malicious_client_testing_logs")
+
+    logging.info("CHECK ALL NODES HOLD THE SAME CHAIN")
+    report = check_chain_consistency(node_grpcs())
+    if report.consistent:
+        logging.info(f"\tNODES AGREE UP TO HEIGHT {report.common_height}, HEIGHTS {report.heights}")
+    else:
+        logging.warning(f"\tNODES DIVERGE AT HEIGHT {report.first_divergent_height}: {report.hashes}")
\ No newline at end of file
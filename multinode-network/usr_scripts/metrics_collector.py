@@ -0,0 +1,191 @@
+#! /bin/python
+
+"""
+Scrape the Prometheus metrics endpoint of every node at a fixed interval, and record them as time series
+Each node serves metrics on the port set by "metrics" in its config.docker (7001 to 7004, forwarded by docker-compose).
+All nodes are scraped concurrently, and each sample is parsed from the text exposition format into one compact
+array of floats per series, with a shared array of scrape times per node. A series missing from a scrape,
+or a failed scrape, is recorded as NaN so every array of a node stays aligned with its timestamps
+
+The recording can be saved as JSON next to a load test run (see load_generator.py --metrics), so a throughput dip
+can be lined up with block height, proposal and peer metrics from each node
+
+Usage:
+    python metrics_collector.py --interval 1 --duration 60 --out metrics.json
+"""
+from IrohaUtils import *
+import argparse
+import http.client
+import json
+import logging
+import math
+import re
+import sys
+import threading
+import time
+import urllib.request
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+
+# The first metrics port, node N serves metrics on METRICS_PORT + N - 1
+METRICS_PORT = int(os.getenv('IROHA_METRICS_PORT', '7001'))
+
+_SAMPLE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(\{.*\})?\s+(\S+)(?:\s+\S+)?$')
+_LABEL = re.compile(r'([a-zA-Z_][a-zA-Z0-9_]*)="((?:[^"\\]|\\.)*)"')
+
+
+def metrics_endpoints(connection=peers):
+    """
+    The metrics URL of each peer, on the host of its Torii address
+
+    Returns:
+        list of (String, String): The name and metrics URL of each peer
+    """
+
+    return [(peer.name, f"http://{peer.address.rsplit(':', 1)[0]}:{METRICS_PORT + i}/metrics")
+            for i, peer in enumerate(connection)]
+
+def parse_metrics(text):
+    """
+    Parse the Prometheus text exposition format
+
+    Args:
+        text (String): The body of a metrics endpoint
+
+    Returns:
+        dict of String to float: The value of each sample, keyed by its name and sorted labels, e.g. 'blocks_height'
+            or 'peer_status{peer="node2"}'
+    """
+
+    samples = {}
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        match = _SAMPLE.match(line)
+        if not match:
+            logging.debug(f"SKIPPING UNPARSEABLE METRIC LINE {line}")
+            continue
+        name, labels, value = match.groups()
+        if labels:
+            pairs = sorted(_LABEL.findall(labels))
+            name += "{" + ",".join(f'{key}="{value}"' for key, value in pairs) + "}"
+        try:
+            samples[name] = float(value)
+        except ValueError:
+            logging.debug(f"SKIPPING NON NUMERIC METRIC {line}")
+    return samples
+
+def scrape(url, timeout=2):
+    """Fetch and parse one metrics endpoint"""
+
+    with urllib.request.urlopen(url, timeout=timeout) as response:
+        return parse_metrics(response.read().decode())
+
+
+class MetricsRecorder:
+    """
+    Scrape several metrics endpoints concurrently at a fixed interval on a background thread
+
+    Usage:
+        with MetricsRecorder(metrics_endpoints(), interval=1) as recorder:
+            run_load(...)
+        recorder.save("metrics.json")
+    """
+
+    def __init__(self, endpoints, interval=1.0, timeout=None):
+        """
+        Args:
+            endpoints (list of (String, String)): The name and URL of each endpoint, as from metrics_endpoints
+            interval (float, optional): Seconds between scrapes. Defaults to 1
+            timeout (float, optional): Timeout of each scrape in seconds. Defaults to the interval
+        """
+
+        self.endpoints = endpoints
+        self.interval = interval
+        self.timeout = timeout or interval
+        # Per node, the time of each scrape and an array of values per series
+        self.timestamps = {name: array("d") for name, _ in endpoints}
+        self.series = {name: {} for name, _ in endpoints}
+        self._executor = ThreadPoolExecutor(max_workers=len(endpoints))
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _record(self, name, timestamp, samples):
+        timestamps, series = self.timestamps[name], self.series[name]
+        for key in samples.keys() - series.keys():
+            # A series first seen now was missing from every earlier scrape
+            series[key] = array("d", [math.nan] * len(timestamps))
+        timestamps.append(timestamp)
+        for key, values in series.items():
+            values.append(samples.get(key, math.nan))
+
+    def scrape_once(self):
+        """Scrape every endpoint concurrently and record the samples"""
+
+        timestamp = time.time()
+        futures = [(name, self._executor.submit(scrape, url, self.timeout)) for name, url in self.endpoints]
+        for name, future in futures:
+            try:
+                samples = future.result()
+            except (OSError, http.client.HTTPException, ValueError) as e:
+                # Unreachable, a truncated or malformed response, or a body that is not text
+                logging.warning(f"FAILED TO SCRAPE METRICS OF {name}: {e}")
+                samples = {}
+            self._record(name, timestamp, samples)
+
+    def _run(self):
+        next_scrape = time.monotonic()
+        while not self._stop.is_set():
+            self.scrape_once()
+            next_scrape += self.interval
+            self._stop.wait(max(0, next_scrape - time.monotonic()))
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="MetricsRecorder", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._executor.shutdown()
+
+    def to_dict(self):
+        """The recording as plain lists, NaN written as None"""
+
+        def values(arr):
+            return [None if math.isnan(v) else v for v in arr]
+
+        return {name: {
+            "timestamps": list(self.timestamps[name]),
+            "series": {key: values(arr) for key, arr in sorted(self.series[name].items())},
+        } for name, _ in self.endpoints}
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Record the Prometheus metrics of every node")
+    parser.add_argument("--interval", type=float, default=1.0, help="seconds between scrapes")
+    parser.add_argument("--duration", type=float, default=60, help="seconds to record for")
+    parser.add_argument("--out", default="metrics.json", help="file to save the recording to")
+    args = parser.parse_args(argv)
+
+    with MetricsRecorder(metrics_endpoints(), args.interval) as recorder:
+        time.sleep(args.duration)
+    recorder.save(args.out)
+    logging.info(f"SAVED {len(recorder.endpoints)} NODES OF METRICS TO {args.out}")
+
+if __name__=="__main__":
+    logging.basicConfig(level=logging.INFO)
+    main(sys.argv[1:])
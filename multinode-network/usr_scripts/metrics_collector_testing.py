@@ -0,0 +1,98 @@
+#! /bin/python
+
+"""
+Test parsing the Prometheus text format, and recording scrapes of a local HTTP server standing in for the nodes
+
+Run with pytest -rA -v metrics_collector_testing.py
+"""
+from metrics_collector import *
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+
+METRICS = """# HELP blocks_height Total number of blocks in chain
+# TYPE blocks_height gauge
+blocks_height 42
+peers_number 4
+total_number_of_transactions 1.5e3
+peer_status{status="online",peer="node2"} 1
+peer_status{peer="node3",status="offline"} 0
+queue_size{name="proposal"} NaN
+connected 1 1700000000000
+not a metric line at all
+"""
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Serves METRICS on /good, a response cut short on /truncated, and bytes that are not UTF-8 on /binary"""
+
+    def do_GET(self):
+        body = {"/good": METRICS.encode(), "/truncated": METRICS.encode(), "/binary": b"\xff\xfe\xfa"}[self.path]
+        self.send_response(200)
+        length = len(body) + (100 if self.path == "/truncated" else 0)
+        self.send_header("Content-Length", str(length))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(name="server", scope="module")
+def server_fixture():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+def test_parse_metrics():
+    """
+    Test samples are keyed by name and sorted labels, with comments, timestamps and bad lines skipped
+    """
+
+    samples = parse_metrics(METRICS)
+    assert samples["blocks_height"] == 42
+    assert samples["total_number_of_transactions"] == 1500
+    assert samples['peer_status{peer="node2",status="online"}'] == 1
+    assert samples['peer_status{peer="node3",status="offline"}'] == 0
+    assert math.isnan(samples['queue_size{name="proposal"}'])
+    assert samples["connected"] == 1
+    assert len(samples) == 7
+    assert parse_metrics("") == {}
+
+
+def test_parse_metrics_escaped_labels():
+    """
+    Test label values keep escaped quotes and commas
+    """
+
+    samples = parse_metrics('errors{reason="bad \\"tx\\", again"} 3\nerrors{reason="other"} not_a_number\n')
+    assert samples == {'errors{reason="bad \\"tx\\", again"}': 3}
+
+
+def test_failed_scrapes_recorded_as_nan(server):
+    """
+    Test an unreachable, truncated or undecodable endpoint records a row of NaN, aligned with the good endpoint
+    """
+
+    endpoints = [("good", f"{server}/good"), ("truncated", f"{server}/truncated"), ("binary", f"{server}/binary"),
+                 ("down", "http://127.0.0.1:1/metrics")]
+    recorder = MetricsRecorder(endpoints, interval=1)
+    try:
+        recorder.scrape_once()
+        recorder.scrape_once()
+        # A node that was scraped before and then fails gets NaN in each of its series
+        recorder.endpoints[0] = ("good", f"{server}/truncated")
+        recorder.scrape_once()
+    finally:
+        recorder.stop()
+    assert list(recorder.series["good"]["blocks_height"])[:2] == [42, 42]
+    assert all(math.isnan(values[-1]) for values in recorder.series["good"].values())
+    for name in ("truncated", "binary", "down"):
+        assert len(recorder.timestamps[name]) == 3
+        assert recorder.series[name] == {}
+    recording = recorder.to_dict()
+    assert recording["good"]["series"]["queue_size{name=\"proposal\"}"] == [None, None, None]
+    assert recording["down"] == {"timestamps": list(recorder.timestamps["down"]), "series": {}}
@@ -2,17 +2,32 @@
 
 """
 Test multinode Iroha network with several mundane scenarios, with logging of outputs
-This module assumes a fresh network, so make sure to run manage-network restart
-Also note these tests are ordered. Some tests create objects that will be used by later tests
-Do NOT employ pytest-random, as tests will fail. This is intended
+Each run, and each pytest-xdist worker, creates its own domain, asset and users, so this module can run
+on a network already in use, and alongside other tests
+Note these tests are ordered. Some tests create objects that will be used by later tests
+Do NOT employ pytest-random, as tests will fail. This is intended.
+The tests are grouped, so under pytest-xdist run with --dist loadgroup to keep them on one worker, in order, e.g.
+pytest -n 4 --dist loadgroup network_testing.py malicious_client_testing.py
 """
 from operator import le
 from IrohaUtils import *
+from peer_registry import (IROHA_HOST_ADDR_1, IROHA_PORT_1, IROHA_HOST_ADDR_2, IROHA_PORT_2, IROHA_HOST_ADDR_3,
+                           IROHA_PORT_3, IROHA_HOST_ADDR_4, IROHA_PORT_4)
+from async_iroha import async_connections, async_send_transaction, async_get_block
+from block_archive import BlockArchiveReader, archive_all_blocks
+import asyncio
 import pytest
 import logging
 import socket
 import sys
 
+# Keep these ordered tests on one pytest-xdist worker
+pytestmark = pytest.mark.xdist_group("network_testing")
+
+# Names unique to this run and worker, so concurrent runs do not share state
+DOMAIN_ID = f"pytest-{unique_suffix()}"
+ASSET_ID = f"coin#{DOMAIN_ID}"
+
 def node_locations():
     return[
         (IROHA_HOST_ADDR_1, int(IROHA_PORT_1)),
@@ -57,9 +72,9 @@ def test_create_domain():
     Test that an admin can create a domain
     """
 
-    logging.info("ATTEMPTING TO CREATE DOMAIN pytest")
+    logging.info(f"ATTEMPTING TO CREATE DOMAIN {DOMAIN_ID}")
     commands = [
-        iroha.command('CreateDomain', domain_id='pytest', default_role='user')
+        iroha.command('CreateDomain', domain_id=DOMAIN_ID, default_role='user')
     ]
 
     tx = IrohaCrypto.sign_transaction(
@@ -76,10 +91,10 @@ def test_create_asset():
     Test that an admin can create an asset on a domain
     """
 
-    logging.info("ATTEMPTING TO CREATE ASSET coin#pytest")
+    logging.info(f"ATTEMPTING TO CREATE ASSET {ASSET_ID}")
     commands = [
         iroha.command('CreateAsset', asset_name='coin',
-                      domain_id='pytest', precision=2)
+                      domain_id=DOMAIN_ID, precision=2)
     ]
 
     tx = IrohaCrypto.sign_transaction(
@@ -96,10 +111,10 @@ def test_add_asset():
     Test if an admin can add an asset to their account in a domain
     """
 
-    logging.info("ATTEMPTING TO ADD 1000 coin#pytest TO admin@test")
+    logging.info(f"ATTEMPTING TO ADD 1000 {ASSET_ID} TO admin@test")
     tx = iroha.transaction([
         iroha.command('AddAssetQuantity',
-                      asset_id='coin#pytest', amount='1000.00')
+                      asset_id=ASSET_ID, amount='1000.00')
     ])
     tx = IrohaCrypto.sign_transaction(tx, ADMIN_PRIVATE_KEY)
     logging.debug(tx)
@@ -121,7 +136,7 @@ def test_create_users(node_grpcs):
         user_private_key = IrohaCrypto.private_key()
         user_public_key = IrohaCrypto.derive_public_key(user_private_key)
         tx = iroha.transaction([
-            iroha.command('CreateAccount', account_name=f'user{i+1}', domain_id='pytest',
+            iroha.command('CreateAccount', account_name=f'user{i+1}', domain_id=DOMAIN_ID,
                           public_key=user_public_key)
         ])
         IrohaCrypto.sign_transaction(tx, ADMIN_PRIVATE_KEY)
@@ -137,13 +152,13 @@ def test_transfer_asset_to_users(node_grpcs):
     Test that an admin can transfer assets to other users
     """
 
-    logging.info("ATTEMPT TO TRANSFER coin#pytest FROM ADMIN TO USERS")
+    logging.info(f"ATTEMPT TO TRANSFER {ASSET_ID} FROM ADMIN TO USERS")
     
     for i, node_grpc in enumerate(node_grpcs):
         logging.info(f"\tTRANSFER TO USER{i+1} VIA NODE_{i+1}")
         tx = iroha.transaction([
-            iroha.command('TransferAsset', src_account_id='admin@test', dest_account_id=f'user{i+1}@pytest',
-                          asset_id='coin#pytest', description='Top Up', amount=f'{(i+1)*1.11}')
+            iroha.command('TransferAsset', src_account_id='admin@test', dest_account_id=f'user{i+1}@{DOMAIN_ID}',
+                          asset_id=ASSET_ID, description='Top Up', amount=f'{(i+1)*1.11}')
         ])
         IrohaCrypto.sign_transaction(tx, ADMIN_PRIVATE_KEY)
         logging.debug(tx)
@@ -156,18 +171,117 @@ def test_query_on_asset(node_grpcs):
     """
     Test that an admin can query an asset property
     """
-    logging.info("QUERY ASSET coin#pytest OVER EACH NODE")
+    logging.info(f"QUERY ASSET {ASSET_ID} OVER EACH NODE")
 
     for i, node_grpc in enumerate(node_grpcs):
         logging.info(f"\tQUERY OVER NODE_{i+1}")
-        query = iroha.query('GetAssetInfo', asset_id='coin#pytest')
+        query = iroha.query('GetAssetInfo', asset_id=ASSET_ID)
         IrohaCrypto.sign_query(query, ADMIN_PRIVATE_KEY)
         response = node_grpc.send_query(query)
         data = response.asset_response.asset
         logging.debug(data)
-        assert str(data) == 'asset_id: "coin#pytest"\ndomain_id: "pytest"\nprecision: 2\n'
+        assert str(data) == f'asset_id: "{ASSET_ID}"\ndomain_id: "{DOMAIN_ID}"\nprecision: 2\n'
         logging.info(f"\t\tSUCCESSFULLY QUERIED ASSET ON NODE_{i+1}")
 
+
+def test_async_send_transactions():
+    """
+    Test that transactions sent to every node at once from one event loop are all committed
+    """
+
+    logging.info("ATTEMPTING TO SEND A TRANSACTION TO EACH NODE AT ONCE")
+
+    async def send_to_each_node():
+        connections = async_connections()
+        transactions = []
+        for i in range(len(connections)):
+            tx = iroha.transaction([
+                iroha.command('SetAccountDetail', account_id=ADMIN_ACCOUNT_ID, key=f'async_node{i+1}', value='sent')
+            ])
+            IrohaCrypto.sign_transaction(tx, ADMIN_PRIVATE_KEY)
+            transactions.append(tx)
+        statuses = await asyncio.gather(*(
+            async_send_transaction(tx, connection) for tx, connection in zip(transactions, connections)))
+        return statuses, await async_get_block(1, connections[0])
+
+    statuses, block = asyncio.run(send_to_each_node())
+    logging.debug(statuses)
+    assert [status[0] for status in statuses] == ["COMMITTED"] * len(statuses)
+    assert block.block_response.block.block_v1.payload.height == 1
+    logging.info("\tSUCCESSFULLY COMMITTED A TRANSACTION ON EACH NODE")
+
+
+def test_get_all_blocks(node_grpcs):
+    """
+    Test that the chain downloaded in parallel ranges from every node is complete and in order
+    """
+
+    logging.info("ATTEMPTING TO DOWNLOAD THE CHAIN FROM ALL NODES AT ONCE")
+    height = get_chain_height(net_1)
+    blocks = get_all_blocks(net_1, node_grpcs, max_workers=4)
+    logging.debug(f"CHAIN HEIGHT {height}, {len(blocks)} BLOCKS DOWNLOADED")
+    assert len(blocks) >= height
+    assert [block.block_response.block.block_v1.payload.height for block in blocks] == \
+        list(range(1, len(blocks) + 1))
+    assert blocks[height - 1] == get_block(height, net_1)
+    logging.info(f"\tSUCCESSFULLY DOWNLOADED {len(blocks)} BLOCKS")
+
+
+def test_archive_all_blocks(tmp_path):
+    """
+    Test that the chain of a node archived to a binary block archive reads back block for block
+    """
+
+    logging.info("ATTEMPTING TO ARCHIVE THE CHAIN OF NODE_1")
+    archive_all_blocks(net_1, "node1.blocks", str(tmp_path))
+    with BlockArchiveReader(tmp_path / "node1.blocks") as archive:
+        height = archive.last_height
+        assert len(archive) == height
+        for block_number in (1, height):
+            assert archive.get_block(block_number) == get_block(block_number, net_1).block_response.block
+
+    logging.info("\tARCHIVE AGAIN, ONLY APPENDING NEW BLOCKS")
+    archive_all_blocks(net_1, "node1.blocks", str(tmp_path))
+    with BlockArchiveReader(tmp_path / "node1.blocks") as archive:
+        assert archive.last_height >= height
+        assert archive.get_block(height) == get_block(height, net_1).block_response.block
+    logging.info(f"\tSUCCESSFULLY ARCHIVED {height} BLOCKS")
+
+
+def test_chain_consistency(node_grpcs):
+    """
+    Test that every node holds the same chain
+    """
+
+    logging.info("CHECK ALL NODES HOLD THE SAME CHAIN")
+    report = check_chain_consistency(node_grpcs)
+    logging.debug(report)
+    assert report.consistent
+    assert report.common_height == min(report.heights.values()) > 0
+    logging.info(f"\tNODES AGREE UP TO HEIGHT {report.common_height}")
+
+
+def test_provision_accounts(tmp_path):
+    """
+    Test that accounts created many to a transaction exist, and that their keys are kept for the next run
+    """
+
+    logging.info("ATTEMPTING TO CREATE 600 ACCOUNTS IN {DOMAIN_ID}")
+    keystore = Keystore(tmp_path / "keystore.json")
+    users = provision_accounts(DOMAIN_ID, 600, keystore, connection=peers, prefix="bulk")
+    assert len(users) == 600
+    for user in (users[0], users[-1]):
+        query = iroha.query('GetAccount', account_id=user["id"])
+        IrohaCrypto.sign_query(query, ADMIN_PRIVATE_KEY)
+        response = net_1.send_query(query)
+        logging.debug(response)
+        assert response.account_response.account.account_id == user["id"]
+
+    logging.info("\tRELOAD THE KEYSTORE")
+    reloaded = Keystore(tmp_path / "keystore.json").users(DOMAIN_ID, 600, "bulk")
+    assert [user["private_key"] for user in reloaded] == [user["private_key"] for user in users]
+    logging.info("\tSUCCESSFULLY CREATED 600 ACCOUNTS")
+
 if __name__=="__main__":
     #logging.basicConfig(level=logging.DEBUG)
     logging.basicConfig(level=logging.INFO)
@@ -207,4 +321,11 @@ if __name__=="__main__":
     logging.info("SAVE BLOCKCHAIN LOGS TO network_testing_logs/")
     for i, grpc in enumerate(node_grpcs()):
         logging.info(f"\tSAVING LOGS OF node{i+1}")
-        log_all_blocks(grpc, f"node{i+1}.log", "network_testing_logs")
+        log_all_blocks(grpc, f"node{i+1}.jsonl", "network_testing_logs")
+
+    logging.info("CHECK ALL NODES HOLD THE SAME CHAIN")
+    report = check_chain_consistency(node_grpcs())
+    if report.consistent:
+        logging.info(f"\tNODES AGREE UP TO HEIGHT {report.common_height}, HEIGHTS {report.heights}")
+    else:
+        logging.warning(f"\tNODES DIVERGE AT HEIGHT {report.first_divergent_height}: {report.hashes}")
@@ -0,0 +1,605 @@
+"""
+Connections to the peers of the network: a PeerConnection per peer, tracking its latency and health, and a
+PeerRegistry choosing between them, hedging queries and failing transactions over
+
+Usage:
+    from peer_registry import PeerRegistry
+    registry = PeerRegistry.from_config("peers.json", policy="least_outstanding")
+    send_transaction(tx, registry.select())
+"""
+import os
+import binascii
+import json
+import logging
+import queue
+import threading
+import time
+import weakref
+from collections import OrderedDict, deque
+import grpc
+from iroha import IrohaCrypto, IrohaGrpc
+from iroha import endpoint_pb2, endpoint_pb2_grpc
+from profiling import active_profiler
+
+# Iroha peer 1
+IROHA_HOST_ADDR_1 = os.getenv('IROHA_HOST_ADDR_1', '172.29.101.121')
+IROHA_PORT_1 = os.getenv('IROHA_PORT_1', '50051')
+# Iroha peer 2
+IROHA_HOST_ADDR_2 = os.getenv('IROHA_HOST_ADDR_2', '172.29.101.122')
+IROHA_PORT_2 = os.getenv('IROHA_PORT_2', '50052')
+# Iroha peer 3
+IROHA_HOST_ADDR_3 = os.getenv('IROHA_HOST_ADDR_3', '172.29.101.123')
+IROHA_PORT_3 = os.getenv('IROHA_PORT_3', '50053')
+# Iroha peer 4
+IROHA_HOST_ADDR_4 = os.getenv('IROHA_HOST_ADDR_4', '172.29.101.124')
+IROHA_PORT_4 = os.getenv('IROHA_PORT_4', '50054')
+# Further peers can be added with IROHA_HOST_ADDR_5, IROHA_PORT_5 and so on
+
+# Channels are kept open and reused, with keepalive pings while calls are in flight.
+# Iroha (as any gRPC server by default) rejects pings more often than every 5 minutes
+GRPC_CHANNEL_OPTIONS = [
+    ('grpc.keepalive_time_ms', 300000),
+    ('grpc.keepalive_timeout_ms', 20000),
+    ('grpc.keepalive_permit_without_calls', 0),
+]
+
+
+# The live QueryCaches of this process, which a PeerConnection drops as soon as it sees a transaction COMMITTED
+_query_caches = weakref.WeakSet()
+
+def _invalidate_query_caches():
+    for cache in list(_query_caches):
+        cache.invalidate()
+
+# How far through Iroha's pipeline each status is, so a stream resumed on another peer can skip what was seen
+_STATUS_PROGRESS = {
+    "NOT_RECEIVED": 0,
+    "STATELESS_VALIDATION_SUCCESS": 1,
+    "MST_PENDING": 2,
+    "ENOUGH_SIGNATURES_COLLECTED": 3,
+    "STATEFUL_VALIDATION_SUCCESS": 4,
+    "STATEFUL_VALIDATION_FAILED": 4,
+    "STATELESS_VALIDATION_FAILED": 5,
+    "REJECTED": 5,
+    "COMMITTED": 5,
+    "MST_EXPIRED": 5,
+}
+
+
+class StreamIdleError(grpc.RpcError):
+    """A status stream that sent nothing for longer than its idle timeout, treated as a call that timed out"""
+
+    def __init__(self, message):
+        super().__init__(message)
+        self._message = message
+
+    def code(self):
+        return grpc.StatusCode.DEADLINE_EXCEEDED
+
+    def details(self):
+        return self._message
+
+
+class PeerConnection(IrohaGrpc):
+    """An IrohaGrpc connection to one peer that keeps its channel alive for reuse,
+    and tracks the number of outstanding calls, their latency and the health of the peer so peers can be compared
+    A peer is unhealthy for a cooldown after a call fails as unavailable or timed out,
+    the cooldown doubling with each consecutive failure
+    """
+
+    # Weight of the newest sample in the moving average of latency
+    LATENCY_SMOOTHING = 0.2
+    # Number of recent latencies kept for percentiles
+    LATENCY_SAMPLES = 100
+    # Calls failing with these codes count against the health of the peer
+    FAILURE_CODES = (grpc.StatusCode.UNAVAILABLE, grpc.StatusCode.DEADLINE_EXCEEDED)
+    # Seconds an unhealthy peer is avoided for after its first failure, and at most
+    COOLDOWN = 1.0
+    MAX_COOLDOWN = 30.0
+    # A StageLatencyRecorder timing the status transitions of every transaction sent and streamed, if set
+    stage_recorder = None
+
+    def __init__(self, address, name=None, timeout=10, options=None):
+        """
+        Args:
+            address (String): Iroha Torii address with port, e.g. 172.29.101.121:50051
+            name (String, optional): A name for the peer, e.g. node1. Defaults to the address
+            timeout (float, optional): Timeout for network I/O operations in seconds. Defaults to 10
+            options (list of tuple, optional): gRPC channel options. Defaults to GRPC_CHANNEL_OPTIONS
+        """
+
+        super().__init__(address, timeout)
+        # IrohaGrpc takes no channel options, so its channel is swapped for one with keepalive before any call uses it.
+        # Channels connect lazily, so the one closed never opened a connection
+        self._channel.close()
+        self._channel = grpc.insecure_channel(address, options=GRPC_CHANNEL_OPTIONS if options is None else options)
+        self._command_service_stub = endpoint_pb2_grpc.CommandService_v1Stub(self._channel)
+        self._query_service_stub = endpoint_pb2_grpc.QueryService_v1Stub(self._channel)
+        self.name = name or address
+        self.outstanding = 0
+        self.latency = None
+        self.failures = 0
+        self._unhealthy_until = 0
+        self._latencies = deque(maxlen=self.LATENCY_SAMPLES)
+        self._stats_lock = threading.Lock()
+
+    def __repr__(self):
+        return f"PeerConnection({self.name}, {self._address})"
+
+    @property
+    def address(self):
+        return self._address
+
+    @property
+    def healthy(self):
+        """False while the peer is cooling down after failing"""
+        return time.monotonic() >= self._unhealthy_until
+
+    def latency_percentile(self, percentile, default=None):
+        """The given percentile of recent call latencies in seconds, or default if there are none yet"""
+
+        with self._stats_lock:
+            samples = sorted(self._latencies)
+        if not samples:
+            return default
+        return samples[round(percentile / 100 * (len(samples) - 1))]
+
+    def _record(self, elapsed=None, error=None):
+        """Record the end of a call, with its latency if it succeeded or the error if it failed"""
+
+        with self._stats_lock:
+            self.outstanding -= 1
+            if isinstance(error, grpc.RpcError) and error.code() in self.FAILURE_CODES:
+                self.failures += 1
+                cooldown = min(self.COOLDOWN * 2 ** (self.failures - 1), self.MAX_COOLDOWN)
+                self._unhealthy_until = time.monotonic() + cooldown
+                logging.warning(f"{self.name} FAILED ({error.code().name}), AVOIDING FOR {cooldown}s")
+                return
+            self.failures = 0
+            if elapsed is not None:
+                self._latencies.append(elapsed)
+                self.latency = elapsed if self.latency is None else \
+                    self.LATENCY_SMOOTHING * elapsed + (1 - self.LATENCY_SMOOTHING) * self.latency
+
+    def _call(self, method, *args, **kwargs):
+        with self._stats_lock:
+            self.outstanding += 1
+        profiler = active_profiler()
+        token = profiler and profiler.begin(f"PeerConnection.{method.__name__}", self.name)
+        start = time.monotonic()
+        try:
+            result = method(*args, **kwargs)
+        except Exception as e:
+            self._record(error=e)
+            if token:
+                profiler.end(token, error=True)
+            raise
+        self._record(time.monotonic() - start)
+        if token:
+            profiler.end(token)
+        return result
+
+    def send_tx(self, transaction, timeout=None):
+        if self.stage_recorder is not None:
+            self.stage_recorder.sent(IrohaCrypto.hash(transaction))
+        return self._call(super().send_tx, transaction, timeout)
+
+    def send_txs(self, transactions, timeout=None):
+        if self.stage_recorder is not None:
+            for transaction in transactions:
+                self.stage_recorder.sent(IrohaCrypto.hash(transaction))
+        return self._call(super().send_txs, transactions, timeout)
+
+    def send_query(self, query, timeout=None):
+        return self._call(super().send_query, query, timeout)
+
+    def tx_status(self, transaction, timeout=None):
+        return self._call(super().tx_status, transaction, timeout)
+
+    def send_query_future(self, query, timeout=None):
+        """Send a query without waiting for the response
+
+        Returns:
+            grpc.Future: The call, resolving to the protobuf response to the query
+        """
+
+        with self._stats_lock:
+            self.outstanding += 1
+        start = time.monotonic()
+        future = self._query_service_stub.Find.future(query, timeout=timeout or self._timeout)
+
+        def done(f):
+            # A call cancelled because it was hedged says nothing of the peer's latency or health
+            if f.cancelled():
+                with self._stats_lock:
+                    self.outstanding -= 1
+            elif f.exception() is not None:
+                self._record(error=f.exception())
+            else:
+                self._record(time.monotonic() - start)
+
+        future.add_done_callback(done)
+        return future
+
+    def _watched_status_stream(self, transaction_hash, timeout, idle_timeout):
+        """Stream the statuses of a transaction, cancelling the stream if the peer sends nothing for idle_timeout
+        Only time spent waiting on the peer counts, not time the caller spends between statuses"""
+
+        request = endpoint_pb2.TxStatusRequest(tx_hash=binascii.hexlify(transaction_hash)
+                                               if isinstance(transaction_hash, bytes) else transaction_hash.encode())
+        call = self._command_service_stub.StatusStream(request, timeout=timeout)
+        idle = threading.Event()
+
+        def expire():
+            idle.set()
+            call.cancel()
+
+        try:
+            while True:
+                timer = threading.Timer(idle_timeout, expire)
+                timer.daemon = True
+                timer.start()
+                try:
+                    status = next(call)
+                except StopIteration:
+                    return
+                except grpc.RpcError as e:
+                    if idle.is_set():
+                        raise StreamIdleError(f"{self.name} sent no status for {idle_timeout}s") from e
+                    raise
+                finally:
+                    timer.cancel()
+                yield self._parse_tx_status(status)
+        finally:
+            call.cancel()
+
+    def tx_hash_status_stream(self, transaction_hash, timeout=None, idle_timeout=None):
+        """Stream the statuses of a transaction, as IrohaGrpc does
+
+        Args:
+            transaction_hash (bytes or String): The hash of the transaction
+            timeout (float, optional): Timeout of the whole stream in seconds. Defaults to the peer timeout,
+                or to none if idle_timeout is given
+            idle_timeout (float, optional): Seconds to wait for each status before failing with StreamIdleError
+
+        Yields:
+            tuple: Symbolic status, integral status code, and error code (0 if no error occurred)
+        """
+
+        # Streams count as outstanding, but their length is not a latency sample
+        with self._stats_lock:
+            self.outstanding += 1
+        error = None
+        recorder = self.stage_recorder
+        profiler = active_profiler()
+        token = profiler and profiler.begin("PeerConnection.tx_hash_status_stream", self.name)
+        try:
+            transitions = []
+            statuses = super().tx_hash_status_stream(transaction_hash, timeout) if idle_timeout is None else \
+                self._watched_status_stream(transaction_hash, timeout, idle_timeout)
+            for status in statuses:
+                if recorder is not None and (not transitions or transitions[-1][0] != status[0]):
+                    transitions.append((status[0], time.monotonic()))
+                if status[0] == "COMMITTED" and _query_caches:
+                    # Drop cached reads before the caller can read its own write
+                    _invalidate_query_caches()
+                yield status
+            if recorder is not None:
+                recorder.record(transaction_hash, self.name, transitions)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self._record(error=error)
+            if token:
+                profiler.end(token, error is not None, cpu=False)
+
+    def fetch_commits(self, query):
+        """Open a FetchCommits stream of newly committed blocks, with no deadline
+
+        Args:
+            query (BlocksQuery): The signed blocks query
+
+        Returns:
+            grpc call: Iterates over BlockQueryResponse, one per block committed. cancel() ends it
+        """
+
+        return self._query_service_stub.FetchCommits(query)
+
+    def close(self):
+        self._channel.close()
+
+
+class PeerRegistry:
+    """The peers of the network, each with one pooled PeerConnection, and policies to choose between them
+    Unhealthy peers are skipped while any healthy peer remains.
+
+    A registry can also be used in place of a connection, e.g. send_transaction(tx, peers) or get_block(1, peers).
+    Queries are then hedged: if a peer has not answered by a percentile of its recent latencies,
+    the query is also sent to another peer and the first answer wins. Transactions are sent to a
+    healthy peer, and to the next if it is unavailable. A status stream that fails, or sends nothing for its timeout,
+    is resumed on another peer after resending the transaction there. Both are safe as Iroha handles a transaction once per hash
+
+    Selection policies:
+        round_robin: each peer in turn
+        least_outstanding: the peer with the fewest calls in flight
+        latency: the peer with the lowest expected wait, its average latency times (outstanding calls + 1).
+            Peers without a latency sample yet are tried first
+    """
+
+    POLICIES = ("round_robin", "least_outstanding", "latency")
+    # Seconds to wait before hedging a query to a peer with no latency samples yet
+    HEDGE_DELAY = 1.0
+    # Transactions remembered for resending on failover, before the oldest are forgotten
+    MAX_SENT_TRANSACTIONS = 10000
+
+    def __init__(self, peers=(), timeout=10, policy="round_robin", send_timeout=2, hedge_percentile=95):
+        """
+        Args:
+            peers (list of (String, String), optional): (name, address) of each peer. Defaults to none
+            timeout (float, optional): Timeout for network I/O operations in seconds. Defaults to 10
+            policy (String, optional): The default selection policy. Defaults to round_robin
+            send_timeout (float, optional): Timeout in seconds for sending a transaction to one peer,
+                before failing over to the next. Defaults to 2
+            hedge_percentile (float, optional): The percentile of a peer's latency after which a query
+                is also sent to another peer. Defaults to 95
+        """
+
+        if policy not in self.POLICIES:
+            raise ValueError(f"Unknown peer selection policy {policy}, expected one of {self.POLICIES}")
+        self.timeout = timeout
+        self.policy = policy
+        self.send_timeout = send_timeout
+        self.hedge_percentile = hedge_percentile
+        self._peers = {}
+        self._lock = threading.Lock()
+        self._next = 0
+        self._sent = OrderedDict()
+        for name, address in peers:
+            self.add_peer(name, address)
+
+    @classmethod
+    def from_env(cls, **kwargs):
+        """Create a registry from the IROHA_HOST_ADDR_n and IROHA_PORT_n environment variables
+        Peers 1 to 4 have the defaults of this network, further peers are read until one is not set
+        """
+
+        peers = [(f"node{i+1}", f"{address}:{port}") for i, (address, port) in enumerate([
+            (IROHA_HOST_ADDR_1, IROHA_PORT_1),
+            (IROHA_HOST_ADDR_2, IROHA_PORT_2),
+            (IROHA_HOST_ADDR_3, IROHA_PORT_3),
+            (IROHA_HOST_ADDR_4, IROHA_PORT_4),
+        ])]
+        n = 5
+        while os.getenv(f'IROHA_HOST_ADDR_{n}'):
+            peers.append((f"node{n}", f"{os.getenv(f'IROHA_HOST_ADDR_{n}')}:{os.getenv(f'IROHA_PORT_{n}', '50051')}"))
+            n += 1
+        return cls(peers, **kwargs)
+
+    @classmethod
+    def from_config(cls, path, **kwargs):
+        """Create a registry from a JSON config file of the form
+        {"peers": [{"name": "node1", "address": "172.29.101.121:50051"}, ...]}
+        """
+
+        with open(path) as f:
+            config = json.load(f)
+        return cls([(peer.get("name", peer["address"]), peer["address"]) for peer in config["peers"]], **kwargs)
+
+    @classmethod
+    def from_genesis(cls, path, torii_ports=None, **kwargs):
+        """Create a registry from the addPeer commands of a genesis block
+        The genesis block holds each peer's internal address, so the host is taken from it and
+        paired with the peer's Torii port
+
+        Args:
+            path (String): Path to the genesis block, e.g. ../network/shared_init/genesis.block
+            torii_ports (list of int, optional): The Torii port of each peer, in the order they are added.
+                Defaults to 50051, 50052, ... as in the config.docker of this network
+        """
+
+        with open(path) as f:
+            genesis = json.load(f)
+        hosts = []
+        for transaction in genesis["block_v1"]["payload"]["transactions"]:
+            for command in transaction["payload"]["reducedPayload"]["commands"]:
+                if "addPeer" in command:
+                    hosts.append(command["addPeer"]["peer"]["address"].rsplit(":", 1)[0])
+        torii_ports = torii_ports or [50051 + i for i in range(len(hosts))]
+        return cls([(f"node{i+1}", f"{host}:{port}") for i, (host, port) in enumerate(zip(hosts, torii_ports))], **kwargs)
+
+    def add_peer(self, name, address):
+        """Add a peer to the registry, reusing its connection if the address is already known
+
+        Returns:
+            PeerConnection: The connection to the peer
+        """
+
+        with self._lock:
+            for connection in self._peers.values():
+                if connection.address == address:
+                    self._peers[name] = connection
+                    return connection
+            connection = PeerConnection(address, name, timeout=self.timeout)
+            self._peers[name] = connection
+            return connection
+
+    def remove_peer(self, name):
+        with self._lock:
+            connection = self._peers.pop(name)
+        if connection not in self._peers.values():
+            connection.close()
+
+    def __getitem__(self, name):
+        return self._peers[name]
+
+    def __len__(self):
+        return len(self._peers)
+
+    def __iter__(self):
+        return iter(self.connections())
+
+    def connections(self):
+        """The connection to every peer, in the order they were added"""
+        with self._lock:
+            return list(self._peers.values())
+
+    def select(self, policy=None, exclude=()):
+        """Choose a peer to send the next call to, preferring healthy peers
+
+        Args:
+            policy (String, optional): One of POLICIES. Defaults to the policy of the registry
+            exclude (list of PeerConnection, optional): Peers not to choose, e.g. those already tried
+
+        Returns:
+            PeerConnection: The chosen peer
+        """
+
+        policy = policy or self.policy
+        connections = [c for c in self.connections() if c not in exclude]
+        if not connections:
+            raise LookupError("No peers left in the registry to choose from")
+        connections = [c for c in connections if c.healthy] or connections
+        if policy == "least_outstanding":
+            return min(connections, key=lambda c: c.outstanding)
+        if policy == "latency":
+            return min(connections, key=lambda c: (c.latency or 0) * (c.outstanding + 1))
+        if policy != "round_robin":
+            raise ValueError(f"Unknown peer selection policy {policy}, expected one of {self.POLICIES}")
+        with self._lock:
+            self._next += 1
+            return connections[(self._next - 1) % len(connections)]
+
+    def send_query(self, query, timeout=None, max_attempts=3):
+        """Send a query, hedging it to other peers if the chosen peer is slow or fails
+
+        Args:
+            query (Iroha.query): The signed query
+            timeout (float, optional): Timeout of each attempt in seconds. Defaults to the peer timeout
+            max_attempts (int, optional): The most peers to send the query to. Defaults to 3
+
+        Returns:
+            The protobuf response to the query, from whichever peer answered first
+
+        Throws:
+            grpc.RpcError of the last attempt if every attempt failed
+        """
+
+        max_attempts = min(max_attempts, len(self))
+        answers = queue.Queue()
+        tried, calls = [], []
+
+        def attempt():
+            connection = self.select(exclude=tried)
+            tried.append(connection)
+            call = connection.send_query_future(query, timeout)
+            call.add_done_callback(answers.put)
+            calls.append(call)
+            return connection
+
+        connection = attempt()
+        waiting = 1
+        try:
+            while True:
+                can_hedge = len(tried) < max_attempts
+                hedge_after = connection.latency_percentile(self.hedge_percentile, self.HEDGE_DELAY)
+                try:
+                    call = answers.get(timeout=hedge_after if can_hedge else None)
+                except queue.Empty:
+                    logging.debug(f"{connection.name} SLOWER THAN {hedge_after:.3f}s, HEDGING QUERY")
+                    connection = attempt()
+                    waiting += 1
+                    continue
+                waiting -= 1
+                if call.exception() is None:
+                    return call.result()
+                if can_hedge:
+                    connection = attempt()
+                    waiting += 1
+                elif waiting == 0:
+                    raise call.exception()
+        finally:
+            for call in calls:
+                call.cancel()
+
+    def _remember(self, transaction, connection):
+        tx_hash = IrohaCrypto.hash(transaction)
+        with self._lock:
+            self._sent[tx_hash] = (transaction, connection)
+            self._sent.move_to_end(tx_hash)
+            while len(self._sent) > self.MAX_SENT_TRANSACTIONS:
+                self._sent.popitem(last=False)
+
+    def _failover(self, send, tried):
+        """Call send with healthy peers in turn until one accepts, returning that peer"""
+
+        while True:
+            connection = self.select(exclude=tried)
+            tried.append(connection)
+            try:
+                send(connection)
+                return connection
+            except grpc.RpcError as e:
+                if e.code() not in PeerConnection.FAILURE_CODES or len(tried) >= len(self):
+                    raise
+                logging.warning(f"{connection.name} UNAVAILABLE, FAILING OVER")
+
+    def send_tx(self, transaction, timeout=None):
+        """Send a transaction to a healthy peer, failing over to the next if it is unavailable"""
+
+        connection = self._failover(
+            lambda c: c.send_tx(transaction, timeout or self.send_timeout), [])
+        self._remember(transaction, connection)
+
+    def send_txs(self, transactions, timeout=None):
+        """Send a series of transactions to a healthy peer, failing over to the next if it is unavailable"""
+
+        connection = self._failover(
+            lambda c: c.send_txs(transactions, timeout or self.send_timeout), [])
+        for transaction in transactions:
+            self._remember(transaction, connection)
+
+    def tx_status_stream(self, transaction, timeout=None):
+        # Only transactions sent through the registry are resent on failover, others are only streamed
+        yield from self.tx_hash_status_stream(IrohaCrypto.hash(transaction), timeout)
+
+    def tx_hash_status_stream(self, transaction_hash, timeout=None):
+        """Stream the statuses of a transaction from the peer it was sent to,
+        resending it to and resuming on another peer if that peer fails or stops sending statuses.
+        A resumed stream skips the statuses already yielded, and any from earlier in the pipeline
+
+        Args:
+            transaction_hash (bytes): The hash of a transaction sent through the registry
+            timeout (float, optional): Seconds to wait for each status before resuming on another peer.
+                Defaults to the peer timeout
+
+        Yields:
+            tuple: Symbolic status, integral status code, and error code (0 if no error occurred)
+        """
+
+        with self._lock:
+            transaction, connection = self._sent.pop(transaction_hash, (None, None))
+        tried = [connection] if connection is not None else []
+        progress = -1
+        while True:
+            if connection is None and transaction is None:
+                connection = self.select(exclude=tried)
+                tried.append(connection)
+            elif connection is None:
+                connection = self._failover(lambda c: c.send_tx(transaction, self.send_timeout), tried)
+            try:
+                for status in connection.tx_hash_status_stream(transaction_hash, None, timeout or connection._timeout):
+                    if progress >= 0 and _STATUS_PROGRESS.get(status[0], progress + 1) <= progress:
+                        continue
+                    progress = max(progress, _STATUS_PROGRESS.get(status[0], progress))
+                    yield status
+                return
+            except grpc.RpcError as e:
+                if e.code() not in PeerConnection.FAILURE_CODES or len(tried) >= len(self):
+                    raise
+                logging.warning(f"{connection.name} STATUS STREAM FAILED, RESUMING ON ANOTHER PEER")
+                connection = None
+
+    def close(self):
+        for connection in set(self.connections()):
+            connection.close()
@@ -0,0 +1,415 @@
+"""
+Profiling of the Iroha client: call counts and timings of traced functions and peer calls, and latency histograms
+of the statuses transactions pass through
+
+Usage:
+    from profiling import Profiler
+    with Profiler(spans=True) as profiler:
+        send_transaction(tx, net_1)
+    print(profiler.format_table())
+"""
+import os
+import asyncio
+import atexit
+import binascii
+import functools
+import inspect
+import json
+import logging
+import math
+import multiprocessing
+import threading
+import time
+from collections import OrderedDict, deque
+from iroha import IrohaGrpc
+
+# Instrumentation --------------------------------------------------------------
+# Every function decorated with @trace, and every call a PeerConnection makes, reports to the active Profiler.
+# With no profiler active (the default) a traced call costs one global lookup on top of the call itself.
+# Set IROHA_PROFILE to a file name to profile a whole script without changing it: a profiler is enabled
+# on import, and on exit its table is logged and its spans are written to that file
+
+_profiler = None
+
+def active_profiler():
+    """The Profiler calls are reported to, None while profiling is off"""
+    return _profiler
+
+class Profiler:
+    """Call counts, wall and CPU time and in flight calls per function and per peer, and optionally spans
+
+    Spans are exported in the Chrome trace event format, which chrome://tracing and https://ui.perfetto.dev open.
+    CPU time is that of the calling thread, so is not measured for coroutines, which share their thread
+
+    Usage:
+        with Profiler(spans=True) as profiler:
+            ... run the client ...
+        print(profiler.format_table())
+        profiler.save_spans("trace.json")
+    """
+
+    def __init__(self, spans=False, max_spans=100000):
+        """
+        Args:
+            spans (bool, optional): Also keep a span per call, for export. Defaults to False
+            max_spans (int, optional): The most recent spans kept. Defaults to 100000
+        """
+
+        self.stats = {}
+        self.spans = deque(maxlen=max_spans) if spans else None
+        self._lock = threading.Lock()
+        self._epoch = time.perf_counter()
+        self._previous = None
+
+    def __enter__(self):
+        global _profiler
+        self._previous, _profiler = _profiler, self
+        return self
+
+    def __exit__(self, *exc_info):
+        global _profiler
+        _profiler = self._previous
+
+    def begin(self, name, peer=None):
+        """Mark a call as started, returning the token to end it with"""
+
+        key = (name, peer)
+        with self._lock:
+            stats = self.stats.get(key)
+            if stats is None:
+                stats = self.stats[key] = {"calls": 0, "errors": 0, "wall": 0.0, "cpu": 0.0,
+                                           "in_flight": 0, "max_in_flight": 0}
+            stats["in_flight"] += 1
+            stats["max_in_flight"] = max(stats["max_in_flight"], stats["in_flight"])
+        return key, time.perf_counter(), time.thread_time()
+
+    def end(self, token, error=False, cpu=True):
+        """Mark a call as finished, given the token begin returned"""
+
+        key, start, cpu_start = token
+        now = time.perf_counter()
+        cpu_time = time.thread_time() - cpu_start if cpu else 0.0
+        with self._lock:
+            stats = self.stats[key]
+            stats["in_flight"] -= 1
+            stats["calls"] += 1
+            stats["errors"] += bool(error)
+            stats["wall"] += now - start
+            stats["cpu"] += cpu_time
+            if self.spans is not None:
+                name, peer = key
+                self.spans.append({
+                    "name": name, "cat": peer or "client", "ph": "X", "pid": os.getpid(),
+                    "tid": threading.get_ident(), "ts": (start - self._epoch) * 1e6, "dur": (now - start) * 1e6,
+                    "args": {"peer": peer, "error": bool(error)},
+                })
+
+    def format_table(self):
+        """The statistics of each function and peer, slowest total wall time first, as a plain text table"""
+
+        rows = [("function", "peer", "calls", "errors", "wall s", "mean ms", "cpu s", "in flight", "max in flight")]
+        with self._lock:
+            for (name, peer), stats in sorted(self.stats.items(), key=lambda item: -item[1]["wall"]):
+                rows.append((name, peer or "-", str(stats["calls"]), str(stats["errors"]), f"{stats['wall']:.3f}",
+                             f"{stats['wall'] / stats['calls'] * 1000:.2f}" if stats["calls"] else "-",
+                             f"{stats['cpu']:.3f}", str(stats["in_flight"]), str(stats["max_in_flight"])))
+        widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+        return "\n".join("  ".join(cell.rjust(width) for cell, width in zip(row, widths)) for row in rows)
+
+    def save_spans(self, path):
+        """Write the spans kept to a file in the Chrome trace event format"""
+
+        with self._lock:
+            events = list(self.spans or ())
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+def enable_profiling(spans=False):
+    """Start profiling every traced function and peer call, returning the new Profiler"""
+
+    global _profiler
+    _profiler = Profiler(spans)
+    return _profiler
+
+def disable_profiling():
+    """Stop profiling, returning the Profiler that was active, if any"""
+
+    global _profiler
+    profiler, _profiler = _profiler, None
+    return profiler
+
+def _peer_name(args, kwargs):
+    """The name of the peer a traced call goes to, from its connection argument"""
+
+    connection = kwargs.get("connection")
+    if connection is None:
+        connection = next((arg for arg in args if isinstance(arg, IrohaGrpc)), None)
+    return getattr(connection, "name", None)
+
+def trace(func):
+    """
+    A decorator reporting the calls of a function to the active Profiler, if any
+    Calls of generator functions are timed until the generator is exhausted or closed
+    """
+
+    name = func.__qualname__
+
+    @functools.wraps(func)
+    def tracer(*args, **kwargs):
+        profiler = _profiler
+        if profiler is None:
+            return func(*args, **kwargs)
+        token = profiler.begin(name, _peer_name(args, kwargs))
+        error = True
+        try:
+            result = func(*args, **kwargs)
+            error = False
+            return result
+        finally:
+            profiler.end(token, error)
+
+    @functools.wraps(func)
+    def generator_tracer(*args, **kwargs):
+        profiler = _profiler
+        if profiler is None:
+            return (yield from func(*args, **kwargs))
+        token = profiler.begin(name, _peer_name(args, kwargs))
+        error = True
+        try:
+            result = yield from func(*args, **kwargs)
+            error = False
+            return result
+        except GeneratorExit:
+            error = False
+            raise
+        finally:
+            profiler.end(token, error, cpu=False)
+
+    @functools.wraps(func)
+    async def async_tracer(*args, **kwargs):
+        profiler = _profiler
+        if profiler is None:
+            return await func(*args, **kwargs)
+        token = profiler.begin(name, _peer_name(args, kwargs))
+        error = True
+        try:
+            result = await func(*args, **kwargs)
+            error = False
+            return result
+        finally:
+            profiler.end(token, error, cpu=False)
+
+    if asyncio.iscoroutinefunction(func):
+        return async_tracer
+    if inspect.isgeneratorfunction(func):
+        return generator_tracer
+    return tracer
+
+def _save_profile(path):
+    profiler = disable_profiling()
+    if profiler is not None:
+        logging.info(f"PROFILE\n{profiler.format_table()}")
+        profiler.save_spans(path)
+
+# Worker processes, e.g. of sign_transactions, import this module too but are not profiled
+if os.getenv('IROHA_PROFILE') and multiprocessing.parent_process() is None:
+    enable_profiling(spans=True)
+    atexit.register(_save_profile, os.getenv('IROHA_PROFILE'))
+
+
+# Stage latencies --------------------------------------------------------------
+# A transaction passes through a path of statuses, e.g. ENOUGH_SIGNATURES_COLLECTED,
+# STATEFUL_VALIDATION_SUCCESS then COMMITTED. When PeerConnection.stage_recorder is set, the time a
+# transaction is sent and the arrival of each status on its stream are timestamped, and the time spent
+# reaching each status (since the previous one, or since sending for the first) is recorded per stage and per peer
+
+class LatencyHistogram:
+    """A histogram of latencies with a bounded relative error, in the style of an HDR histogram
+    Values are counted in microseconds. Values below 2^SUB_BUCKET_BITS are counted exactly, and above that each
+    power of two range is split into 2^(SUB_BUCKET_BITS-1) linear buckets, so every bucket is within
+    1/2^(SUB_BUCKET_BITS-1) of its values and the buckets needed grow only with the log of the largest value
+    """
+
+    SUB_BUCKET_BITS = 7
+    UNIT = 1e-6
+
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    @classmethod
+    def _index(cls, value):
+        if value < 1 << cls.SUB_BUCKET_BITS:
+            return value
+        shift = value.bit_length() - cls.SUB_BUCKET_BITS
+        half = 1 << (cls.SUB_BUCKET_BITS - 1)
+        return (1 << cls.SUB_BUCKET_BITS) + (shift - 1) * half + (value >> shift) - half
+
+    @classmethod
+    def _bounds(cls, index):
+        """The lowest and highest value counted in a bucket"""
+
+        if index < 1 << cls.SUB_BUCKET_BITS:
+            return index, index
+        half = 1 << (cls.SUB_BUCKET_BITS - 1)
+        shift, sub = divmod(index - (1 << cls.SUB_BUCKET_BITS), half)
+        low = (sub + half) << (shift + 1)
+        return low, low + (1 << (shift + 1)) - 1
+
+    def record(self, seconds):
+        value = max(0, round(seconds / self.UNIT))
+        index = self._index(value)
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def merge(self, other):
+        """Add the counts of another histogram to this one"""
+
+        for index, count in other.counts.items():
+            self.counts[index] = self.counts.get(index, 0) + count
+        self.count += other.count
+        self.total += other.total
+        for value in (other.min, other.max):
+            if value is not None:
+                self.min = value if self.min is None else min(self.min, value)
+                self.max = value if self.max is None else max(self.max, value)
+
+    def percentile(self, percentile):
+        """The given percentile in seconds, nearest rank, as the middle of its bucket. None if empty"""
+
+        if not self.count:
+            return None
+        # The smallest value with at least percentile% of values at or below it. Multiplying before dividing keeps
+        # e.g. 99.9% of 1000 at exactly rank 999
+        rank = max(1, math.ceil(percentile * self.count / 100))
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                low, high = self._bounds(index)
+                return min(max((low + high) / 2, self.min), self.max) * self.UNIT
+        return self.max * self.UNIT
+
+    @property
+    def mean(self):
+        return self.total / self.count * self.UNIT if self.count else None
+
+    def to_dict(self):
+        """Summary statistics in seconds, and the count of each bucket keyed by its lowest value in microseconds"""
+
+        return {
+            "count": self.count,
+            "min": None if self.min is None else self.min * self.UNIT,
+            "mean": self.mean,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+            "p999": self.percentile(99.9),
+            "max": None if self.max is None else self.max * self.UNIT,
+            "buckets": {str(self._bounds(index)[0]): count for index, count in sorted(self.counts.items())},
+        }
+
+
+class StageLatencyRecorder:
+    """Timestamps the status transitions of transactions, aggregating the time spent reaching each status
+    into a LatencyHistogram per stage and per peer. A stage is named by the status it ends in, and TOTAL covers
+    sending until the final status
+
+    Usage:
+        PeerConnection.stage_recorder = StageLatencyRecorder()
+        ... send transactions ...
+        print(PeerConnection.stage_recorder.format_table())
+        PeerConnection.stage_recorder.save("stages.json")
+    """
+
+    TOTAL = "TOTAL"
+
+    def __init__(self, max_transactions=10000):
+        """
+        Args:
+            max_transactions (int, optional): The most recent transaction paths kept for export, and
+                sent transactions awaiting a status stream before the oldest are forgotten. Defaults to 10000
+        """
+
+        self.max_transactions = max_transactions
+        self.stages = {}
+        self.peers = {}
+        self.transactions = deque(maxlen=max_transactions)
+        self._sent = OrderedDict()
+        self._lock = threading.Lock()
+
+    def sent(self, transaction_hash):
+        """Timestamp the sending of a transaction. Resending it, e.g. on failover, keeps the first time"""
+
+        now = time.monotonic()
+        with self._lock:
+            self._sent.setdefault(transaction_hash, now)
+            while len(self._sent) > self.max_transactions:
+                self._sent.popitem(last=False)
+
+    def record(self, transaction_hash, peer, transitions):
+        """Record the statuses of a transaction streamed from a peer
+
+        Args:
+            transaction_hash (bytes): The hash of the transaction
+            peer (String): The name of the peer that streamed the statuses
+            transitions (list of (String, float)): Each status, and the time.monotonic() it arrived
+        """
+
+        if not transitions:
+            return
+        with self._lock:
+            start = self._sent.pop(transaction_hash, None)
+            # A transaction not sent through a recorded connection has no start, so its first stage is unknown
+            previous = start if start is not None else transitions[0][1]
+            durations = []
+            for status, arrived in transitions:
+                durations.append((status, arrived - previous))
+                previous = arrived
+            if start is None:
+                durations = durations[1:]
+            else:
+                durations.append((self.TOTAL, transitions[-1][1] - start))
+            peer_stages = self.peers.setdefault(peer, {})
+            for stage, duration in durations:
+                self.stages.setdefault(stage, LatencyHistogram()).record(duration)
+                peer_stages.setdefault(stage, LatencyHistogram()).record(duration)
+            self.transactions.append({
+                "hash": binascii.hexlify(transaction_hash).decode(),
+                "peer": peer,
+                "stages": [[status, round(duration, 6)] for status, duration in durations],
+            })
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                "stages": {stage: histogram.to_dict() for stage, histogram in self.stages.items()},
+                "peers": {peer: {stage: histogram.to_dict() for stage, histogram in stages.items()}
+                          for peer, stages in self.peers.items()},
+                "transactions": list(self.transactions),
+            }
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f)
+
+    def format_table(self):
+        """The count and latency percentiles of each stage, overall and per peer, as a plain text table"""
+
+        def ms(seconds):
+            return "-" if seconds is None else f"{seconds * 1000:.1f}"
+
+        rows = [("peer", "stage", "count", "p50 ms", "p90 ms", "p99 ms", "max ms")]
+        with self._lock:
+            for peer, stages in [("all", self.stages), *sorted(self.peers.items())]:
+                for stage, histogram in stages.items():
+                    rows.append((peer, stage, str(histogram.count), ms(histogram.percentile(50)),
+                        ms(histogram.percentile(90)), ms(histogram.percentile(99)), ms(histogram.max * histogram.UNIT)))
+        widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+        return "\n".join("  ".join(cell.rjust(width) for cell, width in zip(row, widths)) for row in rows)
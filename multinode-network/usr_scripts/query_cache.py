@@ -0,0 +1,132 @@
+"""
+A cache of query responses in front of a connection, valid until the next block commits
+
+Usage:
+    from query_cache import QueryCache
+    cache = QueryCache(net_1)
+    get_balances(account_ids, asset_id, cache)
+"""
+from peer_registry import _query_caches
+from IrohaUtils import ADMIN_PRIVATE_KEY, iroha_admin, BlockSubscriber
+import threading
+from collections import OrderedDict
+from iroha import qry_responses_pb2
+
+# Query cache ------------------------------------------------------------------
+# Reads between blocks are answered locally. Each cached response is tagged with the chain height it was read at,
+# and every entry is dropped as soon as a new block commits: a BlockSubscriber reports each block, and a
+# transaction this client sees COMMITTED drops them at once, so a client always reads its own writes
+
+class QueryCache:
+    """An LRU cache of query responses in front of a connection, valid until the next block commits
+    A cache can be used in place of its connection, e.g. get_balances(ids, asset_id, cache): queries are
+    answered from the cache where possible, and everything else goes to the connection
+
+    Queries are keyed on their creator, signing key, type and arguments, not their time or counter, so a response
+    is only given again to the account Iroha checked it was permitted for. Error responses are not
+    cached. While the block stream is down nothing is cached, so a read is never older than the last block
+
+    Usage:
+        cache = QueryCache(net_1)
+        cache.send_query(query)  # Sent to net_1
+        cache.send_query(query)  # Answered locally, unless a block committed in between
+    """
+
+    def __init__(self, connection, max_entries=1024, creator=iroha_admin, private_key=ADMIN_PRIVATE_KEY):
+        """
+        Args:
+            connection (PeerConnection or PeerRegistry): The connection to query and stream blocks from
+            max_entries (int, optional): The most responses kept, the least recently used dropped first. Defaults to 1024
+            creator (Iroha, optional): Creates the blocks query. Defaults to the admin
+            private_key (String, optional): Signs the blocks query. Defaults to the admin private key
+        """
+
+        self.connection = connection
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._subscriber = BlockSubscriber(connection, [self._on_block], creator=creator, private_key=private_key)
+        self._started = False
+        _query_caches.add(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __getattr__(self, name):
+        # Everything but queries goes straight to the connection
+        return getattr(self.connection, name)
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def height(self):
+        """The height of the last block seen, None until subscribed"""
+        return self._subscriber.height
+
+    @staticmethod
+    def _key(query):
+        kind = query.payload.WhichOneof("query")
+        return (query.payload.meta.creator_account_id, query.signature.public_key, kind,
+                getattr(query.payload, kind).SerializeToString(deterministic=True))
+
+    def _on_block(self, block):
+        self.invalidate()
+
+    def invalidate(self):
+        """Drop every entry, as a block has committed"""
+
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
+
+    def send_query(self, query, timeout=None):
+        """Answer a query from the cache, or send it to the connection and cache the response
+
+        Returns:
+            QueryResponse: The response, a copy of the cached one on a hit
+        """
+
+        if not self._started:
+            with self._lock:
+                if not self._started:
+                    self._subscriber.start()
+                    self._started = True
+        key = self._key(query)
+        with self._lock:
+            # While not following blocks, a block may have committed unseen, so nothing cached can be trusted
+            entry = self._entries.get(key) if self._subscriber.live else None
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                response = qry_responses_pb2.QueryResponse()
+                response.CopyFrom(entry[1])
+                return response
+            self.misses += 1
+            generation, height = self._generation, self.height
+            live = self._subscriber.live
+        response = self.connection.send_query(query, timeout)
+        if not live or response.HasField("error_response"):
+            return response
+        with self._lock:
+            # A block committed while the query was in flight may or may not be in the response, so it is not kept
+            if self._generation == generation:
+                cached = qry_responses_pb2.QueryResponse()
+                cached.CopyFrom(response)
+                self._entries[key] = (height, cached)
+                if len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return response
+
+    def close(self):
+        """Stop following blocks. The connection is left open"""
+
+        if self._started:
+            self._subscriber.stop()
+        _query_caches.discard(self)